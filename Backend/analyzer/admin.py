@@ -1,8 +1,9 @@
 from django.contrib import admin
-from .models import FoodAnalysis, AnalysisSession
+from .models import FoodAnalysis, AnalysisSession, LabelImage
 # from django.contrib.auth.admin import UserAdmin
 
 # Register your models here.
 # admin.site.register(User, UserAdmin)
 admin.site.register(FoodAnalysis)
-admin.site.register(AnalysisSession)
\ No newline at end of file
+admin.site.register(AnalysisSession)
+admin.site.register(LabelImage)
\ No newline at end of file
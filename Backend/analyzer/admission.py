@@ -0,0 +1,246 @@
+import logging
+import math
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+from django.conf import settings
+from django.http import JsonResponse
+from .deadlines import Deadline
+from .utils import get_client_ip
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_ADMISSION_CONTROL = {
+    'max_concurrency': 2,
+    'max_queue': 8,
+    'max_wait_seconds': 15,
+}
+
+RATE_PERIODS = {'s': 1, 'm': 60, 'h': 3600}
+
+
+class AdmissionRejected(Exception):
+    """Raised when a request cannot be admitted in time"""
+
+    def __init__(self, reason, retry_after):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+def parse_rate(rate):
+    """Parse a '<count>/<s|m|h>' rate into (count, period_seconds)"""
+    if not rate:
+        return None
+    count, period = rate.split('/')
+    return int(count), RATE_PERIODS[period.strip()[0].lower()]
+
+
+class RateLimiter:
+    """Token-bucket rate limiter keyed by client (IP address or session)"""
+
+    def __init__(self, rate, max_keys=10000):
+        count, period = parse_rate(rate)
+        self.capacity = count
+        self.refill_per_second = count / period
+        self.max_keys = max_keys
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def hit(self, key):
+        """Take a token for `key`; return 0 if allowed, else seconds until retry"""
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (self.capacity, now))
+            tokens = min(self.capacity, tokens + (now - updated) * self.refill_per_second)
+            if tokens >= 1:
+                self._buckets[key] = (tokens - 1, now)
+                retry_after = 0
+            else:
+                self._buckets[key] = (tokens, now)
+                retry_after = (1 - tokens) / self.refill_per_second
+            if len(self._buckets) > self.max_keys:
+                self._prune(now)
+        return retry_after
+
+    def _prune(self, now):
+        # Buckets that have refilled completely carry no state worth keeping
+        full_after = self.capacity / self.refill_per_second
+        self._buckets = {
+            key: value for key, value in self._buckets.items()
+            if now - value[1] < full_after
+        }
+
+
+class AdmissionController:
+    """Bound concurrent work on an endpoint with a bounded, time-limited wait queue.
+
+    Up to `max_concurrency` requests run at once. Up to `max_queue` more wait
+    for a slot, each for at most `max_wait_seconds`; anything beyond that is
+    rejected immediately so the requests we do accept keep a bounded latency.
+    """
+
+    def __init__(self, name, max_concurrency, max_queue, max_wait_seconds):
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.max_wait_seconds = max_wait_seconds
+        self._condition = threading.Condition()
+        self._active = 0
+        self._waiting = 0
+        self._service_time = None
+
+    @contextmanager
+    def admit(self, max_wait=None):
+        """Hold a slot for the duration of the block or raise AdmissionRejected"""
+        release = self.acquire(max_wait)
+        try:
+            yield
+        finally:
+            release()
+
+    def acquire(self, max_wait=None):
+        """Take a slot or raise AdmissionRejected; returns the function that frees it"""
+        self._acquire(max_wait)
+        started = time.monotonic()
+
+        def release():
+            elapsed = time.monotonic() - started
+            with self._condition:
+                self._active -= 1
+                self._service_time = elapsed if self._service_time is None else (
+                    0.3 * elapsed + 0.7 * self._service_time
+                )
+                self._condition.notify()
+        return release
+
+    def _acquire(self, max_wait=None):
+        with self._condition:
+            if self._active < self.max_concurrency and self._waiting == 0:
+                self._active += 1
+                return
+            if self._waiting >= self.max_queue:
+                raise AdmissionRejected('queue full', self._retry_after())
+
+            self._waiting += 1
+            wait = self.max_wait_seconds if max_wait is None else min(max_wait, self.max_wait_seconds)
+            deadline = time.monotonic() + wait
+            try:
+                while self._active >= self.max_concurrency:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise AdmissionRejected('queue wait timed out', self._retry_after())
+                    self._condition.wait(remaining)
+            finally:
+                self._waiting -= 1
+            self._active += 1
+
+    def _retry_after(self):
+        """Estimate seconds until the queue drains enough to accept a request"""
+        service_time = self._service_time or self.max_wait_seconds
+        backlog = (self._waiting + 1) / max(self.max_concurrency, 1)
+        return max(1, math.ceil(backlog * service_time))
+
+    def stats(self):
+        with self._condition:
+            return {'active': self._active, 'waiting': self._waiting}
+
+
+_controllers = {}
+_rate_limiters = {}
+_registry_lock = threading.Lock()
+
+
+def get_admission_controller(endpoint):
+    """Get or create the admission controller for an endpoint"""
+    with _registry_lock:
+        controller = _controllers.get(endpoint)
+        if controller is None:
+            config = {
+                **DEFAULT_ADMISSION_CONTROL,
+                **getattr(settings, 'ADMISSION_CONTROL', {}).get(endpoint, {}),
+            }
+            controller = _controllers[endpoint] = AdmissionController(endpoint, **config)
+        return controller
+
+
+def get_rate_limiters(endpoint):
+    """Get or create the (scope, limiter) pairs configured for an endpoint"""
+    with _registry_lock:
+        limiters = _rate_limiters.get(endpoint)
+        if limiters is None:
+            config = getattr(settings, 'RATE_LIMITS', {}).get(endpoint, {})
+            limiters = _rate_limiters[endpoint] = [
+                (scope, RateLimiter(config[scope]))
+                for scope in ('per_ip', 'per_session')
+                if config.get(scope)
+            ]
+        return limiters
+
+
+def hold_admission(request, future):
+    """Keep the request's admission slot until `future` is done, even past the response.
+
+    An LLM call the view stopped waiting for still occupies a backend and a
+    background thread, so it keeps counting against the endpoint's concurrency.
+    """
+    if not hasattr(request, '_admission_holds'):
+        request._admission_holds = []
+    request._admission_holds.append(future)
+
+
+def _release_when_done(release, futures):
+    pending = [future for future in futures if not future.done()]
+    if not pending:
+        release()
+        return
+    lock = threading.Lock()
+    remaining = [len(pending)]
+
+    def done(future):
+        with lock:
+            remaining[0] -= 1
+            last = remaining[0] == 0
+        if last:
+            release()
+    for future in pending:
+        future.add_done_callback(done)
+
+
+def _rejection(message, status, retry_after):
+    response = JsonResponse({'error': message, 'retry_after': retry_after}, status=status)
+    response['Retry-After'] = str(retry_after)
+    return response
+
+
+def admission_controlled(endpoint):
+    """Apply per-client rate limits and admission control to an LLM-bound view"""
+    def decorator(view_func):
+        @wraps(view_func)
+        def wrapped(request, *args, **kwargs):
+            keys = {
+                'per_ip': get_client_ip(request),
+                'per_session': request.session.session_key,
+            }
+            for scope, limiter in get_rate_limiters(endpoint):
+                if not keys[scope]:
+                    continue
+                retry_after = limiter.hit(keys[scope])
+                if retry_after:
+                    logger.info(f"Rate limited {endpoint} request ({scope}: {keys[scope]})")
+                    return _rejection('Too many requests. Please slow down.', 429, math.ceil(retry_after))
+
+            # Start the request's deadline before it queues for a slot
+            deadline = Deadline.for_request(request, endpoint)
+            try:
+                release = get_admission_controller(endpoint).acquire(max_wait=deadline.remaining())
+            except AdmissionRejected as e:
+                logger.warning(f"Shed {endpoint} request: {e.reason}")
+                return _rejection('Server is busy. Please try again shortly.', 503, e.retry_after)
+            try:
+                return view_func(request, *args, **kwargs)
+            finally:
+                _release_when_done(release, getattr(request, '_admission_holds', ()))
+        return wrapped
+    return decorator
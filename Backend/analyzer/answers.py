@@ -0,0 +1,124 @@
+import hashlib
+import logging
+import re
+import time
+from django.conf import settings
+from django.core.cache import cache
+from .admission import AdmissionRejected, get_admission_controller
+from .tasks import BackgroundLane
+
+logger = logging.getLogger(__name__)
+
+# Words that don't change what is being asked. Negations and quantities stay:
+# "is it safe" and "is it not safe" must not share an answer.
+STOPWORDS = frozenset("""
+a an the this that these those it its it's is are was be been am do does did can could would should will shall
+i me my we our you your he she they them their please tell know let us just about of in on at to for from with
+there here what which any some so really actually product food item eat eating
+""".split())
+
+# Prefix length that folds inflections together ("diabetic"/"diabetes", "allergic"/"allergens")
+STEM_LENGTH = 6
+
+
+def question_tokens(question):
+    """Normalized word set of a question, used as its cache identity"""
+    words = re.findall(r"[a-z0-9]+", (question or '').lower())
+    return frozenset(word[:STEM_LENGTH] for word in words if word not in STOPWORDS)
+
+
+def _cache_key(analysis):
+    # Copies of an analysis share its answers; a re-analysis invalidates them
+    digest = hashlib.sha1((analysis.analysis_result or '').encode()).hexdigest()[:12]
+    return f"chat-answers:{analysis.reused_from_id or analysis.id}:{digest}"
+
+
+def get_cached_answer(analysis, question):
+    """Cached first-turn answer to the same question about the analysis, or None.
+
+    Questions match only when their content words are the same: they may differ
+    in stopwords, word order and inflection, but not in a single content word,
+    since "low blood pressure" and "high blood pressure" need different answers.
+    """
+    if not getattr(settings, 'CHAT_ANSWER_CACHE', True):
+        return None
+    tokens = question_tokens(question)
+    if not tokens:
+        return None
+    for entry in cache.get(_cache_key(analysis), []):
+        if entry['tokens'] == tokens:
+            logger.info(f"💬 Answer cache hit for analysis {analysis.id}")
+            return entry
+    return None
+
+
+def cache_answer(analysis, question, answer, title=None, model=''):
+    """Remember a first-turn answer; the most recent entries per analysis are kept"""
+    if not getattr(settings, 'CHAT_ANSWER_CACHE', True):
+        return
+    tokens = question_tokens(question)
+    if not tokens:
+        return
+    key = _cache_key(analysis)
+    # Concurrent writers may drop each other's entry, which only costs a cache miss
+    entries = [entry for entry in cache.get(key, []) if entry['tokens'] != tokens]
+    entries.append({
+        'tokens': tokens,
+        'question': question,
+        'answer': answer,
+        'title': title,
+        'model': model,
+        'cached_at': time.time(),
+    })
+    max_entries = getattr(settings, 'CHAT_ANSWER_CACHE_MAX_ENTRIES', 20)
+    cache.set(key, entries[-max_entries:], getattr(settings, 'CHAT_ANSWER_CACHE_TTL', 24 * 3600))
+
+
+# Precomputing is optional, so it gets one thread of its own and is dropped when
+# that falls behind, rather than competing with requests for the shared pool
+_precompute_lane = BackgroundLane(
+    'analyzer-precompute', workers=1, max_pending=getattr(settings, 'CHAT_ANSWER_PRECOMPUTE_MAX_PENDING', 8)
+)
+
+
+def precompute_answers(analysis):
+    """Answer the configured common questions about a fresh analysis ahead of time.
+
+    Each answer takes a chat admission slot without waiting, so precomputing
+    only uses LLM capacity that no chat request wants; it stops at the first
+    question no slot is free for.
+    """
+    from .services import get_food_analyzer_service
+    # The chat view owns the prompt format; import late to avoid a cycle
+    from .views import build_chat_prompt, parse_llm_response
+
+    service = get_food_analyzer_service()
+    controller = get_admission_controller('chat')
+    for question in getattr(settings, 'CHAT_ANSWER_PRECOMPUTE_QUESTIONS', []):
+        if get_cached_answer(analysis, question) is not None:
+            continue
+        prompt = build_chat_prompt(analysis, [{'role': 'user', 'content': question}], question, with_title=True)
+        try:
+            with controller.admit(max_wait=0):
+                reply = service.generate('chat', prompt)
+        except AdmissionRejected:
+            logger.info(f"💬 Chat is busy, stopped precomputing answers for analysis {analysis.id}")
+            return
+        title, answer = parse_llm_response(reply.text)
+        if not answer or not answer.strip():
+            continue
+        if not title:
+            try:
+                title = service.generate_title(question, answer)
+            except Exception as e:
+                logger.warning(f"⚠️ Title generation failed: {str(e)}")
+        cache_answer(analysis, question, answer, title, reply.model)
+    logger.info(f"💬 Precomputed answers for analysis {analysis.id}")
+
+
+def schedule_precompute(analysis):
+    """Precompute common answers in the background, if any are configured"""
+    if not getattr(settings, 'CHAT_ANSWER_CACHE', True) or not getattr(settings, 'CHAT_ANSWER_PRECOMPUTE_QUESTIONS', []):
+        return
+    if _precompute_lane.submit(precompute_answers, analysis) is None:
+        logger.info(f"💬 Precompute queue full, skipped analysis {analysis.id}")
@@ -1,3 +1,4 @@
+import sys
 from django.apps import AppConfig
 
 class AnalyzerConfig(AppConfig):
@@ -7,12 +8,22 @@ class AnalyzerConfig(AppConfig):
     
     def ready(self):
         """Initialize the app when Django starts"""
+        from . import signals  # noqa: F401  (registers signal handlers)
+
+        # Compile the ingredient knowledge base once, before the first request
+        try:
+            from .knowledge import get_ingredient_knowledge
+            get_ingredient_knowledge()
+        except Exception as e:
+            print(f"⚠️  Warning: Could not load the ingredient knowledge base: {e}", file=sys.stderr)
+
+        # Startup notes go to stderr so commands that write data to stdout stay clean
         # Import services to ensure LangChain is initialized
         try:
             from .services import get_food_analyzer_service
             # Test the service initialization
             service = get_food_analyzer_service()
-            print("✅ Food Analyzer Service initialized successfully")
+            print("✅ Food Analyzer Service initialized successfully", file=sys.stderr)
         except Exception as e:
-            print(f"⚠️  Warning: Could not initialize Food Analyzer Service: {e}")
-            print("Make sure Ollama is running and a model is available")
\ No newline at end of file
+            print(f"⚠️  Warning: Could not initialize Food Analyzer Service: {e}", file=sys.stderr)
+            print("Make sure Ollama is running and a model is available", file=sys.stderr)
\ No newline at end of file
@@ -0,0 +1,213 @@
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+import requests
+
+logger = logging.getLogger(__name__)
+
+# Weight of the newest sample in the per-backend latency moving average
+LATENCY_EWMA_ALPHA = 0.3
+
+
+class NoHealthyBackend(Exception):
+    """Raised when every configured Ollama backend is ejected"""
+
+
+class OllamaResponseError(ValueError):
+    """Ollama answered a generation with an error status"""
+
+    def __init__(self, status, detail):
+        # Same message as LangChain's Ollama, which raises a plain ValueError
+        super().__init__(f"Ollama call failed with status code {status}. Details: {detail}")
+        self.status = status
+        self.detail = detail or ''
+
+
+def is_missing_model(error):
+    """Whether a generation failed because the node hasn't pulled the model"""
+    return isinstance(error, OllamaResponseError) and (
+        error.status == 404 or 'not found' in error.detail.lower()
+    )
+
+
+def is_backend_failure(error):
+    """Whether a generation error is the node's fault, so it counts towards ejecting it.
+
+    Connection errors, 5xx responses and empty streams are. A 4xx, such as a
+    model missing on that node, is about the request: the node still serves
+    every other model, so it is retried elsewhere but never ejects the node.
+    """
+    if isinstance(error, requests.exceptions.RequestException):
+        return True
+    if isinstance(error, OllamaResponseError):
+        return error.status >= 500 and not is_missing_model(error)
+    return isinstance(error, ValueError) and str(error).startswith('No data received from Ollama')
+
+
+def is_retryable(error):
+    """Whether another node may serve a generation that failed with `error`"""
+    return is_backend_failure(error) or is_missing_model(error)
+
+
+def normalize_model_name(model):
+    """Ollama's name for a model: 'llama3.2' is 'llama3.2:latest'"""
+    return model if ':' in model else f"{model}:latest"
+
+
+class OllamaBackend:
+    """State and statistics for one Ollama inference node"""
+
+    def __init__(self, url):
+        self.url = url.rstrip('/')
+        self.healthy = True
+        self.inflight = 0
+        self.consecutive_failures = 0
+        self.requests = 0
+        self.failures = 0
+        self.avg_latency = None
+        self.last_error = ''
+        self.models = None  # Names from the last successful health check
+
+    def stats(self):
+        return {
+            'url': self.url,
+            'healthy': self.healthy,
+            'inflight': self.inflight,
+            'requests': self.requests,
+            'failures': self.failures,
+            'avg_latency_seconds': round(self.avg_latency, 3) if self.avg_latency is not None else None,
+            'last_error': self.last_error,
+            'models': sorted(self.models) if self.models is not None else None,
+        }
+
+
+class OllamaBackendPool:
+    """Dispatch generations to the least-loaded healthy Ollama backend.
+
+    A backend is ejected after `max_failures` consecutive failed generations
+    (connection errors, 5xx responses or empty streams) and re-admitted once a background
+    health check (GET /api/tags) succeeds; the check also records the models
+    each node has. The health checker starts lazily, checks straight away and
+    restarts in forked worker processes.
+    """
+
+    def __init__(self, urls, max_failures=3, health_check_interval=15, health_check_timeout=3):
+        if not urls:
+            raise ValueError("At least one Ollama backend URL is required")
+        self.backends = [OllamaBackend(url) for url in urls]
+        self.max_failures = max_failures
+        self.health_check_interval = health_check_interval
+        self.health_check_timeout = health_check_timeout
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._pid = None
+
+    def start(self):
+        """Start the background health checker for this process if needed"""
+        if not self.health_check_interval:
+            return
+        with self._lock:
+            if self._pid == os.getpid() and self._thread and self._thread.is_alive():
+                return
+            self._pid = os.getpid()
+            self._stop.clear()
+            self._thread = threading.Thread(
+                target=self._health_loop, name='ollama-health-check', daemon=True
+            )
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def acquire(self, exclude=()):
+        """Pick the healthy backend with the fewest in-flight generations"""
+        self.start()
+        with self._lock:
+            candidates = [b for b in self.backends if b.healthy and b.url not in exclude]
+            if not candidates:
+                raise NoHealthyBackend("No healthy Ollama backend available")
+            backend = min(candidates, key=lambda b: (b.inflight, b.avg_latency or 0))
+            backend.inflight += 1
+            backend.requests += 1
+            return backend
+
+    @contextmanager
+    def use(self, exclude=()):
+        """Hold a backend for one generation, recording its outcome"""
+        backend = self.acquire(exclude)
+        started = time.monotonic()
+        try:
+            yield backend
+        except Exception as e:
+            if is_backend_failure(e):
+                self._record_failure(backend, e)
+            raise
+        else:
+            self._record_success(backend, time.monotonic() - started)
+        finally:
+            with self._lock:
+                backend.inflight -= 1
+
+    def _record_success(self, backend, elapsed):
+        with self._lock:
+            backend.consecutive_failures = 0
+            backend.avg_latency = elapsed if backend.avg_latency is None else (
+                LATENCY_EWMA_ALPHA * elapsed + (1 - LATENCY_EWMA_ALPHA) * backend.avg_latency
+            )
+
+    def _record_failure(self, backend, error):
+        with self._lock:
+            backend.failures += 1
+            backend.consecutive_failures += 1
+            backend.last_error = str(error)[:200]
+            if backend.healthy and backend.consecutive_failures >= self.max_failures:
+                backend.healthy = False
+                logger.warning(f"Ejected Ollama backend {backend.url}: {backend.last_error}")
+
+    def check(self, backend):
+        """Probe one backend and eject or re-admit it accordingly"""
+        try:
+            response = requests.get(f"{backend.url}/api/tags", timeout=self.health_check_timeout)
+            response.raise_for_status()
+            models = {normalize_model_name(model.get('name', '')) for model in response.json().get('models', [])}
+        except (requests.exceptions.RequestException, ValueError, AttributeError) as e:
+            with self._lock:
+                backend.last_error = str(e)[:200]
+                if backend.healthy:
+                    backend.healthy = False
+                    logger.warning(f"Ejected Ollama backend {backend.url}: health check failed")
+            return False
+
+        with self._lock:
+            backend.consecutive_failures = 0
+            backend.models = models
+            if not backend.healthy:
+                backend.healthy = True
+                logger.info(f"Re-admitted Ollama backend {backend.url}")
+        return True
+
+    def has_model(self, model):
+        """Whether a healthy node has `model`; None until a node has reported its models"""
+        model = normalize_model_name(model)
+        with self._lock:
+            reported = [b.models for b in self.backends if b.healthy and b.models is not None]
+        if not reported:
+            return None
+        return any(model in models for models in reported)
+
+    def check_all(self):
+        return {backend.url: self.check(backend) for backend in self.backends}
+
+    def _health_loop(self):
+        while True:
+            for backend in self.backends:
+                self.check(backend)
+            if self._stop.wait(self.health_check_interval):
+                return
+
+    def stats(self):
+        with self._lock:
+            return [backend.stats() for backend in self.backends]
@@ -0,0 +1,49 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from django.conf import settings
+
+# Serialized chat read responses of this process, keyed by ('history', chat_id)
+# or ('chats', user_id) and stored with the ETag they were built for. An entry
+# is only returned for that ETag, which the views compute from the database on
+# every request, so a write in another process just makes it stop matching;
+# invalidate() frees entries early in the writing process. Bounded by
+# CHAT_RESPONSE_CACHE_MAX_ENTRIES entries of CHAT_RESPONSE_CACHE_MAX_ENTRY_BYTES.
+_entries = OrderedDict()
+_lock = threading.Lock()
+
+
+def make_etag(*parts):
+    """Opaque ETag for a tuple of validator values"""
+    return hashlib.sha1(repr(parts).encode()).hexdigest()[:20]
+
+
+def get(key, etag):
+    """Cached response body for `key` if it was built for `etag`"""
+    with _lock:
+        entry = _entries.get(key)
+        if entry is None or entry[0] != etag:
+            return None
+        _entries.move_to_end(key)
+        return entry[1]
+
+
+def put(key, etag, content):
+    if len(content) > getattr(settings, 'CHAT_RESPONSE_CACHE_MAX_ENTRY_BYTES', 256 * 1024):
+        with _lock:
+            _entries.pop(key, None)
+        return
+    with _lock:
+        _entries[key] = (etag, content)
+        _entries.move_to_end(key)
+        while len(_entries) > getattr(settings, 'CHAT_RESPONSE_CACHE_MAX_ENTRIES', 1000):
+            _entries.popitem(last=False)
+
+
+def invalidate(chat_id=None, user_id=None):
+    """Drop the cached responses a write to a chat (and its owner's chat list) affects"""
+    with _lock:
+        if chat_id is not None:
+            _entries.pop(('history', chat_id), None)
+        if user_id is not None:
+            _entries.pop(('chats', user_id), None)
@@ -0,0 +1,52 @@
+import time
+from django.conf import settings
+
+DEFAULT_REQUEST_DEADLINES = {
+    'analyze': 45,
+    'chat': 25,
+}
+
+
+class DeadlineExceeded(Exception):
+    """Raised when a pipeline stage starts after the request's budget ran out"""
+
+    def __init__(self, stage):
+        super().__init__(f"Deadline exceeded before {stage}")
+        self.stage = stage
+
+
+class Deadline:
+    """Time budget for one request, carried through every pipeline stage"""
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.started_at = time.monotonic()
+        self.expires_at = self.started_at + seconds if seconds else None
+
+    @classmethod
+    def for_request(cls, request, endpoint):
+        """Get the request's deadline, starting its clock on first use"""
+        deadline = getattr(request, '_deadline', None)
+        if deadline is None:
+            seconds = {
+                **DEFAULT_REQUEST_DEADLINES,
+                **getattr(settings, 'REQUEST_DEADLINES', {}),
+            }.get(endpoint)
+            deadline = request._deadline = cls(seconds)
+        return deadline
+
+    def remaining(self, reserve=0):
+        """Seconds left, keeping `reserve` seconds back for later stages"""
+        if self.expires_at is None:
+            return None
+        return max(self.expires_at - time.monotonic() - reserve, 0)
+
+    def expired(self, reserve=0):
+        return self.expires_at is not None and self.remaining(reserve) <= 0
+
+    def check(self, stage, reserve=0):
+        if self.expired(reserve):
+            raise DeadlineExceeded(stage)
+
+    def elapsed(self):
+        return time.monotonic() - self.started_at
@@ -0,0 +1,118 @@
+import csv
+import datetime
+import json
+import uuid
+from django.conf import settings
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+from .models import Chat, FoodAnalysis, Message
+
+# Columns exported per dataset, in order
+DATASETS = {
+    'analyses': (FoodAnalysis, [
+        'id', 'created_at', 'status', 'recommendation', 'health_score', 'llm_model', 'llm_latency_ms',
+        'ocr_confidence', 'reused_from_id', 'label_image_id', 'ingredients_text', 'nutrition_text',
+        'ingredient_tags', 'extracted_text', 'analysis_result',
+    ]),
+    'chats': (Chat, ['id', 'created_at', 'user_id', 'title', 'is_title_auto_generated', 'analysis_id']),
+    'messages': (Message, ['id', 'created_at', 'chat_id', 'role', 'content', 'llm_model', 'llm_latency_ms']),
+}
+
+# Lookup from each dataset to the owning user's id
+USER_FIELDS = {
+    'chats': 'user_id',
+    'messages': 'chat__user_id',
+}
+
+FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+
+
+def parse_bound(value, end=False):
+    """Parse an ISO date or datetime filter; a bare `end` date includes that whole day"""
+    if not value:
+        return None
+    # Dates first: parse_datetime also accepts a bare date, as midnight
+    day = parse_date(value)
+    if day is not None:
+        moment = datetime.datetime.combine(day + datetime.timedelta(days=1) if end else day, datetime.time.min)
+    else:
+        moment = parse_datetime(value)
+        if moment is None:
+            raise ValueError(f"Invalid date: {value!r}")
+    if settings.USE_TZ and timezone.is_naive(moment):
+        moment = timezone.make_aware(moment)
+    return moment
+
+
+def export_rows(dataset, since=None, until=None, recommendation=None, user=None, chunk_size=None):
+    """Stream (fields, rows) for a dataset without loading it into memory.
+
+    `until` is exclusive. Rows come from `.iterator()`, which uses a
+    server-side cursor on PostgreSQL, so memory stays flat at any size.
+    """
+    if dataset not in DATASETS:
+        raise ValueError(f"Unknown dataset: {dataset!r}")
+    model, fields = DATASETS[dataset]
+    queryset = model.objects.all()
+    if since:
+        queryset = queryset.filter(created_at__gte=since)
+    if until:
+        queryset = queryset.filter(created_at__lt=until)
+    if recommendation:
+        if dataset != 'analyses':
+            raise ValueError("Only analyses can be filtered by recommendation")
+        queryset = queryset.filter(recommendation=recommendation.upper())
+    if user:
+        if dataset not in USER_FIELDS:
+            raise ValueError("Only chats and messages can be filtered by user")
+        try:
+            user = int(user)
+        except (TypeError, ValueError):
+            raise ValueError(f"Invalid user id: {user!r}")
+        queryset = queryset.filter(**{USER_FIELDS[dataset]: user})
+    chunk_size = chunk_size or getattr(settings, 'EXPORT_CHUNK_SIZE', 2000)
+    rows = queryset.order_by('created_at', 'pk').values_list(*fields).iterator(chunk_size=chunk_size)
+    return fields, rows
+
+
+def _json_value(value):
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    if isinstance(value, uuid.UUID):
+        return str(value)
+    return value
+
+
+def iter_ndjson(fields, rows):
+    """One JSON object per line"""
+    for row in rows:
+        yield json.dumps(dict(zip(fields, map(_json_value, row))), ensure_ascii=False) + '\n'
+
+
+class _Echo:
+    """File-like object whose write() hands the line straight back to csv.writer"""
+
+    def write(self, value):
+        return value
+
+
+def iter_csv(fields, rows):
+    """A header line, then one CSV line per row; nested JSON is kept as a JSON string"""
+    writer = csv.writer(_Echo())
+    yield writer.writerow(fields)
+    for row in rows:
+        yield writer.writerow([
+            json.dumps(value, ensure_ascii=False) if isinstance(value, (dict, list)) else _json_value(value)
+            for value in row
+        ])
+
+
+def iter_export(fields, rows, export_format):
+    if export_format == 'csv':
+        return iter_csv(fields, rows)
+    if export_format == 'ndjson':
+        return iter_ndjson(fields, rows)
+    raise ValueError(f"Unknown format: {export_format!r}")
@@ -0,0 +1,206 @@
+import json
+import logging
+import os
+import re
+import threading
+import time
+from collections import deque
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_KNOWLEDGE_PATH = os.path.join(os.path.dirname(__file__), 'data', 'ingredient_knowledge.json')
+
+
+def normalize_ingredient_text(text):
+    """Lower-case text with every run of non-alphanumerics collapsed to one space"""
+    return re.sub(r'[^a-z0-9]+', ' ', (text or '').lower()).strip()
+
+
+class AhoCorasick:
+    """Multi-pattern matcher that finds every occurrence of every pattern in one pass"""
+
+    def __init__(self):
+        self._goto = [{}]
+        self._fail = [0]
+        self._outputs = [[]]  # (pattern length, payload) pairs ending at each node
+        self.patterns = 0
+
+    def add(self, pattern, payload):
+        node = 0
+        for char in pattern:
+            child = self._goto[node].get(char)
+            if child is None:
+                child = len(self._goto)
+                self._goto.append({})
+                self._fail.append(0)
+                self._outputs.append([])
+                self._goto[node][char] = child
+            node = child
+        self._outputs[node].append((len(pattern), payload))
+        self.patterns += 1
+
+    def build(self):
+        """Compute failure links breadth-first; call once after adding patterns"""
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, child in self._goto[node].items():
+                queue.append(child)
+                fail = self._fail[node]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[child] = self._goto[fail].get(char, 0)
+                # A node also ends every pattern its failure node ends
+                self._outputs[child] = self._outputs[child] + self._outputs[self._fail[child]]
+
+    def find(self, text):
+        """Yield (start, end, payload) for every pattern occurrence in text"""
+        node = 0
+        for i, char in enumerate(text):
+            while node and char not in self._goto[node]:
+                node = self._fail[node]
+            node = self._goto[node].get(char, 0)
+            for length, payload in self._outputs[node]:
+                yield i + 1 - length, i + 1, payload
+
+
+def _code_variants(code):
+    """Spellings of an E-number seen on labels: E330, E 330, INS 330, E150(d)"""
+    code = code.lower()
+    number = code[1:]
+    variants = {code, f"e {number}", f"ins {number}", f"ins{number}"}
+    if number[-1].isalpha():
+        variants.add(f"e{number[:-1]} {number[-1]}")
+    return variants
+
+
+class IngredientKnowledge:
+    """Compiled knowledge base of allergens, additives and ingredient flags.
+
+    Every term is compiled into a single Aho-Corasick automaton so tagging an
+    ingredient list is one linear pass regardless of the number of terms.
+    """
+
+    def __init__(self, data):
+        self.version = data.get('version')
+        self.allergens = data.get('allergens', {})
+        self.additives = {additive['code']: additive for additive in data.get('additives', [])}
+        self.flags = data.get('ingredient_flags', {})
+        self._matcher = AhoCorasick()
+        self._seen = set()
+
+        for allergen, terms in self.allergens.items():
+            for term in terms:
+                self._add(term, ('allergen', allergen))
+        for allergen, terms in data.get('allergen_exclusions', {}).items():
+            for term in terms:
+                self._add(term, ('exclude', allergen))
+        for code, additive in self.additives.items():
+            for term in _code_variants(code) | {additive['name'], *additive.get('aliases', [])}:
+                self._add(term, ('additive', code))
+        for flag, entry in self.flags.items():
+            for term in entry['terms']:
+                self._add(term, ('flag', flag))
+        self._matcher.build()
+
+    def _add(self, term, payload):
+        term = normalize_ingredient_text(term)
+        if term and (term, payload) not in self._seen:
+            self._seen.add((term, payload))
+            self._matcher.add(term, payload)
+
+    @classmethod
+    def load(cls, path=None):
+        path = path or getattr(settings, 'INGREDIENT_KNOWLEDGE_PATH', None) or DEFAULT_KNOWLEDGE_PATH
+        started = time.monotonic()
+        with open(path, encoding='utf-8') as f:
+            knowledge = cls(json.load(f))
+        logger.info(f"Compiled ingredient knowledge v{knowledge.version} ({knowledge._matcher.patterns} terms) "
+                    f"in {(time.monotonic() - started) * 1000:.0f} ms")
+        return knowledge
+
+    def _matches(self, text):
+        """Whole-word matches (allowing plural s/es) as (start, end, payload)"""
+        length = len(text)
+        for start, end, payload in self._matcher.find(text):
+            if start and text[start - 1] != ' ':
+                continue
+            for suffix in ('', 's', 'es'):
+                stop = end + len(suffix)
+                if text[end:stop] == suffix and (stop == length or text[stop] == ' '):
+                    yield start, stop, payload
+                    break
+
+    def tag(self, text):
+        """Tag allergens, additives and ingredient flags found in an ingredient list"""
+        text = normalize_ingredient_text(text)
+        matches = list(self._matches(text))
+        excluded = [(start, end, payload[1]) for start, end, payload in matches if payload[0] == 'exclude']
+
+        found = {'allergen': {}, 'additive': {}, 'flag': {}}
+        covered = {}
+        # Longest match first at each position so "glucose" inside "glucose syrup" is dropped
+        for start, end, (kind, key) in sorted(matches, key=lambda m: (m[0], -m[1])):
+            if kind == 'exclude' or end <= covered.get((kind, key), -1):
+                continue
+            # "cocoa butter" is not milk, nor is "coconut milk powder"
+            if kind == 'allergen' and any(s < end and start < e and a == key for s, e, a in excluded):
+                continue
+            covered[(kind, key)] = end
+            terms = found[kind].setdefault(key, [])
+            term = text[start:end]
+            if term not in terms:
+                terms.append(term)
+
+        return {
+            'allergens': [
+                {'name': name, 'matches': terms}
+                for name, terms in found['allergen'].items()
+            ],
+            'additives': [
+                {
+                    'code': code,
+                    'name': self.additives[code]['name'],
+                    'category': self.additives[code]['category'],
+                    'concern': self.additives[code]['concern'],
+                    'note': self.additives[code].get('note', ''),
+                    'matches': terms,
+                }
+                for code, terms in found['additive'].items()
+            ],
+            'flags': [
+                {'flag': flag, 'label': self.flags[flag]['label'], 'matches': terms}
+                for flag, terms in found['flag'].items()
+            ],
+        }
+
+
+def format_ingredient_hints(tags):
+    """Render ingredient tags as compact prompt lines"""
+    lines = []
+    if tags.get('allergens'):
+        lines.append("Allergens: " + ", ".join(
+            f"{allergen['name']} ({', '.join(allergen['matches'])})" for allergen in tags['allergens']
+        ))
+    if tags.get('additives'):
+        lines.append("Additives: " + "; ".join(
+            f"{additive['code']} {additive['name']} ({additive['category']}, {additive['concern']} concern)"
+            for additive in tags['additives']
+        ))
+    if tags.get('flags'):
+        lines.append("Flags: " + ", ".join(flag['label'] for flag in tags['flags']))
+    return '\n'.join(lines) or "Nothing flagged"
+
+
+_knowledge = None
+_knowledge_lock = threading.Lock()
+
+
+def get_ingredient_knowledge():
+    """Get the compiled ingredient knowledge base, building it on first use"""
+    global _knowledge
+    with _knowledge_lock:
+        if _knowledge is None:
+            _knowledge = IngredientKnowledge.load()
+        return _knowledge
@@ -0,0 +1,44 @@
+from django.core.management.base import BaseCommand
+from analyzer.retention import RetentionJob
+
+
+class Command(BaseCommand):
+    help = (
+        "Delete (and optionally archive to compressed JSONL) analyses, chats, "
+        "sessions, anonymous users and media older than the retention policies."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Only count what would be removed')
+        parser.add_argument('--archive-dir',
+                            help='Write removed rows to <dir>/<table>-<timestamp>.jsonl.gz first')
+        parser.add_argument('--batch-size', type=int,
+                            help='Rows deleted per transaction (default: RETENTION_BATCH_SIZE)')
+        for key in ('chats', 'analyses', 'sessions', 'anonymous-users'):
+            parser.add_argument(f'--{key}-days', type=int,
+                                help=f'Override the {key.replace("-", " ")} retention policy')
+
+    def handle(self, *args, **options):
+        policies = {}
+        for key in ('chats', 'analyses', 'sessions', 'anonymous_users'):
+            if options[f'{key}_days'] is not None:
+                policies[key] = options[f'{key}_days']
+
+        job = RetentionJob(
+            policies=policies,
+            archive_dir=options['archive_dir'],
+            batch_size=options['batch_size'],
+            dry_run=options['dry_run'],
+        )
+        report = job.run()
+
+        prefix = "[dry run] would remove" if options['dry_run'] else "Removed"
+        for key, value in report.items():
+            if key in ('media_bytes_reclaimed', 'elapsed_seconds'):
+                continue
+            self.stdout.write(f"{prefix} {value} {key.replace('_', ' ')}")
+        self.stdout.write(self.style.SUCCESS(
+            f"Reclaimed {report['media_bytes_reclaimed'] / 1e6:.1f} MB of media "
+            f"in {report['elapsed_seconds']}s"
+        ))
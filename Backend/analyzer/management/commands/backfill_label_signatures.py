@@ -0,0 +1,52 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from analyzer.models import FoodAnalysis
+from analyzer.similarity import label_signature, normalize_label_text
+
+
+class Command(BaseCommand):
+    help = (
+        "Compute the MinHash label_signature of analyses stored without one (e.g. before "
+        "near-duplicate reuse existed), so their labels can be matched and reused."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help="Analyses loaded and saved together")
+        parser.add_argument('--all', action='store_true',
+                            help="Recompute every signature, e.g. after changing the MinHash parameters")
+        parser.add_argument('--dry-run', action='store_true', help="Only count the analyses to update")
+
+    def handle(self, *args, **options):
+        queryset = FoodAnalysis.objects.exclude(extracted_text='')
+        if not options['all']:
+            queryset = queryset.filter(label_signature__isnull=True)
+        ids = list(queryset.order_by('pk').values_list('id', flat=True))
+        if options['dry_run']:
+            self.stdout.write(f"[dry run] {len(ids)} analyses to sign")
+            return
+
+        signed = too_short = 0
+        batch_size = max(1, options['batch_size'])
+        for offset in range(0, len(ids), batch_size):
+            analyses = list(
+                FoodAnalysis.objects.filter(id__in=ids[offset:offset + batch_size])
+                .only('id', 'extracted_text', 'ingredients_text', 'nutrition_text', 'label_signature')
+            )
+            for analysis in analyses:
+                signature = label_signature(normalize_label_text(
+                    analysis.ingredients_text, analysis.nutrition_text, analysis.extracted_text
+                ))
+                analysis.label_signature = signature.tobytes() if signature is not None else None
+                if signature is None:
+                    too_short += 1
+                else:
+                    signed += 1
+            with transaction.atomic():
+                FoodAnalysis.objects.bulk_update(analyses, ['label_signature'])
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Signed {signed} analyses ({too_short} too short to match)"
+        ))
+        if signed:
+            # Running workers only pick up newly created rows
+            self.stdout.write("Restart the app server so its similarity index loads the new signatures")
@@ -0,0 +1,78 @@
+import statistics
+import time
+from django.core.management.base import BaseCommand, CommandError
+from analyzer.models import FoodAnalysis
+from analyzer.services import ANALYSIS_OUTPUT_MODES, get_food_analyzer_service
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare generated tokens and latency of the markdown and JSON analysis "
+        "output modes on stored labels. Nothing is saved."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--samples', type=int, default=5,
+                            help="Number of most recent analyzed labels to replay")
+        parser.add_argument('--repeat', type=int, default=1, help="Runs per label and mode")
+        parser.add_argument('--modes', nargs='+', choices=ANALYSIS_OUTPUT_MODES, default=list(ANALYSIS_OUTPUT_MODES))
+        parser.add_argument('--text-file', help="Benchmark this label text instead of stored analyses")
+
+    def handle(self, *args, **options):
+        service = get_food_analyzer_service()
+        labels = self._labels(service, options)
+        if not labels:
+            raise CommandError("No analyzed labels to benchmark; pass --text-file")
+
+        runs = {mode: [] for mode in options['modes']}
+        for round_number in range(options['repeat']):
+            for index, (extracted_text, ingredients, nutrition) in enumerate(labels, 1):
+                tags = service.tag_ingredients(extracted_text, ingredients)
+                # Alternate the order so neither mode always runs on a warm model
+                modes = options['modes'] if (index + round_number) % 2 else options['modes'][::-1]
+                for mode in modes:
+                    started = time.monotonic()
+                    result = service.analyze_food_label(extracted_text, ingredients, nutrition, tags, output_mode=mode)
+                    elapsed_ms = (time.monotonic() - started) * 1000
+                    if result['recommendation'] == 'ERROR':
+                        self.stderr.write(f"{mode} run failed on label {index}: {result['summary']}")
+                        continue
+                    runs[mode].append({
+                        'tokens': result['tokens'],
+                        'llm_ms': result['latency_ms'],
+                        'total_ms': elapsed_ms,
+                        'fell_back': result['output_mode'] != mode,
+                    })
+                    self.stdout.write(
+                        f"label {index} {mode:<8} {result['tokens'] or '?':>5} tokens "
+                        f"{elapsed_ms:8.0f} ms  {result['recommendation']} {result['health_score']}/10"
+                    )
+
+        self.stdout.write('')
+        self.stdout.write(f"{'mode':<10}{'runs':>6}{'fallbacks':>11}{'tokens p50':>12}"
+                          f"{'llm ms p50':>12}{'total ms p50':>14}{'total ms max':>14}")
+        for mode, results in runs.items():
+            if not results:
+                self.stdout.write(f"{mode:<10}{0:>6}")
+                continue
+            tokens = [r['tokens'] for r in results if r['tokens'] is not None]
+            self.stdout.write(
+                f"{mode:<10}{len(results):>6}{sum(r['fell_back'] for r in results):>11}"
+                f"{statistics.median(tokens) if tokens else '?':>12}"
+                f"{statistics.median(r['llm_ms'] for r in results):>12.0f}"
+                f"{statistics.median(r['total_ms'] for r in results):>14.0f}"
+                f"{max(r['total_ms'] for r in results):>14.0f}"
+            )
+
+    def _labels(self, service, options):
+        if options['text_file']:
+            with open(options['text_file'], encoding='utf-8') as f:
+                text = f.read()
+            return [(text, *service.process_extracted_text(text))]
+        analyses = (
+            FoodAnalysis.objects.filter(status='COMPLETE', reused_from__isnull=True)
+            .exclude(extracted_text='')
+            .order_by('-created_at')
+            .values_list('extracted_text', 'ingredients_text', 'nutrition_text')[:options['samples']]
+        )
+        return list(analyses)
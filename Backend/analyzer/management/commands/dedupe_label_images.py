@@ -0,0 +1,75 @@
+import os
+from django.conf import settings
+from django.core.files import File
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from analyzer.models import FoodAnalysis
+from analyzer.storage import get_label_image_store
+
+
+class Command(BaseCommand):
+    help = (
+        "Move legacy food_labels/food_label_<uuid>.<ext> uploads into the "
+        "content-addressed label image store, deduplicating identical images."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Report what would change without touching files or rows')
+        parser.add_argument('--delete-orphans', action='store_true',
+                            help='Also delete legacy files no analysis refers to')
+
+    def handle(self, *args, **options):
+        dry_run = options['dry_run']
+        store = get_label_image_store()
+        legacy_dir = os.path.join(settings.MEDIA_ROOT, 'food_labels')
+        if not os.path.isdir(legacy_dir):
+            self.stdout.write(f"No legacy directory at {legacy_dir}")
+            return
+
+        stats = {'files': 0, 'migrated': 0, 'orphans': 0, 'bytes_before': 0, 'bytes_after': 0}
+        seen_images = set()
+
+        for entry in sorted(os.scandir(legacy_dir), key=lambda e: e.name):
+            if not entry.is_file() or not entry.name.startswith('food_label_'):
+                continue
+            stats['files'] += 1
+            name = f"food_labels/{entry.name}"
+            analysis_ids = list(
+                FoodAnalysis.objects.filter(image=name).values_list('id', flat=True)
+            )
+
+            if not analysis_ids:
+                stats['orphans'] += 1
+                if options['delete_orphans'] and not dry_run:
+                    os.remove(entry.path)
+                continue
+
+            stats['migrated'] += 1
+            stats['bytes_before'] += entry.stat().st_size
+            if dry_run:
+                continue
+
+            with open(entry.path, 'rb') as fh, transaction.atomic():
+                label_image = store.store(File(fh, name=entry.name), references=len(analysis_ids))
+                FoodAnalysis.objects.filter(id__in=analysis_ids).update(
+                    label_image=label_image,
+                    image=label_image.ocr_name
+                )
+            if label_image.pk not in seen_images:
+                seen_images.add(label_image.pk)
+                stats['bytes_after'] += label_image.size + (
+                    label_image.derivative.size if label_image.derivative else 0
+                )
+            os.remove(entry.path)
+
+        prefix = "[dry run] " if dry_run else ""
+        self.stdout.write(
+            f"{prefix}{stats['files']} legacy files: {stats['migrated']} referenced, "
+            f"{stats['orphans']} orphaned"
+        )
+        if not dry_run:
+            self.stdout.write(self.style.SUCCESS(
+                f"Stored {len(seen_images)} unique images; "
+                f"{stats['bytes_before'] / 1e6:.1f} MB -> {stats['bytes_after'] / 1e6:.1f} MB"
+            ))
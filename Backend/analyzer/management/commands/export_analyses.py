@@ -0,0 +1,47 @@
+import sys
+from django.core.management.base import BaseCommand, CommandError
+from analyzer import exports
+
+
+class Command(BaseCommand):
+    help = (
+        "Stream analyses (or chats/messages) as NDJSON or CSV with constant memory, "
+        "optionally filtered by date range, recommendation and (for chats and messages) user."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dataset', choices=list(exports.DATASETS), default='analyses')
+        parser.add_argument('--format', choices=list(exports.FORMATS), default='ndjson')
+        parser.add_argument('--since', help="ISO date or datetime, inclusive")
+        parser.add_argument('--until', help="ISO date (inclusive) or datetime (exclusive)")
+        parser.add_argument('--recommendation', choices=['EAT', 'MODERATE', 'AVOID'])
+        parser.add_argument('--user', type=int, help="Only this user's chats or messages")
+        parser.add_argument('--chunk-size', type=int, help="Rows per database round trip")
+        parser.add_argument('--output', '-o', help="File to write (default: stdout)")
+
+    def handle(self, *args, **options):
+        try:
+            fields, rows = exports.export_rows(
+                options['dataset'],
+                since=exports.parse_bound(options['since']),
+                until=exports.parse_bound(options['until'], end=True),
+                recommendation=options['recommendation'],
+                user=options['user'],
+                chunk_size=options['chunk_size'],
+            )
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        output = open(options['output'], 'w', encoding='utf-8', newline='') if options['output'] else sys.stdout
+        count = 0
+        try:
+            for line in exports.iter_export(fields, rows, options['format']):
+                output.write(line)
+                count += 1
+        finally:
+            if output is not sys.stdout:
+                output.close()
+        if options['format'] == 'csv':
+            count -= 1  # Header
+        if options['output']:
+            self.stdout.write(self.style.SUCCESS(f"Exported {count} {options['dataset']} to {options['output']}"))
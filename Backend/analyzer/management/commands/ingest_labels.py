@@ -0,0 +1,297 @@
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import numpy as np
+from django.conf import settings
+from django.core.files import File
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+from analyzer import search
+from analyzer.models import FoodAnalysis, LabelImage
+from analyzer.ocr_pool import get_ocr_pool, ocr_label
+from analyzer.services import get_food_analyzer_service
+from analyzer.similarity import REUSABLE, find_similar_analysis, remember_analysis
+from analyzer.storage import get_label_image_store
+
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.webp', '.bmp', '.gif', '.tif', '.tiff'}
+CHECKPOINT_NAME = '.ingest_checkpoint'
+
+
+class Command(BaseCommand):
+    help = (
+        "Analyze every label image in a directory: OCR on a process pool, the LLM "
+        "with bounded concurrency, rows written in bulk. Resumable via a checkpoint file."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('directory', help="Directory to scan recursively for label images")
+        parser.add_argument('--ocr-workers', type=int, default=os.cpu_count() or 1)
+        parser.add_argument('--llm-concurrency', type=int, default=2,
+                            help="Analyses sent to Ollama at once")
+        parser.add_argument('--chunk-size', type=int, default=50, help="Rows per bulk insert")
+        parser.add_argument('--checkpoint', help=f"Progress file (default: <directory>/{CHECKPOINT_NAME})")
+        parser.add_argument('--restart', action='store_true', help="Ignore the checkpoint and start over")
+        parser.add_argument('--skip-llm', action='store_true',
+                            help="Store heuristic results only (status DEGRADED)")
+        parser.add_argument('--limit', type=int, help="Process at most this many new images")
+
+    def handle(self, *args, **options):
+        directory = os.path.abspath(options['directory'])
+        if not os.path.isdir(directory):
+            raise CommandError(f"Not a directory: {directory}")
+        self.options = options
+        self.directory = directory
+        self.checkpoint = options['checkpoint'] or os.path.join(directory, CHECKPOINT_NAME)
+        self.service = get_food_analyzer_service()
+        self.store = get_label_image_store()
+        self.use_cache = getattr(settings, 'NEAR_DUPLICATE_CACHE', True)
+
+        done = set() if options['restart'] else self._read_checkpoint()
+        todo = [path for path in self._scan(directory) if os.path.relpath(path, directory) not in done]
+        stored = self._already_stored(todo)
+        if stored:
+            todo = [path for path in todo if path not in stored]
+            self.stdout.write(
+                f"Skipping {len(stored)} images already in the media store "
+                f"(run dedupe_label_images to move legacy uploads into the label store)"
+            )
+        if options['limit']:
+            todo = todo[:options['limit']]
+        self.stdout.write(f"{len(todo)} images to ingest ({len(done)} already done per {self.checkpoint})")
+        if not todo:
+            return
+
+        self.stats = {'failed': 0, 'reused': 0, 'analyzed': 0, 'degraded': 0}
+        self.total = len(todo)
+        self.started = time.monotonic()
+        self.last_report = 0.0
+        self.buffer = []
+        # Label image id -> later copies of it in this run, waiting on the first one's result
+        self.copies = {}
+
+        ocr_workers = max(1, options['ocr_workers'])
+        with get_ocr_pool(ocr_workers) as ocr_pool, \
+                ThreadPoolExecutor(max_workers=max(1, options['llm_concurrency']),
+                                   thread_name_prefix='ingest-llm') as llm_pool:
+            self._run(iter(todo), ocr_pool, ocr_workers, llm_pool)
+        self._flush()
+        self._report(final=True)
+
+    def _run(self, paths, ocr_pool, ocr_workers, llm_pool):
+        ocr_futures, llm_futures = {}, {}
+        exhausted = False
+        while True:
+            # Keep every OCR worker busy without racing far ahead of the LLM stage
+            while (not exhausted and len(ocr_futures) < ocr_workers * 2
+                   and len(llm_futures) < self.options['llm_concurrency'] * 4):
+                path = next(paths, None)
+                if path is None:
+                    exhausted = True
+                    break
+                item = self._store(path)
+                if item is None:
+                    continue
+                if item['label_image'].pk in self.copies:
+                    # The same file is already being analyzed; share its result
+                    self.copies[item['label_image'].pk].append(item)
+                    continue
+                self.copies[item['label_image'].pk] = []
+                ocr_futures[ocr_pool.submit(ocr_label, self.store.path(item['label_image'].ocr_name))] = item
+
+            if not ocr_futures and not llm_futures:
+                return
+            finished, _ = wait([*ocr_futures, *llm_futures], return_when=FIRST_COMPLETED)
+            for future in finished:
+                if future in ocr_futures:
+                    self._after_ocr(ocr_futures.pop(future), future, llm_pool, llm_futures)
+                else:
+                    item = llm_futures.pop(future)
+                    self._after_llm(item, future)
+            if len(self.buffer) >= self.options['chunk_size']:
+                self._flush()
+            self._report()
+
+    def _store(self, path):
+        """Put the image in the label store; references are taken when its row is written"""
+        try:
+            with open(path, 'rb') as fh:
+                label_image = self.store.store(File(fh, name=os.path.basename(path)), references=0)
+            return {'path': path, 'label_image': label_image}
+        except Exception as e:
+            self._fail(path, e)
+            return None
+
+    def _already_stored(self, paths):
+        """Paths under MEDIA_ROOT that an analysis or the label store already refers to"""
+        media_root = os.path.abspath(settings.MEDIA_ROOT)
+        names = {
+            os.path.relpath(path, media_root).replace(os.sep, '/'): path
+            for path in paths if os.path.commonpath([media_root, path]) == media_root
+        }
+        keys = list(names)
+        referenced = set()
+        for offset in range(0, len(keys), 500):
+            chunk = keys[offset:offset + 500]
+            referenced.update(FoodAnalysis.objects.filter(image__in=chunk).values_list('image', flat=True))
+            for file_name, derivative_name in LabelImage.objects.filter(
+                Q(file__in=chunk) | Q(derivative__in=chunk)
+            ).values_list('file', 'derivative'):
+                referenced.update((file_name, derivative_name))
+        return {names[name] for name in referenced if name in names}
+
+    def _after_ocr(self, item, future, llm_pool, llm_futures):
+        try:
+            result = future.result()
+        except Exception as e:
+            self._fail_with_copies(item, e)
+            return
+        if 'error' in result:
+            self._fail_with_copies(item, result['error'])
+            return
+        item.update(result)
+
+        if self.use_cache:
+            source = FoodAnalysis.objects.filter(
+                REUSABLE, label_image=item['label_image']
+            ).order_by('-created_at').first()
+            reuse = (source, 1.0) if source else None
+            if reuse is None and item['label_signature']:
+                reuse = find_similar_analysis(self._signature(item))
+            if reuse is not None:
+                source = reuse[0]
+                self.stats['reused'] += 1
+                self._buffer(item, {
+                    **self.service._parse_analysis_result(source.analysis_result),
+                    'model': source.llm_model or None,
+                    'latency_ms': None,
+                    'prompt_version': source.prompt_version,
+                }, 'COMPLETE', reused_from=source)
+                return
+
+        if self.options['skip_llm']:
+            self._buffer(item, self._heuristic(item), 'DEGRADED')
+            return
+        llm_futures[llm_pool.submit(
+            self.service.analyze_food_label,
+            item['extracted_text'], item['ingredients_text'], item['nutrition_text'], item['ingredient_tags']
+        )] = item
+
+    def _after_llm(self, item, future):
+        try:
+            result = future.result()
+        except Exception as e:
+            result = {'recommendation': 'ERROR', 'summary': str(e)}
+        if result['recommendation'] == 'ERROR':
+            # Keep the image usable; a later re-analysis can replace the estimate
+            self.stderr.write(f"LLM failed for {item['path']}: {result['summary']}")
+            self._buffer(item, self._heuristic(item), 'DEGRADED')
+        else:
+            self.stats['analyzed'] += 1
+            self._buffer(item, result, 'COMPLETE')
+
+    def _heuristic(self, item):
+        self.stats['degraded'] += 1
+        return self.service.heuristic_assessment(
+            item['ingredients_text'], item['nutrition_text'], item['ingredient_tags']
+        )
+
+    def _signature(self, item):
+        return np.frombuffer(item['label_signature'], dtype=np.uint32)
+
+    def _buffer(self, item, result, status, reused_from=None):
+        analysis = FoodAnalysis(
+            label_image=item['label_image'],
+            image=item['label_image'].ocr_name,
+            extracted_text=item['extracted_text'],
+            ocr_confidence=item['ocr_confidence'],
+            ocr_version=item['ocr_version'],
+            ingredients_text=item['ingredients_text'],
+            nutrition_text=item['nutrition_text'],
+            ingredient_tags=item['ingredient_tags'],
+            analysis_result=result['raw_response'],
+            recommendation=result['recommendation'],
+            health_score=result['health_score'],
+            llm_model=result['model'] or '',
+            llm_latency_ms=result['latency_ms'],
+            prompt_version=result.get('prompt_version', ''),
+            status=status,
+            label_signature=item['label_signature'],
+            reused_from=reused_from,
+            created_at=timezone.now(),
+        )
+        self.buffer.append((item, analysis))
+        # Copies follow the original, so a later re-analysis updates them along with it
+        for copy in self.copies.pop(item['label_image'].pk, ()):
+            self.stats['reused' if status == 'COMPLETE' else 'degraded'] += 1
+            self._buffer({**item, 'path': copy['path']}, result, status, reused_from=reused_from or analysis)
+
+    def _flush(self):
+        """Write buffered analyses in one transaction, then checkpoint them"""
+        if not self.buffer:
+            return
+        batch, self.buffer = self.buffer, []
+        analyses = [analysis for _, analysis in batch]
+        references = {}
+        for analysis in analyses:
+            references[analysis.label_image_id] = references.get(analysis.label_image_id, 0) + 1
+
+        with transaction.atomic():
+            FoodAnalysis.objects.bulk_create(analyses)
+            for label_image_id, count in references.items():
+                LabelImage.objects.filter(pk=label_image_id).update(ref_count=F('ref_count') + count)
+            # bulk_create sends no post_save, so index explicitly
+            search.index_analyses(analyses)
+        for analysis in analyses:
+            remember_analysis(analysis)
+
+        with open(self.checkpoint, 'a', encoding='utf-8') as f:
+            f.writelines(f"{os.path.relpath(item['path'], self.directory)}\n" for item, _ in batch)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _fail_with_copies(self, item, error):
+        self._fail(item['path'], error)
+        for copy in self.copies.pop(item['label_image'].pk, ()):
+            self._fail(copy['path'], error)
+
+    def _fail(self, path, error):
+        self.stats['failed'] += 1
+        self.stderr.write(f"Skipped {path}: {error}")
+
+    def _report(self, final=False):
+        now = time.monotonic()
+        if not final and now - self.last_report < 5:
+            return
+        self.last_report = now
+        stats = self.stats
+        finished = stats['analyzed'] + stats['reused'] + stats['degraded'] + stats['failed']
+        elapsed = now - self.started
+        rate = finished / elapsed if elapsed else 0
+        eta = (self.total - finished) / rate if rate else float('inf')
+        line = (
+            f"{finished}/{self.total} done ({stats['analyzed']} analyzed, {stats['reused']} reused, "
+            f"{stats['degraded']} degraded, {stats['failed']} failed) "
+            f"{rate * 60:.1f}/min, elapsed {elapsed:.0f}s"
+        )
+        if final:
+            self.stdout.write(self.style.SUCCESS(line))
+        else:
+            self.stdout.write(f"{line}, ETA {eta:.0f}s" if rate else line)
+
+    def _read_checkpoint(self):
+        if not os.path.exists(self.checkpoint):
+            return set()
+        with open(self.checkpoint, encoding='utf-8') as f:
+            return {line.rstrip('\n') for line in f if line.strip()}
+
+    def _scan(self, directory):
+        paths = []
+        for root, dirs, files in os.walk(directory):
+            dirs.sort()
+            paths.extend(
+                os.path.join(root, name) for name in sorted(files)
+                if os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS
+            )
+        return paths
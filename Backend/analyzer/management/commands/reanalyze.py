@@ -0,0 +1,266 @@
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Q
+from analyzer import search
+from analyzer.models import FoodAnalysis
+from analyzer.services import get_food_analyzer_service
+from analyzer.similarity import forget_analysis, label_signature, normalize_label_text, remember_analysis
+from analyzer.storage import get_label_image_store
+
+STAGES = ('ocr', 'llm')
+CHECKPOINT_NAME = '.reanalyze_checkpoint'
+RESULT_FIELDS = ['analysis_result', 'recommendation', 'health_score', 'llm_model', 'prompt_version']
+OCR_FIELDS = ['extracted_text', 'ocr_confidence', 'ocr_version', 'ingredients_text', 'nutrition_text', 'label_signature']
+
+
+class Command(BaseCommand):
+    help = (
+        "Re-run the stages of stored analyses whose version is stale: the LLM when the "
+        "prompt or analysis model changed (reusing the stored OCR text), and OCR when "
+        "asked to and the OCR engine or settings changed. Results from the configured "
+        "downgrade model or the JSON mode's markdown fallback count as current. "
+        "Resumable via a checkpoint file."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--stages', nargs='+', choices=STAGES, default=['llm'],
+                            help="Stages to refresh (default: llm; OCR is only re-run when listed)")
+        parser.add_argument('--batch-size', type=int, default=50, help="Analyses loaded and saved together")
+        parser.add_argument('--llm-concurrency', type=int, default=2, help="Analyses sent to Ollama at once")
+        parser.add_argument('--ocr-workers', type=int, default=2, help="Images OCR'd at once")
+        parser.add_argument('--checkpoint', help=f"Progress file (default: <BASE_DIR>/{CHECKPOINT_NAME})")
+        parser.add_argument('--restart', action='store_true', help="Ignore the checkpoint and start over")
+        parser.add_argument('--limit', type=int, help="Process at most this many analyses")
+        parser.add_argument('--dry-run', action='store_true',
+                            help="Only report what is stale and estimate the LLM calls and time needed")
+
+    def handle(self, *args, **options):
+        self.options = options
+        self.service = get_food_analyzer_service()
+        self.stages = set(options['stages'])
+        self.target = {
+            'prompt_version': self.service.prompt_version(),
+            'llm_model': self.service.router.choose('analysis'),
+        }
+        # What a fresh analysis may legitimately record: a downgrade or a fallback is not stale
+        self.current = {
+            'prompt_version': self.service.current_prompt_versions(),
+            'llm_model': self.service.router.serving_models('analysis'),
+        }
+        if 'ocr' in self.stages:
+            try:
+                self.target['ocr_version'] = self.service.ocr.version
+            except Exception as e:
+                raise CommandError(f"Could not determine the OCR version: {e}")
+        self.stdout.write("Target: " + ", ".join(f"{key}={value}" for key, value in self.target.items()))
+
+        if options['dry_run']:
+            self._estimate()
+            return
+
+        self.checkpoint = options['checkpoint'] or os.path.join(settings.BASE_DIR, CHECKPOINT_NAME)
+        done = None if options['restart'] else self._read_checkpoint()
+        if done is None:
+            done = set()
+            self._start_checkpoint()
+        todo = [
+            str(analysis_id) for analysis_id in
+            self._stale().order_by('created_at', 'pk').values_list('id', flat=True).iterator()
+            if str(analysis_id) not in done
+        ]
+        if options['limit']:
+            todo = todo[:options['limit']]
+        self.stdout.write(f"{len(todo)} analyses to refresh ({len(done)} already done per {self.checkpoint})")
+        if not todo:
+            return
+
+        self.stats = {'ocr': 0, 'analyzed': 0, 'copies': 0, 'failed': 0}
+        self.store = get_label_image_store()
+        started = time.monotonic()
+        batch_size = max(1, options['batch_size'])
+        with ThreadPoolExecutor(max_workers=max(1, options['ocr_workers']),
+                                thread_name_prefix='reanalyze-ocr') as ocr_pool, \
+                ThreadPoolExecutor(max_workers=max(1, options['llm_concurrency']),
+                                   thread_name_prefix='reanalyze-llm') as llm_pool:
+            for offset in range(0, len(todo), batch_size):
+                batch = todo[offset:offset + batch_size]
+                self._run_batch(batch, ocr_pool, llm_pool)
+                self._write_checkpoint(batch)
+                elapsed = time.monotonic() - started
+                finished = offset + len(batch)
+                eta = elapsed / finished * (len(todo) - finished)
+                self.stdout.write(f"{finished}/{len(todo)} done, elapsed {elapsed:.0f}s, ETA {eta:.0f}s")
+
+        stats = self.stats
+        self.stdout.write(self.style.SUCCESS(
+            f"Re-OCR'd {stats['ocr']}, re-analyzed {stats['analyzed']} (+{stats['copies']} reused copies updated), "
+            f"{stats['failed']} failed"
+        ))
+
+    def _sources(self):
+        # Copies of another analysis follow their source; processing and pending ones are still being written
+        return FoodAnalysis.objects.filter(reused_from__isnull=True).exclude(status__in=('PROCESSING', 'PENDING'))
+
+    def _ocr_stale(self):
+        if 'ocr' not in self.stages:
+            return Q(pk__in=[])
+        return ~Q(ocr_version=self.target['ocr_version']) & (Q(label_image__isnull=False) | Q(image__gt=''))
+
+    def _llm_stale(self):
+        if 'llm' not in self.stages:
+            return Q(pk__in=[])
+        return (
+            ~Q(extracted_text='')
+            & (Q(status='DEGRADED') | ~Q(prompt_version__in=self.current['prompt_version'])
+               | ~Q(llm_model__in=self.current['llm_model']))
+        )
+
+    def _stale(self):
+        return self._sources().filter(self._ocr_stale() | self._llm_stale())
+
+    def _estimate(self):
+        """Report stale counts and the LLM time they need, from the median stored latency"""
+        sources = self._sources()
+        ocr_stale = sources.filter(self._ocr_stale()).count() if 'ocr' in self.stages else 0
+        llm_stale = sources.filter(self._llm_stale()).count() if 'llm' in self.stages else 0
+        # Re-OCR'd text is re-analyzed too, so count every stale row when both stages run
+        calls = self._stale().count() if self.stages == set(STAGES) else llm_stale
+        copies = FoodAnalysis.objects.filter(reused_from__in=self._stale()).count()
+
+        latencies = FoodAnalysis.objects.filter(status='COMPLETE', llm_latency_ms__isnull=False)
+        count = latencies.count()
+        median_ms = (
+            latencies.order_by('llm_latency_ms').values_list('llm_latency_ms', flat=True)[count // 2]
+            if count else None
+        )
+        if 'ocr' in self.stages:
+            self.stdout.write(f"OCR stale: {ocr_stale}")
+        if 'llm' in self.stages:
+            self.stdout.write(f"LLM stale: {llm_stale}")
+        self.stdout.write(f"LLM calls needed: {calls} ({copies} reused copies would be updated without a call)")
+        if median_ms is None:
+            self.stdout.write("No stored LLM latencies to estimate the duration from")
+            return
+        concurrency = max(1, self.options['llm_concurrency'])
+        seconds = calls * median_ms / 1000 / concurrency
+        self.stdout.write(
+            f"Estimated LLM time: {seconds:.0f}s (~{seconds / 60:.1f} min) at median {median_ms} ms per call "
+            f"and --llm-concurrency {concurrency}"
+        )
+
+    def _run_batch(self, batch, ocr_pool, llm_pool):
+        analyses = list(FoodAnalysis.objects.filter(id__in=batch).select_related('label_image'))
+        ocr_updated = []
+        if 'ocr' in self.stages:
+            stale = [analysis for analysis in analyses if analysis.ocr_version != self.target['ocr_version']]
+            for analysis, changed in zip(stale, ocr_pool.map(self._reocr, stale)):
+                if changed is None:
+                    self.stats['failed'] += 1
+                else:
+                    self.stats['ocr'] += 1
+                    ocr_updated.append(analysis)
+                    if changed:
+                        # New text needs a new verdict whatever its prompt version
+                        analysis.prompt_version = ''
+
+        to_analyze = [
+            analysis for analysis in analyses
+            if 'llm' in self.stages and analysis.extracted_text and (
+                analysis.status == 'DEGRADED'
+                or analysis.prompt_version not in self.current['prompt_version']
+                or analysis.llm_model not in self.current['llm_model']
+            )
+        ]
+        for analysis in to_analyze:
+            # Cheap, and picks up knowledge base changes along with the prompt
+            analysis.ingredient_tags = self.service.tag_ingredients(analysis.extracted_text, analysis.ingredients_text)
+        results = llm_pool.map(
+            lambda analysis: self.service.analyze_food_label(
+                analysis.extracted_text, analysis.ingredients_text, analysis.nutrition_text, analysis.ingredient_tags
+            ),
+            to_analyze,
+        )
+        analyzed = []
+        for analysis, result in zip(to_analyze, results):
+            if result['recommendation'] == 'ERROR':
+                self.stats['failed'] += 1
+                self.stderr.write(f"LLM failed for {analysis.id}: {result['summary']}")
+                continue
+            analysis.analysis_result = result['raw_response']
+            analysis.recommendation = result['recommendation']
+            analysis.health_score = result['health_score']
+            analysis.llm_model = result['model'] or ''
+            analysis.llm_latency_ms = result['latency_ms']
+            analysis.prompt_version = result['prompt_version']
+            analysis.status = 'COMPLETE'
+            analyzed.append(analysis)
+        self.stats['analyzed'] += len(analyzed)
+
+        with transaction.atomic():
+            if ocr_updated:
+                FoodAnalysis.objects.bulk_update(ocr_updated, OCR_FIELDS + ['prompt_version'])
+            if analyzed:
+                FoodAnalysis.objects.bulk_update(
+                    analyzed, RESULT_FIELDS + ['llm_latency_ms', 'status', 'ingredient_tags']
+                )
+            for analysis in analyzed:
+                self.stats['copies'] += FoodAnalysis.objects.filter(reused_from=analysis).update(
+                    status='COMPLETE', **{field: getattr(analysis, field) for field in RESULT_FIELDS}
+                )
+            for analysis in ocr_updated:
+                search.index_analysis(analysis)
+
+        for analysis in ocr_updated:
+            forget_analysis(analysis.id)
+        for analysis in {analysis.id: analysis for analysis in ocr_updated + analyzed}.values():
+            remember_analysis(analysis)
+
+    def _reocr(self, analysis):
+        """OCR the stored image again; returns whether the text changed, or None on failure"""
+        name = analysis.label_image.ocr_name if analysis.label_image else analysis.image.name
+        path = self.store.path(name)
+        if not os.path.exists(path):
+            self.stderr.write(f"Image missing for {analysis.id}: {path}")
+            return None
+        text, confidence = self.service.extract_text_with_confidence(path)
+        if text.startswith("Error"):
+            self.stderr.write(f"OCR failed for {analysis.id}: {text}")
+            return None
+        changed = text != analysis.extracted_text
+        analysis.extracted_text = text
+        analysis.ocr_confidence = confidence
+        analysis.ocr_version = self.target['ocr_version']
+        if changed:
+            analysis.ingredients_text, analysis.nutrition_text = self.service.process_extracted_text(text)
+            signature = label_signature(
+                normalize_label_text(analysis.ingredients_text, analysis.nutrition_text, text)
+            )
+            analysis.label_signature = signature.tobytes() if signature is not None else None
+        return changed
+
+    def _read_checkpoint(self):
+        """Analysis ids already handled for the current target, or None to start a new checkpoint"""
+        if not os.path.exists(self.checkpoint):
+            return None
+        with open(self.checkpoint, encoding='utf-8') as f:
+            if f.readline().rstrip('\n') != self._checkpoint_header():
+                return None  # Written for other versions: everything is worth retrying
+            return {line.rstrip('\n') for line in f if line.strip()}
+
+    def _start_checkpoint(self):
+        with open(self.checkpoint, 'w', encoding='utf-8') as f:
+            f.write(self._checkpoint_header() + '\n')
+
+    def _write_checkpoint(self, batch):
+        # Failed ids are recorded too, so a resumed run doesn't keep retrying them
+        with open(self.checkpoint, 'a', encoding='utf-8') as f:
+            f.writelines(f"{analysis_id}\n" for analysis_id in batch)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _checkpoint_header(self):
+        return ' '.join(f"{key}={value}" for key, value in sorted(self.target.items()))
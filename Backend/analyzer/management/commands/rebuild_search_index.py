@@ -0,0 +1,69 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from analyzer.models import FoodAnalysis, Message, SearchDocument
+
+
+class Command(BaseCommand):
+    help = "Rebuild the full-text search index from all analyses and chat messages."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        chunk_size = options['chunk_size']
+        SearchDocument.objects.all().delete()
+
+        analyses = (
+            FoodAnalysis.objects.exclude(extracted_text='')
+            .only('id', 'extracted_text', 'ingredients_text', 'created_at')
+            .iterator(chunk_size=chunk_size)
+        )
+        count = self._bulk_index(
+            (
+                SearchDocument(
+                    kind='analysis',
+                    object_id=str(analysis.id),
+                    title=(analysis.ingredients_text or '')[:255],
+                    body=analysis.extracted_text,
+                    created_at=analysis.created_at,
+                )
+                for analysis in analyses
+            ),
+            chunk_size
+        )
+        self.stdout.write(f"Indexed {count} analyses")
+
+        messages = Message.objects.select_related('chat').iterator(chunk_size=chunk_size)
+        count = self._bulk_index(
+            (
+                SearchDocument(
+                    kind='message',
+                    object_id=str(message.id),
+                    user_id=message.chat.user_id,
+                    chat_id=message.chat_id,
+                    title=message.chat.title[:255],
+                    body=message.content,
+                    created_at=message.created_at,
+                )
+                for message in messages
+            ),
+            chunk_size
+        )
+        self.stdout.write(self.style.SUCCESS(f"Indexed {count} messages"))
+
+    def _bulk_index(self, documents, chunk_size):
+        count = 0
+        batch = []
+        for document in documents:
+            batch.append(document)
+            if len(batch) >= chunk_size:
+                count += self._flush(batch)
+                batch = []
+        if batch:
+            count += self._flush(batch)
+        return count
+
+    def _flush(self, batch):
+        with transaction.atomic():
+            SearchDocument.objects.bulk_create(batch)
+        return len(batch)
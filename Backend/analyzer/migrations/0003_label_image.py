@@ -0,0 +1,38 @@
+# Generated by Django 4.2.7 on 2026-10-19 08:42
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analyzer', '0002_chat_message'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LabelImage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('sha256', models.CharField(max_length=64, unique=True)),
+                ('file', models.ImageField(max_length=255, upload_to='food_labels/')),
+                ('derivative', models.ImageField(blank=True, max_length=255, upload_to='food_labels/')),
+                ('content_type', models.CharField(blank=True, max_length=50)),
+                ('size', models.PositiveIntegerField(default=0)),
+                ('ref_count', models.PositiveIntegerField(default=0)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+        ),
+        migrations.AlterField(
+            model_name='foodanalysis',
+            name='image',
+            field=models.ImageField(blank=True, max_length=255, null=True, upload_to='food_labels/'),
+        ),
+        migrations.AddField(
+            model_name='foodanalysis',
+            name='label_image',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='analyses', to='analyzer.labelimage'),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 4.2.7 on 2026-10-19 08:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analyzer', '0003_label_image'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='foodanalysis',
+            name='llm_latency_ms',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='foodanalysis',
+            name='llm_model',
+            field=models.CharField(blank=True, max_length=100),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='llm_latency_ms',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='llm_model',
+            field=models.CharField(blank=True, max_length=100),
+        ),
+    ]
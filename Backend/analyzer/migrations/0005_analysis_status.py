@@ -0,0 +1,18 @@
+# Generated by Django 4.2.7 on 2026-10-19 08:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analyzer', '0004_llm_model_tags'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='foodanalysis',
+            name='status',
+            field=models.CharField(choices=[('COMPLETE', 'Complete'), ('DEGRADED', 'Degraded'), ('PENDING', 'Pending')], default='COMPLETE', max_length=10),
+        ),
+    ]
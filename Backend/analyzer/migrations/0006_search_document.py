@@ -0,0 +1,99 @@
+# Generated by Django 4.2.7 on 2026-10-19 08:51
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+POSTGRES_FORWARD = [
+    """
+    ALTER TABLE analyzer_searchdocument ADD COLUMN search_vector tsvector
+    GENERATED ALWAYS AS (
+        setweight(to_tsvector('english', coalesce(title, '')), 'A') ||
+        setweight(to_tsvector('english', coalesce(body, '')), 'B')
+    ) STORED
+    """,
+    "CREATE INDEX analyzer_searchdocument_vector_gin ON analyzer_searchdocument USING gin (search_vector)",
+]
+
+POSTGRES_BACKWARD = [
+    "DROP INDEX IF EXISTS analyzer_searchdocument_vector_gin",
+    "ALTER TABLE analyzer_searchdocument DROP COLUMN IF EXISTS search_vector",
+]
+
+SQLITE_FORWARD = [
+    """
+    CREATE VIRTUAL TABLE analyzer_searchdocument_fts USING fts5(
+        title, body,
+        content='analyzer_searchdocument', content_rowid='id',
+        tokenize='porter unicode61'
+    )
+    """,
+    """
+    CREATE TRIGGER analyzer_searchdocument_ai AFTER INSERT ON analyzer_searchdocument BEGIN
+        INSERT INTO analyzer_searchdocument_fts(rowid, title, body) VALUES (new.id, new.title, new.body);
+    END
+    """,
+    """
+    CREATE TRIGGER analyzer_searchdocument_ad AFTER DELETE ON analyzer_searchdocument BEGIN
+        INSERT INTO analyzer_searchdocument_fts(analyzer_searchdocument_fts, rowid, title, body)
+        VALUES ('delete', old.id, old.title, old.body);
+    END
+    """,
+    """
+    CREATE TRIGGER analyzer_searchdocument_au AFTER UPDATE ON analyzer_searchdocument BEGIN
+        INSERT INTO analyzer_searchdocument_fts(analyzer_searchdocument_fts, rowid, title, body)
+        VALUES ('delete', old.id, old.title, old.body);
+        INSERT INTO analyzer_searchdocument_fts(rowid, title, body) VALUES (new.id, new.title, new.body);
+    END
+    """,
+]
+
+SQLITE_BACKWARD = [
+    "DROP TRIGGER IF EXISTS analyzer_searchdocument_au",
+    "DROP TRIGGER IF EXISTS analyzer_searchdocument_ad",
+    "DROP TRIGGER IF EXISTS analyzer_searchdocument_ai",
+    "DROP TABLE IF EXISTS analyzer_searchdocument_fts",
+]
+
+
+def _run(schema_editor, statements):
+    for statement in statements.get(schema_editor.connection.vendor, []):
+        schema_editor.execute(statement)
+
+
+def create_fulltext_index(apps, schema_editor):
+    _run(schema_editor, {'postgresql': POSTGRES_FORWARD, 'sqlite': SQLITE_FORWARD})
+
+
+def drop_fulltext_index(apps, schema_editor):
+    _run(schema_editor, {'postgresql': POSTGRES_BACKWARD, 'sqlite': SQLITE_BACKWARD})
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('analyzer', '0005_analysis_status'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SearchDocument',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('analysis', 'Analysis'), ('message', 'Message')], max_length=10)),
+                ('object_id', models.CharField(max_length=64)),
+                ('title', models.CharField(blank=True, max_length=255)),
+                ('body', models.TextField(blank=True)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('chat', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='analyzer.chat')),
+                ('user', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'unique_together': {('kind', 'object_id')},
+            },
+        ),
+        migrations.RunPython(create_fulltext_index, drop_fulltext_index),
+    ]
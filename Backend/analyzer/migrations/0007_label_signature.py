@@ -0,0 +1,24 @@
+# Generated by Django 4.2.7 on 2026-10-19 08:53
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analyzer', '0006_search_document'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='foodanalysis',
+            name='label_signature',
+            field=models.BinaryField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='foodanalysis',
+            name='reused_from',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='reuses', to='analyzer.foodanalysis'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.7 on 2026-10-19 08:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analyzer', '0007_label_signature'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='foodanalysis',
+            name='ingredient_tags',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.7 on 2026-10-19 09:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analyzer', '0008_ingredient_tags'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='foodanalysis',
+            name='ocr_confidence',
+            field=models.FloatField(blank=True, null=True),
+        ),
+    ]
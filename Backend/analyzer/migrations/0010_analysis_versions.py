@@ -0,0 +1,23 @@
+# Generated by Django 4.2.7 on 2026-10-19 09:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analyzer', '0009_ocr_confidence'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='foodanalysis',
+            name='ocr_version',
+            field=models.CharField(blank=True, max_length=64),
+        ),
+        migrations.AddField(
+            model_name='foodanalysis',
+            name='prompt_version',
+            field=models.CharField(blank=True, max_length=64),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 4.2.7 on 2026-10-19 09:41
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analyzer', '0010_analysis_versions'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='foodanalysis',
+            name='session',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='analyses', to='analyzer.analysissession'),
+        ),
+    ]
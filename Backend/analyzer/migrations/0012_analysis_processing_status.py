@@ -0,0 +1,28 @@
+# Generated by Django 4.2.7 on 2026-10-19 09:42
+
+from django.db import migrations, models
+from django.db.models import Q
+
+
+def degrade_unfinished_results(apps, schema_editor):
+    """Rows saved COMPLETE without a usable result (failed OCR or LLM) are DEGRADED"""
+    FoodAnalysis = apps.get_model('analyzer', 'FoodAnalysis')
+    FoodAnalysis.objects.filter(
+        Q(analysis_result='') | Q(analysis_result__startswith='Error'), status='COMPLETE'
+    ).update(status='DEGRADED')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analyzer', '0011_analysis_session'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='foodanalysis',
+            name='status',
+            field=models.CharField(choices=[('PROCESSING', 'Processing'), ('COMPLETE', 'Complete'), ('DEGRADED', 'Degraded'), ('PENDING', 'Pending')], default='PROCESSING', max_length=10),
+        ),
+        migrations.RunPython(degrade_unfinished_results, migrations.RunPython.noop),
+    ]
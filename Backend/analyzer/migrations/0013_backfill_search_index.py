@@ -0,0 +1,74 @@
+from django.db import migrations
+
+CHUNK_SIZE = 500
+
+
+def _chunks(iterable):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= CHUNK_SIZE:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _missing(SearchDocument, kind, objects):
+    """Objects of a chunk that have no search entry yet (e.g. after rebuild_search_index)"""
+    indexed = set(
+        SearchDocument.objects.filter(kind=kind, object_id__in=[str(obj.id) for obj in objects])
+        .values_list('object_id', flat=True)
+    )
+    return [obj for obj in objects if str(obj.id) not in indexed]
+
+
+def backfill_search_index(apps, schema_editor):
+    """Index analyses and messages written before 0006 added the search index"""
+    FoodAnalysis = apps.get_model('analyzer', 'FoodAnalysis')
+    Message = apps.get_model('analyzer', 'Message')
+    SearchDocument = apps.get_model('analyzer', 'SearchDocument')
+
+    analyses = (
+        FoodAnalysis.objects.exclude(extracted_text='')
+        .only('id', 'extracted_text', 'ingredients_text', 'created_at')
+        .order_by('pk').iterator(chunk_size=CHUNK_SIZE)
+    )
+    for batch in _chunks(analyses):
+        SearchDocument.objects.bulk_create([
+            SearchDocument(
+                kind='analysis',
+                object_id=str(analysis.id),
+                title=(analysis.ingredients_text or '')[:255],
+                body=analysis.extracted_text,
+                created_at=analysis.created_at,
+            )
+            for analysis in _missing(SearchDocument, 'analysis', batch)
+        ])
+
+    messages = Message.objects.select_related('chat').order_by('pk').iterator(chunk_size=CHUNK_SIZE)
+    for batch in _chunks(messages):
+        SearchDocument.objects.bulk_create([
+            SearchDocument(
+                kind='message',
+                object_id=str(message.id),
+                user_id=message.chat.user_id,
+                chat_id=message.chat_id,
+                title=message.chat.title[:255],
+                body=message.content,
+                created_at=message.created_at,
+            )
+            for message in _missing(SearchDocument, 'message', batch)
+        ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analyzer', '0012_analysis_processing_status'),
+    ]
+
+    operations = [
+        # Documents are kept current by signals from here on; unapplying leaves them
+        migrations.RunPython(backfill_search_index, migrations.RunPython.noop),
+    ]
@@ -3,6 +3,25 @@ from django.utils import timezone
 import uuid
 from django.contrib.auth.models import User
 
+class LabelImage(models.Model):
+    """Content-addressed, deduplicated store entry for an uploaded label image"""
+    
+    sha256 = models.CharField(max_length=64, unique=True)
+    file = models.ImageField(upload_to='food_labels/', max_length=255)
+    derivative = models.ImageField(upload_to='food_labels/', max_length=255, blank=True)
+    content_type = models.CharField(max_length=50, blank=True)
+    size = models.PositiveIntegerField(default=0)
+    ref_count = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(default=timezone.now)
+    
+    def __str__(self):
+        return f"LabelImage {self.sha256[:12]} ({self.ref_count} refs)"
+    
+    @property
+    def ocr_name(self):
+        """Storage name of the file OCR and display should use"""
+        return self.derivative.name if self.derivative else self.file.name
+
 class FoodAnalysis(models.Model):
     """Model to store food label analysis results"""
     
@@ -12,14 +31,32 @@ class FoodAnalysis(models.Model):
         ('MODERATE', 'Moderate'),
     ]
     
+    STATUS_CHOICES = [
+        ('PROCESSING', 'Processing'),  # OCR or the LLM still running
+        ('COMPLETE', 'Complete'),
+        ('DEGRADED', 'Degraded'),  # Heuristic or no result: OCR or the LLM failed or ran out of time
+        ('PENDING', 'Pending'),  # Heuristic result, LLM analysis finishing in background
+    ]
+    
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
-    image = models.ImageField(upload_to='food_labels/', null=True, blank=True)
+    image = models.ImageField(upload_to='food_labels/', max_length=255, null=True, blank=True)
+    label_image = models.ForeignKey(LabelImage, on_delete=models.PROTECT, null=True, blank=True, related_name='analyses')
     extracted_text = models.TextField(blank=True)
+    ocr_confidence = models.FloatField(null=True, blank=True)  # Mean OCR word confidence, 0-100
+    ocr_version = models.CharField(max_length=64, blank=True)  # Tesseract version and OCR settings
     ingredients_text = models.TextField(blank=True)
     nutrition_text = models.TextField(blank=True)
     analysis_result = models.TextField(blank=True)
     recommendation = models.CharField(max_length=10, choices=RECOMMENDATION_CHOICES, blank=True)
     health_score = models.IntegerField(null=True, blank=True)
+    llm_model = models.CharField(max_length=100, blank=True)
+    llm_latency_ms = models.PositiveIntegerField(null=True, blank=True)
+    prompt_version = models.CharField(max_length=64, blank=True)  # Analysis prompt the result came from
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='PROCESSING')
+    label_signature = models.BinaryField(null=True, blank=True)  # MinHash of the label text
+    reused_from = models.ForeignKey('self', on_delete=models.SET_NULL, null=True, blank=True, related_name='reuses')
+    session = models.ForeignKey('AnalysisSession', on_delete=models.SET_NULL, null=True, blank=True, related_name='analyses')
+    ingredient_tags = models.JSONField(default=dict, blank=True)  # Allergens/additives from the knowledge base
     created_at = models.DateTimeField(default=timezone.now)
     
     class Meta:
@@ -54,4 +91,33 @@ class Message(models.Model):
     role = models.CharField(max_length=10, choices=[('user', 'User'), ('llm', 'LLM')])
     content = models.TextField()
     image_url = models.URLField(blank=True, null=True)
+    llm_model = models.CharField(max_length=100, blank=True)
+    llm_latency_ms = models.PositiveIntegerField(null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
+
+class SearchDocument(models.Model):
+    """Full-text search index entry for an analysis or a chat message.
+
+    The database keeps the actual index: a generated `tsvector` column with a
+    GIN index on PostgreSQL, or an FTS5 table synced by triggers on SQLite
+    (see migration 0006).
+    """
+    
+    KIND_CHOICES = [
+        ('analysis', 'Analysis'),
+        ('message', 'Message'),
+    ]
+    
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES)
+    object_id = models.CharField(max_length=64)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, null=True, blank=True)
+    chat = models.ForeignKey(Chat, on_delete=models.CASCADE, null=True, blank=True)
+    title = models.CharField(max_length=255, blank=True)
+    body = models.TextField(blank=True)
+    created_at = models.DateTimeField(default=timezone.now)
+    
+    class Meta:
+        unique_together = [('kind', 'object_id')]
+    
+    def __str__(self):
+        return f"SearchDocument {self.kind}:{self.object_id}"
@@ -0,0 +1,331 @@
+import hashlib
+import logging
+import os
+import shlex
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from functools import cached_property
+import numpy as np
+import pytesseract
+from django.conf import settings
+from PIL import Image, ImageOps, ImageStat
+from .deadlines import DeadlineExceeded
+
+logger = logging.getLogger(__name__)
+
+# A block of text to OCR: (left, top, right, bottom) in full-resolution pixels
+# and the Tesseract page segmentation mode that suits it
+TextRegion = namedtuple('TextRegion', ['box', 'psm'])
+
+# Recognized text, its mean word confidence (0-100) and the Tesseract passes it took
+OCRResult = namedtuple('OCRResult', ['text', 'confidence', 'passes'])
+
+PSM_SINGLE_LINE = 7
+PSM_UNIFORM_BLOCK = 6  # Keeps table rows together across columns
+PSM_SINGLE_COLUMN = 4
+PSM_RAW_LINE = 13
+
+# Segmentation mode to retry a low-confidence region with
+ALTERNATE_PSM = {
+    PSM_SINGLE_LINE: PSM_RAW_LINE,
+    PSM_UNIFORM_BLOCK: PSM_SINGLE_COLUMN,
+    PSM_SINGLE_COLUMN: PSM_UNIFORM_BLOCK,
+}
+
+# Bump when a code change makes the same image read differently
+OCR_PIPELINE_VERSION = 3
+
+DEFAULT_CHAR_WHITELIST = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz()[]{},./:;%*+-=<>!@#$%^&*()_+|\\~` '
+
+EDGE_THRESHOLD = 32  # Grey-level step between neighbouring pixels that counts as an edge
+TABLE_ALIGNMENT = 0.85  # Share of text rows side-by-side blocks must have in common to be one table
+MAX_CUT_DEPTH = 12
+
+
+def _dilate(mask, size, axis):
+    """Binary dilation of `mask` by a centred window of `size` along one axis"""
+    if size <= 1:
+        return mask
+    before = size // 2
+    pad = [(0, 0), (0, 0)]
+    pad[axis] = (before + 1, size - 1 - before)
+    # Window sums from a running total: linear in the number of pixels
+    totals = np.cumsum(np.pad(mask, pad).astype(np.int32), axis=axis)
+    n = mask.shape[axis]
+    return (np.take(totals, np.arange(size, size + n), axis=axis)
+            - np.take(totals, np.arange(n), axis=axis)) > 0
+
+
+def _runs(profile):
+    """(start, end) index pairs of the True runs in a boolean profile"""
+    edges = np.diff(np.concatenate(([0], profile.astype(np.int8), [0])))
+    return list(zip(np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)))
+
+
+def _gaps(profile, min_gap):
+    """Interior runs of False at least `min_gap` long, as (start, end) pairs"""
+    runs = _runs(profile)
+    return [(end, start) for (_, end), (start, _) in zip(runs, runs[1:]) if start - end >= min_gap]
+
+
+def _split(length, gaps):
+    """Spans of [0, length) left between the gaps"""
+    bounds = [0] + [edge for gap in gaps for edge in gap] + [length]
+    return list(zip(bounds[::2], bounds[1::2]))
+
+
+def _aligned(left, right):
+    """Whether two row profiles mostly share their text rows"""
+    shared = np.count_nonzero(left & right)
+    return shared >= TABLE_ALIGNMENT * max(1, min(np.count_nonzero(left), np.count_nonzero(right)))
+
+
+def _group_columns(edges, spans):
+    """Merge neighbouring column spans whose text rows line up (columns of one table)"""
+    groups = [list(spans[0])]
+    profile = edges[:, spans[0][0]:spans[0][1]].any(axis=1)
+    for start, end in spans[1:]:
+        current = edges[:, start:end].any(axis=1)
+        if _aligned(profile, current):
+            groups[-1][1] = end
+        else:
+            groups.append([start, end])
+        profile = current
+    return [tuple(group) for group in groups]
+
+
+def detect_text_regions(gray, max_dimension=1000, min_row_gap=0.01, min_col_gap=0.03):
+    """Find text blocks in a greyscale image, in reading order.
+
+    Works on a downscaled copy: edges are found from grey-level steps,
+    smeared so characters merge into lines and lines into blocks, and the
+    result is split recursively along empty rows and columns (XY-cut).
+    Side-by-side blocks whose text rows line up are kept together as a
+    table, and solid blobs (product art) are dropped. Returns (left, top,
+    right, bottom, psm) tuples in the downscaled image's pixels, and the
+    scale factor back to the original.
+    """
+    scale = max(gray.size) / max_dimension if max(gray.size) > max_dimension else 1.0
+    if scale > 1:
+        gray = gray.resize((round(gray.width / scale), round(gray.height / scale)), Image.BILINEAR)
+    pixels = np.asarray(gray, dtype=np.int16)
+    height, width = pixels.shape
+
+    edges = np.zeros(pixels.shape, dtype=bool)
+    edges[:, 1:] |= np.abs(np.diff(pixels, axis=1)) > EDGE_THRESHOLD
+    edges[1:, :] |= np.abs(np.diff(pixels, axis=0)) > EDGE_THRESHOLD
+    # Merge characters into words and lines, and lines into paragraphs
+    blocks = _dilate(_dilate(edges, max(3, round(width * 0.02)), axis=1), max(2, round(height * 0.006)), axis=0)
+
+    row_gap = max(3, round(height * min_row_gap))
+    col_gap = max(8, round(width * min_col_gap))
+    regions = []
+
+    def cut(top, left, bottom, right, depth):
+        area = blocks[top:bottom, left:right]
+        rows, cols = np.flatnonzero(area.any(axis=1)), np.flatnonzero(area.any(axis=0))
+        if not len(rows):
+            return
+        top, bottom = top + rows[0], top + rows[-1] + 1
+        left, right = left + cols[0], left + cols[-1] + 1
+        area = blocks[top:bottom, left:right]
+        text = edges[top:bottom, left:right]
+        table = False
+
+        if depth < MAX_CUT_DEPTH:
+            # Columns first so a two-column layout reads column by column
+            spans = _split(right - left, _gaps(area.any(axis=0), col_gap))
+            if len(spans) > 1:
+                groups = _group_columns(text, spans)
+                if len(groups) > 1:
+                    for start, end in groups:
+                        cut(top, left + start, bottom, left + end, depth + 1)
+                    return
+                table = True
+            spans = _split(bottom - top, _gaps(area.any(axis=1), row_gap))
+            if len(spans) > 1:
+                for start, end in spans:
+                    cut(top + start, left, top + end, right, depth + 1)
+                return
+
+        if np.count_nonzero(text) < 10 or bottom - top < 4:
+            return  # Speckle, not text
+        lines = len(_runs(text.any(axis=1)))
+        if lines <= 1 and (bottom - top > height * 0.08 or right - left < 2 * (bottom - top)):
+            return  # One solid blob too tall or too square for a line of text: artwork
+        psm = PSM_SINGLE_LINE if lines <= 1 else PSM_UNIFORM_BLOCK if table else PSM_SINGLE_COLUMN
+        regions.append((left, top, right, bottom, psm))
+
+    cut(0, 0, height, width, 0)
+    return regions, scale
+
+
+_ocr_executor = None
+_ocr_executor_pid = None
+_ocr_executor_lock = threading.Lock()
+
+
+def get_ocr_executor():
+    """Get this process' thread pool for OCR'ing regions in parallel"""
+    global _ocr_executor, _ocr_executor_pid
+    with _ocr_executor_lock:
+        if _ocr_executor is None or _ocr_executor_pid != os.getpid():
+            # Parallel Tesseract processes each using every core just contend
+            os.environ.setdefault('OMP_THREAD_LIMIT', '1')
+            _ocr_executor = ThreadPoolExecutor(
+                max_workers=getattr(settings, 'OCR_MAX_WORKERS', 4),
+                thread_name_prefix='analyzer-ocr',
+            )
+            _ocr_executor_pid = os.getpid()
+        return _ocr_executor
+
+
+class LabelOCR:
+    """Tesseract OCR that reads only the text blocks of a label, in parallel.
+
+    Small images, images without detectable blocks and images that break up
+    into too many blocks are read whole, as before.
+
+    Every block gets one fast pass; only blocks whose mean word confidence
+    stays below the target get extra passes (inverted, another segmentation
+    mode, upscaled), keeping whichever pass read them most confidently.
+
+    Given a request deadline, each Tesseract process is killed when it runs
+    out, and extra passes stop `reserve` seconds early.
+    """
+
+    def __init__(self):
+        whitelist = getattr(settings, 'OCR_CHAR_WHITELIST', DEFAULT_CHAR_WHITELIST)
+        self.tesseract_options = f'-c tessedit_char_whitelist={shlex.quote(whitelist)}' if whitelist else ''
+        self.confidence_target = getattr(settings, 'OCR_CONFIDENCE_TARGET', 80)
+        self.max_passes = getattr(settings, 'OCR_MAX_PASSES', 3)
+        self.max_upscale_pixels = getattr(settings, 'OCR_MAX_UPSCALE_PIXELS', 4_000_000)
+        self.region_detection = getattr(settings, 'OCR_REGION_DETECTION', True)
+        self.detection_max_dimension = getattr(settings, 'OCR_DETECTION_MAX_DIMENSION', 1000)
+        self.min_pixels = getattr(settings, 'OCR_REGION_MIN_PIXELS', 1_000_000)
+        self.max_regions = getattr(settings, 'OCR_MAX_REGIONS', 24)
+        self.padding = getattr(settings, 'OCR_REGION_PADDING', 0.01)
+
+    @cached_property
+    def version(self):
+        """Tesseract version plus a digest of the pipeline and its settings, stored with each result"""
+        settings_key = repr((
+            OCR_PIPELINE_VERSION, self.tesseract_options, self.confidence_target, self.max_passes,
+            self.max_upscale_pixels, self.region_detection, self.detection_max_dimension,
+            self.min_pixels, self.max_regions, self.padding,
+        ))
+        return f"tesseract-{pytesseract.get_tesseract_version()}/{hashlib.sha1(settings_key.encode()).hexdigest()[:10]}"
+
+    def config(self, psm):
+        return f'--oem 3 --psm {psm} {self.tesseract_options}'.strip()
+
+    def regions(self, image):
+        """Text regions of a full-resolution image in reading order, or None to read it whole"""
+        if not self.region_detection or image.width * image.height < self.min_pixels:
+            return None
+        found, scale = detect_text_regions(image.convert('L'), self.detection_max_dimension)
+        if not found or len(found) > self.max_regions:
+            logger.info(f"Found {len(found)} text regions, reading the whole image instead")
+            return None
+        pad = round(max(image.size) * self.padding)
+        return [
+            TextRegion(
+                box=(
+                    max(0, int(left * scale) - pad),
+                    max(0, int(top * scale) - pad),
+                    min(image.width, int(right * scale) + pad),
+                    min(image.height, int(bottom * scale) + pad),
+                ),
+                psm=psm,
+            )
+            for left, top, right, bottom, psm in found
+        ]
+
+    def recognize(self, image, psm, deadline=None, reserve=0):
+        """One Tesseract pass: text in reading order and its confidence"""
+        timeout = None
+        if deadline is not None:
+            deadline.check('ocr', reserve)
+            timeout = deadline.remaining(reserve)
+        try:
+            data = pytesseract.image_to_data(
+                image, config=self.config(psm), output_type=pytesseract.Output.DICT, timeout=timeout
+            )
+        except RuntimeError:
+            # pytesseract kills the process at the timeout and raises RuntimeError
+            if deadline is not None and deadline.expired(reserve):
+                raise DeadlineExceeded('ocr')
+            raise
+        blocks = {}
+        weighted, characters = 0.0, 0
+        for i, word in enumerate(data['text']):
+            word = (word or '').strip()
+            confidence = float(data['conf'][i])
+            if not word or confidence < 0:
+                continue
+            lines = blocks.setdefault(data['block_num'][i], {})
+            lines.setdefault((data['par_num'][i], data['line_num'][i]), []).append(word)
+            # Weigh by length so a confidently read "g" can't mask a garbled ingredient
+            weighted += confidence * len(word)
+            characters += len(word)
+        text = '\n\n'.join(
+            '\n'.join(' '.join(words) for words in lines.values()) for lines in blocks.values()
+        )
+        return OCRResult(text, weighted / characters if characters else 0.0, 1)
+
+    def _retries(self, image, psm):
+        """Lazily yield (image, psm) for progressively more expensive passes"""
+        gray = image.convert('L')
+        dark = ImageStat.Stat(gray).mean[0] < 110
+        if dark:
+            yield ImageOps.invert(gray), psm  # Light text on a dark background
+        yield image, ALTERNATE_PSM.get(psm, PSM_UNIFORM_BLOCK)
+        if image.width * image.height * 4 <= self.max_upscale_pixels:
+            yield image.resize((image.width * 2, image.height * 2), Image.LANCZOS), psm  # Small print
+        if not dark:
+            yield ImageOps.invert(gray), psm
+
+    def recognize_adaptive(self, image, psm, deadline=None, reserve=0):
+        """Fast pass first; more passes only while confidence stays below target and time allows"""
+        best = self.recognize(image, psm, deadline)
+        passes = 1
+        if best.confidence < self.confidence_target:
+            for retry_image, retry_psm in self._retries(image, psm):
+                if passes >= self.max_passes:
+                    break
+                try:
+                    result = self.recognize(retry_image, retry_psm, deadline, reserve)
+                except DeadlineExceeded:
+                    break
+                passes += 1
+                if result.confidence > best.confidence:
+                    best = result
+                if best.confidence >= self.confidence_target:
+                    break
+        return best._replace(passes=passes)
+
+    def read(self, image, deadline=None, reserve=0):
+        """OCR an RGB image; text blocks are separated by blank lines"""
+        started = time.monotonic()
+        regions = self.regions(image)
+        if regions is None:
+            result = self.recognize_adaptive(image, PSM_UNIFORM_BLOCK, deadline, reserve)
+            logger.info(f"OCR'd whole image at {result.confidence:.0f}% confidence in {result.passes} passes, "
+                        f"{time.monotonic() - started:.2f}s")
+            return result
+
+        crops = [image.crop(region.box) for region in regions]
+        results = [
+            result for result in get_ocr_executor().map(
+                lambda crop, region: self.recognize_adaptive(crop, region.psm, deadline, reserve), crops, regions
+            )
+            if result.text.strip()
+        ]
+        characters = sum(len(result.text) for result in results)
+        confidence = sum(result.confidence * len(result.text) for result in results) / characters if characters else 0.0
+        passes = sum(result.passes for result in results)
+        logger.info(f"OCR'd {len(regions)} text regions at {confidence:.0f}% confidence in {passes} passes, "
+                    f"{time.monotonic() - started:.2f}s")
+        return OCRResult('\n\n'.join(result.text.strip() for result in results), confidence, passes)
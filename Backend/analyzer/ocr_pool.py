@@ -0,0 +1,49 @@
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import django
+from django.conf import settings
+
+# Nothing here may import models at module level: spawned workers import this
+# module to unpickle their tasks before the initializer has set Django up.
+
+
+def get_ocr_pool(workers):
+    """Process pool for bulk OCR, one OCR lane per process.
+
+    Workers are spawned rather than forked, so they start with no copy of this
+    process' database connections or of the health-check and background
+    threads (and the locks those may hold mid-fork).
+    """
+    return ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context('spawn'),
+        initializer=init_ocr_worker,
+    )
+
+
+def init_ocr_worker():
+    # Each process is one OCR lane; the process pool provides the parallelism
+    settings.OCR_MAX_WORKERS = 1
+    django.setup()
+
+
+def ocr_label(image_path):
+    """OCR one label in a worker process and derive everything that needs no database"""
+    from .services import get_food_analyzer_service
+    from .similarity import label_signature, normalize_label_text
+
+    service = get_food_analyzer_service()
+    text, confidence = service.extract_text_with_confidence(image_path)
+    if text.startswith("Error"):
+        return {'error': text}
+    ingredients, nutrition = service.process_extracted_text(text)
+    signature = label_signature(normalize_label_text(ingredients, nutrition, text))
+    return {
+        'extracted_text': text,
+        'ocr_confidence': confidence,
+        'ocr_version': service.ocr.version,
+        'ingredients_text': ingredients,
+        'nutrition_text': nutrition,
+        'ingredient_tags': service.tag_ingredients(text, ingredients),
+        'label_signature': signature.tobytes() if signature is not None else None,
+    }
@@ -0,0 +1,240 @@
+import gzip
+import json
+import logging
+import os
+import time
+from datetime import timedelta
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+from .models import FoodAnalysis, AnalysisSession, Chat, Message, LabelImage
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_RETENTION_POLICIES = {
+    'chats': 180,
+    'analyses': 365,
+    'sessions': 90,
+    'anonymous_users': 30,
+}
+
+
+class RetentionArchive:
+    """Appends rows to one gzip-compressed JSONL file per table"""
+
+    def __init__(self, directory, stamp):
+        self.directory = directory
+        self.stamp = stamp
+        self._files = {}
+
+    def write(self, label, rows):
+        fh = self._files.get(label)
+        if fh is None:
+            os.makedirs(self.directory, exist_ok=True)
+            path = os.path.join(self.directory, f"{label}-{self.stamp}.jsonl.gz")
+            fh = self._files[label] = gzip.open(path, 'at', encoding='utf-8')
+        for row in rows:
+            fh.write(json.dumps(row, cls=DjangoJSONEncoder))
+            fh.write('\n')
+
+    def close(self):
+        for fh in self._files.values():
+            fh.close()
+        self._files = {}
+
+
+class RetentionJob:
+    """Delete (and optionally archive) data older than the configured policies.
+
+    Candidate primary keys are streamed with `.iterator()` (a server-side
+    cursor on PostgreSQL) and deleted in short transactions of `batch_size`
+    rows, so no long-running lock is held on the tables being pruned.
+    """
+
+    def __init__(self, policies=None, archive_dir=None, batch_size=None, dry_run=False, now=None):
+        self.policies = {
+            **DEFAULT_RETENTION_POLICIES,
+            **getattr(settings, 'RETENTION_POLICIES', {}),
+            **(policies or {}),
+        }
+        if archive_dir is None:
+            archive_dir = getattr(settings, 'RETENTION_ARCHIVE_DIR', None)
+        self.batch_size = batch_size or getattr(settings, 'RETENTION_BATCH_SIZE', 500)
+        self.media_grace = timedelta(hours=getattr(settings, 'RETENTION_MEDIA_GRACE_HOURS', 24))
+        self.dry_run = dry_run
+        self.now = now or timezone.now()
+        self.archive = None
+        if archive_dir and not dry_run:
+            self.archive = RetentionArchive(archive_dir, self.now.strftime('%Y%m%dT%H%M%S'))
+        self.report = {}
+
+    def cutoff(self, key):
+        """Cutoff datetime for a policy, or None if the policy keeps rows forever"""
+        days = self.policies.get(key)
+        if days is None:
+            return None
+        return self.now - timedelta(days=days)
+
+    def run(self):
+        """Apply every policy and return a report of what was reclaimed"""
+        started = time.monotonic()
+        media_before = self._media_usage()
+        try:
+            # Chats go first so the analyses they pointed at become eligible
+            self.purge_chats()
+            self.purge_analyses()
+            self.purge_sessions()
+            self.purge_anonymous_users()
+            self.purge_orphaned_media()
+        finally:
+            if self.archive:
+                self.archive.close()
+        self.report['media_bytes_reclaimed'] = max(media_before - self._media_usage(), 0)
+        self.report['elapsed_seconds'] = round(time.monotonic() - started, 2)
+        return self.report
+
+    def purge_chats(self):
+        cutoff = self.cutoff('chats')
+        if cutoff is None:
+            return
+        # A chat expires once it was created, and last written to, before the cutoff
+        queryset = Chat.objects.filter(created_at__lt=cutoff).exclude(message__created_at__gte=cutoff)
+        self._purge('chats', queryset, related=[('messages', Message, 'chat_id')])
+
+    def purge_analyses(self):
+        cutoff = self.cutoff('analyses')
+        if cutoff is None:
+            return
+
+        def unreferenced(pks):
+            # Keep analyses that a surviving chat still points at
+            referenced = set(
+                Chat.objects.filter(analysis_id__in=[str(pk) for pk in pks])
+                .values_list('analysis_id', flat=True)
+            )
+            return [pk for pk in pks if str(pk) not in referenced]
+
+        queryset = FoodAnalysis.objects.filter(created_at__lt=cutoff)
+        self._purge('analyses', queryset, select=unreferenced)
+
+    def purge_sessions(self):
+        cutoff = self.cutoff('sessions')
+        if cutoff is None:
+            return
+        self._purge('sessions', AnalysisSession.objects.filter(last_activity__lt=cutoff))
+
+    def purge_anonymous_users(self):
+        cutoff = self.cutoff('anonymous_users')
+        if cutoff is None:
+            return
+        # Session users created by get_or_create_session_user: no password, no chats
+        queryset = User.objects.filter(
+            username__startswith='anon_',
+            password='',
+            is_staff=False,
+            date_joined__lt=cutoff,
+            chat__isnull=True,
+        )
+        self._purge('anonymous_users', queryset, archive=False)
+
+    def purge_orphaned_media(self):
+        """Remove leaked store rows and image files nothing refers to"""
+        # A row stored moments ago may not have its analysis attached yet
+        leaked = LabelImage.objects.filter(
+            ref_count__lte=0, analyses__isnull=True, created_at__lt=self.now - self.media_grace
+        )
+        self._purge('leaked_label_images', leaked, archive=False)
+
+        media_dir = os.path.join(settings.MEDIA_ROOT, 'food_labels')
+        threshold = (self.now - self.media_grace).timestamp()
+        removed = 0
+        batch = {}
+        for path in self._walk(media_dir):
+            try:
+                if os.path.getmtime(path) >= threshold:
+                    continue  # May belong to an upload that is still in flight
+            except OSError:
+                continue
+            name = os.path.relpath(path, settings.MEDIA_ROOT).replace(os.sep, '/')
+            batch[name] = path
+            if len(batch) >= self.batch_size:
+                removed += self._remove_unreferenced(batch)
+                batch = {}
+        if batch:
+            removed += self._remove_unreferenced(batch)
+        self.report['orphaned_media_files'] = removed
+
+    def _remove_unreferenced(self, batch):
+        names = list(batch)
+        referenced = set(
+            FoodAnalysis.objects.filter(image__in=names).values_list('image', flat=True)
+        )
+        for file_name, derivative_name in LabelImage.objects.filter(
+            Q(file__in=names) | Q(derivative__in=names)
+        ).values_list('file', 'derivative'):
+            referenced.update((file_name, derivative_name))
+
+        removed = 0
+        for name, path in batch.items():
+            if name in referenced:
+                continue
+            if not self.dry_run:
+                try:
+                    os.remove(path)
+                except OSError as e:
+                    logger.warning(f"Could not remove orphaned media {path}: {str(e)}")
+                    continue
+            removed += 1
+        return removed
+
+    def _purge(self, label, queryset, select=None, related=(), archive=True):
+        """Stream candidate keys and delete them in bounded batches"""
+        model = queryset.model
+        counts = self.report.setdefault(label, 0)
+        batch = []
+        pks = queryset.order_by().values_list('pk', flat=True).distinct().iterator(chunk_size=self.batch_size)
+        for pk in pks:
+            batch.append(pk)
+            if len(batch) >= self.batch_size:
+                counts += self._delete_batch(label, model, batch, select, related, archive)
+                batch = []
+        if batch:
+            counts += self._delete_batch(label, model, batch, select, related, archive)
+        self.report[label] = counts
+        logger.info(f"Retention: {'would remove' if self.dry_run else 'removed'} {counts} {label}")
+
+    def _delete_batch(self, label, model, pks, select, related, archive):
+        if select is not None:
+            pks = select(pks)
+        if not pks or self.dry_run:
+            return len(pks)
+
+        with transaction.atomic():
+            if archive and self.archive:
+                for related_label, related_model, field in related:
+                    rows = related_model.objects.filter(**{f"{field}__in": pks}).values().iterator()
+                    self.archive.write(related_label, rows)
+                self.archive.write(label, model.objects.filter(pk__in=pks).values().iterator())
+            deleted, per_model = model.objects.filter(pk__in=pks).delete()
+
+        for related_label, related_model, field in related:
+            key = related_model._meta.label
+            self.report[related_label] = self.report.get(related_label, 0) + per_model.get(key, 0)
+        return per_model.get(model._meta.label, 0)
+
+    def _walk(self, directory):
+        for root, dirs, files in os.walk(directory):
+            for file_name in files:
+                yield os.path.join(root, file_name)
+
+    def _media_usage(self):
+        total = 0
+        for path in self._walk(os.path.join(settings.MEDIA_ROOT, 'food_labels')):
+            try:
+                total += os.path.getsize(path)
+            except OSError:
+                pass
+        return total
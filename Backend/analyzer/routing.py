@@ -0,0 +1,103 @@
+import logging
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Weight of the newest sample in the per-model latency moving average
+LATENCY_EWMA_ALPHA = 0.3
+
+
+class ModelRouter:
+    """Route LLM task types to models, downgrading when a model is overloaded.
+
+    Every task type ('analysis', 'chat', 'title', 'summary', ...) maps to a
+    model name; tasks without a route use the default model. While a model
+    has `max_queue_depth` generations in flight, or its projected wait
+    (queued generations x average latency) would exceed the task's latency
+    SLO, the task is sent to the model's configured fallback instead.
+
+    `model_available(model)` says whether a healthy node reports having the
+    model (None while unknown). Tasks are only downgraded to a model a node has
+    reported, and a route to a model no node has falls back to the default.
+    """
+
+    def __init__(self, default_model, routes=None, fallbacks=None, slo_seconds=None, max_queue_depth=None,
+                 model_available=None):
+        self.default_model = default_model
+        self.model_available = model_available
+        self.routes = routes or {}
+        self.fallbacks = fallbacks or {}
+        self.slo_seconds = slo_seconds or {}
+        self.max_queue_depth = max_queue_depth
+        self._lock = threading.Lock()
+        self._inflight = defaultdict(int)
+        self._latency = {}
+
+    def choose(self, task):
+        """Return the model that should serve `task` right now"""
+        model = self.routes.get(task) or self.default_model
+        if model != self.default_model and self._available(model) is False:
+            logger.warning(f"No Ollama node has {model} for '{task}', using {self.default_model}")
+            model = self.default_model
+        fallback = self.fallbacks.get(model)
+        if fallback and fallback != model and self._overloaded(model, task) and self._available(fallback):
+            logger.info(f"Routing '{task}' from {model} to {fallback}: queue too deep")
+            return fallback
+        return model
+
+    def serving_models(self, task):
+        """Every model `choose` may currently pick for `task`, downgrades included"""
+        model = self.routes.get(task) or self.default_model
+        if model != self.default_model and self._available(model) is False:
+            model = self.default_model
+        return {model, self.fallbacks.get(model) or model}
+
+    def _available(self, model):
+        return True if self.model_available is None else self.model_available(model)
+
+    def _overloaded(self, model, task):
+        with self._lock:
+            depth = self._inflight[model]
+            latency = self._latency.get(model)
+        if self.max_queue_depth and depth >= self.max_queue_depth:
+            return True
+        slo = self.slo_seconds.get(task)
+        if slo and latency:
+            # Ollama on CPU serves one generation at a time per model
+            return (depth + 1) * latency > slo
+        return False
+
+    @contextmanager
+    def track(self, model):
+        """Count a generation as in flight on `model` and record its latency"""
+        with self._lock:
+            self._inflight[model] += 1
+        started = time.monotonic()
+        succeeded = False
+        try:
+            yield
+            succeeded = True
+        finally:
+            elapsed = time.monotonic() - started
+            with self._lock:
+                self._inflight[model] -= 1
+                if succeeded:
+                    previous = self._latency.get(model)
+                    self._latency[model] = elapsed if previous is None else (
+                        LATENCY_EWMA_ALPHA * elapsed + (1 - LATENCY_EWMA_ALPHA) * previous
+                    )
+
+    def stats(self):
+        """Snapshot of in-flight counts and average latency per model"""
+        with self._lock:
+            models = set(self._inflight) | set(self._latency)
+            return {
+                model: {
+                    'inflight': self._inflight.get(model, 0),
+                    'avg_latency_seconds': round(self._latency[model], 3) if model in self._latency else None,
+                }
+                for model in models
+            }
@@ -0,0 +1,206 @@
+import logging
+import re
+from django.db import connection
+from django.db.models import Q
+from .models import Chat, FoodAnalysis, SearchDocument
+
+logger = logging.getLogger(__name__)
+
+# Markers around matched terms in snippets (markdown bold, safe to render)
+HIGHLIGHT_START = '**'
+HIGHLIGHT_END = '**'
+
+
+def index_analysis(analysis):
+    """Add or refresh the search entry for an analysis"""
+    if not analysis.extracted_text:
+        return
+    SearchDocument.objects.update_or_create(
+        kind='analysis',
+        object_id=str(analysis.id),
+        defaults={
+            'title': (analysis.ingredients_text or '')[:255],
+            'body': analysis.extracted_text,
+            'created_at': analysis.created_at,
+        }
+    )
+
+
+def index_analyses(analyses):
+    """Bulk-add search entries for new analyses (bulk_create skips the post_save signal)"""
+    SearchDocument.objects.bulk_create([
+        SearchDocument(
+            kind='analysis',
+            object_id=str(analysis.id),
+            title=(analysis.ingredients_text or '')[:255],
+            body=analysis.extracted_text,
+            created_at=analysis.created_at,
+        )
+        for analysis in analyses
+        if analysis.extracted_text
+    ])
+
+
+def index_message(message, chat=None):
+    """Add or refresh the search entry for a chat message"""
+    chat = chat or message.chat
+    SearchDocument.objects.update_or_create(
+        kind='message',
+        object_id=str(message.id),
+        defaults={
+            'user_id': chat.user_id,
+            'chat': chat,
+            'title': chat.title[:255],
+            'body': message.content,
+            'created_at': message.created_at,
+        }
+    )
+
+
+def remove_document(kind, object_id):
+    SearchDocument.objects.filter(kind=kind, object_id=str(object_id)).delete()
+
+
+def visible_analysis_ids(user=None, session_key=None):
+    """Ids of the analyses a user has chatted about or uploaded in this session"""
+    ids = set()
+    if user is not None:
+        ids.update(Chat.objects.filter(user=user, analysis_id__isnull=False).values_list('analysis_id', flat=True))
+    if session_key:
+        ids.update(
+            str(analysis_id) for analysis_id in
+            FoodAnalysis.objects.filter(session__session_id=session_key).values_list('id', flat=True)
+        )
+    return sorted(ids)
+
+
+def search(query, user=None, kinds=('analysis', 'message'), page=1, page_size=20, analysis_ids=None):
+    """Ranked full-text search; returns (results, total).
+
+    Analyses are limited to `analysis_ids` (see visible_analysis_ids); None
+    searches all of them, for staff. Chat messages are only visible to the
+    user who owns the chat.
+    """
+    query = (query or '').strip()
+    if not query:
+        return [], 0
+    offset = (page - 1) * page_size
+    user_id = user.id if user else None
+
+    if connection.vendor == 'postgresql':
+        return _search_postgres(query, user_id, analysis_ids, kinds, page_size, offset)
+    if connection.vendor == 'sqlite':
+        return _search_sqlite(query, user_id, analysis_ids, kinds, page_size, offset)
+    return _search_fallback(query, user_id, analysis_ids, kinds, page_size, offset)
+
+
+def _visibility_sql(kinds, user_id, analysis_ids):
+    clauses, params = [], []
+    if 'analysis' in kinds and analysis_ids is None:
+        clauses.append("d.kind = 'analysis'")
+    elif 'analysis' in kinds and analysis_ids:
+        placeholders = ', '.join(['%s'] * len(analysis_ids))
+        clauses.append(f"(d.kind = 'analysis' AND d.object_id IN ({placeholders}))")
+        params.extend(analysis_ids)
+    if 'message' in kinds and user_id is not None:
+        clauses.append("(d.kind = 'message' AND d.user_id = %s)")
+        params.append(user_id)
+    if not clauses:
+        return '1 = 0', []
+    return '(' + ' OR '.join(clauses) + ')', params
+
+
+def _search_postgres(query, user_id, analysis_ids, kinds, limit, offset):
+    visibility, visibility_params = _visibility_sql(kinds, user_id, analysis_ids)
+    where = f"d.search_vector @@ q.query AND {visibility}"
+    base = "FROM analyzer_searchdocument d, websearch_to_tsquery('english', %s) AS q(query)"
+    headline_options = (
+        f"StartSel={HIGHLIGHT_START}, StopSel={HIGHLIGHT_END}, MaxFragments=2, MaxWords=20, MinWords=5"
+    )
+    with connection.cursor() as cursor:
+        cursor.execute(f"SELECT count(*) {base} WHERE {where}", [query, *visibility_params])
+        total = cursor.fetchone()[0]
+        cursor.execute(
+            f"""
+            SELECT d.kind, d.object_id, d.chat_id, d.title, d.created_at,
+                   ts_rank(d.search_vector, q.query) AS rank,
+                   ts_headline('english', d.body, q.query, %s) AS snippet
+            {base}
+            WHERE {where}
+            ORDER BY rank DESC, d.created_at DESC
+            LIMIT %s OFFSET %s
+            """,
+            [headline_options, query, *visibility_params, limit, offset]
+        )
+        rows = cursor.fetchall()
+    return [_result(*row) for row in rows], total
+
+
+def _fts5_query(query):
+    """Quote each term so user input can't inject FTS5 query syntax"""
+    terms = re.findall(r'\w+', query.lower())
+    return ' '.join(f'"{term}"' for term in terms)
+
+
+def _search_sqlite(query, user_id, analysis_ids, kinds, limit, offset):
+    match = _fts5_query(query)
+    if not match:
+        return [], 0
+    visibility, visibility_params = _visibility_sql(kinds, user_id, analysis_ids)
+    base = (
+        "FROM analyzer_searchdocument_fts f "
+        "JOIN analyzer_searchdocument d ON d.id = f.rowid "
+        f"WHERE analyzer_searchdocument_fts MATCH %s AND {visibility}"
+    )
+    with connection.cursor() as cursor:
+        cursor.execute(f"SELECT count(*) {base}", [match, *visibility_params])
+        total = cursor.fetchone()[0]
+        # bm25() is lower-is-better; title matches weigh twice the body
+        cursor.execute(
+            f"""
+            SELECT d.kind, d.object_id, d.chat_id, d.title, d.created_at,
+                   -bm25(analyzer_searchdocument_fts, 2.0, 1.0) AS rank,
+                   snippet(analyzer_searchdocument_fts, 1, %s, %s, '…', 20) AS snippet
+            {base}
+            ORDER BY rank DESC, d.created_at DESC
+            LIMIT %s OFFSET %s
+            """,
+            [HIGHLIGHT_START, HIGHLIGHT_END, match, *visibility_params, limit, offset]
+        )
+        rows = cursor.fetchall()
+    return [_result(*row) for row in rows], total
+
+
+def _search_fallback(query, user_id, analysis_ids, kinds, limit, offset):
+    """Unindexed substring search for databases without full-text support"""
+    logger.warning(f"No full-text index for {connection.vendor}; falling back to a table scan")
+    visible = Q(pk__in=[])
+    if 'analysis' in kinds and analysis_ids is None:
+        visible |= Q(kind='analysis')
+    elif 'analysis' in kinds:
+        visible |= Q(kind='analysis', object_id__in=analysis_ids)
+    if 'message' in kinds and user_id is not None:
+        visible |= Q(kind='message', user_id=user_id)
+    queryset = SearchDocument.objects.filter(visible).filter(
+        Q(body__icontains=query) | Q(title__icontains=query)
+    ).order_by('-created_at')
+    total = queryset.count()
+    rows = queryset.values_list('kind', 'object_id', 'chat_id', 'title', 'created_at', 'body')[offset:offset + limit]
+    return [_result(kind, object_id, chat_id, title, created_at, None, body[:200])
+            for kind, object_id, chat_id, title, created_at, body in rows], total
+
+
+def _result(kind, object_id, chat_id, title, created_at, rank, snippet):
+    result = {
+        'type': kind,
+        'title': title,
+        'snippet': snippet,
+        'rank': round(rank, 4) if rank is not None else None,
+        'created_at': created_at.isoformat() if hasattr(created_at, 'isoformat') else created_at,
+    }
+    if kind == 'analysis':
+        result['analysis_id'] = object_id
+    else:
+        result['message_id'] = int(object_id)
+        result['chat_id'] = chat_id
+    return result
@@ -1,36 +1,163 @@
+import hashlib
+import json
 import os
 import re
+import threading
+import time
+from collections import namedtuple
 from PIL import Image
-import pytesseract
+import requests
 from langchain.llms import Ollama
 from langchain.prompts import PromptTemplate
-from langchain.chains import LLMChain
 from langchain.schema import OutputParserException
 from django.conf import settings
 import logging
+from .backends import OllamaBackendPool, OllamaResponseError, is_retryable
+from .deadlines import DeadlineExceeded
+from .knowledge import format_ingredient_hints, get_ingredient_knowledge
+from .ocr import LabelOCR
+from .routing import ModelRouter
 
 logger = logging.getLogger(__name__)
 
+# Text generated for a task, tagged with the model that served it and its token count
+LLMResponse = namedtuple('LLMResponse', ['text', 'model', 'latency_ms', 'tokens'])
+
+OLLAMA_CONNECT_TIMEOUT = 5
+
+
+class GenerationTimeout(Exception):
+    """Raised when a generation runs past the time it was given"""
+
+    def __init__(self, seconds):
+        super().__init__(f"Generation exceeded its {seconds:.1f}s budget")
+        self.seconds = seconds
+
+
+class BoundedOllama(Ollama):
+    """Ollama LLM taking a per-call `timeout` that covers the whole streamed generation.
+
+    LangChain 0.0.335 (pinned in requirements.txt) posts to Ollama without a
+    timeout, so a call nobody waits for any more streams on for as long as the
+    model takes. This is its `_create_stream` plus that timeout; closing the
+    stream early also makes Ollama stop generating. Error responses raise
+    OllamaResponseError, a ValueError carrying the status.
+    """
+
+    def _create_stream(self, prompt, stop=None, timeout=None, **kwargs):
+        if self.stop is not None and stop is not None:
+            raise ValueError("`stop` found in both the input and default params.")
+        elif self.stop is not None:
+            stop = self.stop
+        elif stop is None:
+            stop = []
+        params = {**self._default_params, "stop": stop, **kwargs}
+        expires_at = time.monotonic() + timeout if timeout else None
+        try:
+            response = requests.post(
+                url=f"{self.base_url}/api/generate/",
+                headers={"Content-Type": "application/json"},
+                json={"prompt": prompt, **params},
+                stream=True,
+                timeout=(min(timeout, OLLAMA_CONNECT_TIMEOUT), timeout) if timeout else None,
+            )
+        except requests.exceptions.ReadTimeout:
+            raise GenerationTimeout(timeout) from None
+        response.encoding = "utf-8"
+        if response.status_code != 200:
+            try:
+                detail = response.json().get("error")
+            except ValueError:
+                detail = response.text[:200]
+            response.close()
+            raise OllamaResponseError(response.status_code, detail)
+        return self._stream_until(response, expires_at, timeout)
+
+    @staticmethod
+    def _stream_until(response, expires_at, timeout):
+        try:
+            for line in response.iter_lines(decode_unicode=True):
+                yield line
+                if expires_at is not None and time.monotonic() > expires_at:
+                    raise GenerationTimeout(timeout)
+        except requests.exceptions.ConnectionError:
+            # A read timeout mid-stream surfaces as a ConnectionError
+            if expires_at is not None and time.monotonic() >= expires_at:
+                raise GenerationTimeout(timeout) from None
+            raise
+        finally:
+            response.close()
+
+ANALYSIS_OUTPUT_MODES = ('markdown', 'json')
+RECOMMENDATIONS = ('EAT', 'MODERATE', 'AVOID')
+
+ANALYSIS_JSON_PROMPT = """You are a certified nutritionist and food safety expert. Assess this food label for a general consumer.
+
+INGREDIENTS: {ingredients}
+NUTRITION: {nutrition_info}
+PRE-FLAGGED FROM OUR INGREDIENT DATABASE (already shown to the user, do not repeat them):
+{ingredient_hints}
+LABEL TEXT: {extracted_text}
+
+Respond with a JSON object only, keeping every string short:
+{{"recommendation": "EAT" | "MODERATE" | "AVOID", "health_score": 1-10, "concerns": [at most 4 short phrases], "advice": "one or two practical sentences", "summary": "one sentence verdict and why"}}
+
+Scoring: 9-10 clean ingredients and balanced nutrition; 7-8 minor concerns; 5-6 processed or sugary, eat occasionally; 3-4 several concerns, eat rarely; 1-2 avoid."""
+
+# Sent as Ollama's `format` so the model can only produce this shape (Ollama 0.5+)
+ANALYSIS_JSON_SCHEMA = {
+    'type': 'object',
+    'properties': {
+        'recommendation': {'type': 'string', 'enum': list(RECOMMENDATIONS)},
+        'health_score': {'type': 'integer', 'minimum': 1, 'maximum': 10},
+        'concerns': {'type': 'array', 'items': {'type': 'string'}, 'maxItems': 4},
+        'advice': {'type': 'string'},
+        'summary': {'type': 'string'},
+    },
+    'required': ['recommendation', 'health_score', 'concerns', 'advice', 'summary'],
+}
+
+TITLE_PROMPT = """Write a short title (3-6 words) for a conversation about a food product that starts with this question and answer. Respond with the title only, no quotes or punctuation at the end.
+
+Question: {question}
+Answer: {answer}
+Title:"""
+
+SUMMARY_PROMPT = """Summarize the following food label assessment in one strong sentence giving the overall health verdict and why. Respond with the sentence only.
+
+{analysis}
+Summary:"""
+
 class FoodAnalyzerService:
     """Service class for food label analysis using LangChain and Ollama"""
     
     def __init__(self):
         self.model_name = getattr(settings, 'OLLAMA_MODEL', 'llama3.2:latest')
         self.base_url = getattr(settings, 'OLLAMA_BASE_URL', 'http://localhost:11434')
+        self.pool = OllamaBackendPool(
+            getattr(settings, 'OLLAMA_BACKENDS', None) or [self.base_url],
+            max_failures=getattr(settings, 'OLLAMA_BACKEND_MAX_FAILURES', 3),
+            health_check_interval=getattr(settings, 'OLLAMA_HEALTH_CHECK_INTERVAL', 15),
+        )
         self.llm = None
-        self.analysis_chain = None
+        self._llms = {}
+        self._llms_lock = threading.Lock()
+        self.router = ModelRouter(
+            default_model=self.model_name,
+            routes=getattr(settings, 'OLLAMA_MODEL_ROUTES', {}),
+            fallbacks=getattr(settings, 'OLLAMA_MODEL_FALLBACKS', {}),
+            slo_seconds=getattr(settings, 'OLLAMA_LATENCY_SLO_SECONDS', {}),
+            max_queue_depth=getattr(settings, 'OLLAMA_MAX_QUEUE_DEPTH', None),
+            model_available=self.pool.has_model,
+        )
+        self.ocr = LabelOCR()
         self._initialize_langchain()
     
     def _initialize_langchain(self):
         """Initialize LangChain components"""
         try:
-            # Initialize Ollama LLM
-            self.llm = Ollama(
-                model=self.model_name,
-                base_url=self.base_url,
-                temperature=0.3,  # Lower temperature for more consistent responses
-                top_p=0.9,
-            )
+            # Initialize Ollama LLM for the default model
+            self.llm = self.get_llm(self.model_name)
             
             prompt_template = """You are a certified nutritionist and food safety expert. Your task is to analyze a food label and provide a detailed health assessment, including specific, practical dietary advice for a general consumer.
 
@@ -47,6 +174,9 @@ First, generate a short, clear **TITLE** summarizing the food item or the main c
 ### 📊 NUTRITION INFORMATION:
 {nutrition_info}
 
+### 🏷 PRE-FLAGGED FROM OUR INGREDIENT DATABASE:
+{ingredient_hints}
+
 ---
 
 ### 🎯 Your Response Format:
@@ -56,7 +186,7 @@ First, generate a short, clear **TITLE** summarizing the food item or the main c
 **HEALTH SCORE:** [1–10]
 
 **DETAILED ANALYSIS:**
-- **Ingredients:** Comment on ingredient quality, additives, preservatives, allergens, natural vs. artificial items.
+- **Ingredients:** Comment on ingredient quality and natural vs. artificial items. The pre-flagged allergens and additives are already shown to the user: do not list them again, only mention the ones that change your verdict.
 - **Nutrition:** Discuss calories, sugar, fats, sodium, protein, fiber, vitamins, minerals.
 - **Concerns:** Clearly highlight any issues like high sugar/sodium, trans fats, allergens, ultra-processing, etc.
 
@@ -76,18 +206,31 @@ First, generate a short, clear **TITLE** summarizing the food item or the main c
 - 5–6: Average — processed or sugary, eat occasionally
 - 3–4: Poor — several concerns, eat rarely
 - 1–2: Unhealthy — avoid due to serious nutritional issues
+
+Keep the whole response under 250 words.
 """
             
             self.prompt = PromptTemplate(
-                input_variables=["extracted_text", "ingredients", "nutrition_info"],
+                input_variables=["extracted_text", "ingredients", "nutrition_info", "ingredient_hints"],
                 template=prompt_template
             )
+            self.json_prompt = PromptTemplate(
+                input_variables=["extracted_text", "ingredients", "nutrition_info", "ingredient_hints"],
+                template=ANALYSIS_JSON_PROMPT
+            )
             
-            # Create the analysis chain
-            self.analysis_chain = LLMChain(
-                llm=self.llm,
-                prompt=self.prompt,
-                verbose=False
+            # Changing a template, the JSON schema or the knowledge base the hints come
+            # from changes the version, which marks earlier results for re-analysis
+            knowledge_version = get_ingredient_knowledge().version
+            self.prompt_versions = {
+                'markdown': self._prompt_version('markdown', prompt_template, knowledge_version),
+                'json': self._prompt_version(
+                    'json', ANALYSIS_JSON_PROMPT, json.dumps(ANALYSIS_JSON_SCHEMA, sort_keys=True), knowledge_version
+                ),
+            }
+            # JSON-mode results that fell back to the markdown prompt
+            self.prompt_versions['json-fallback'] = self._prompt_version(
+                'json-fallback', self.prompt_versions['json'], self.prompt_versions['markdown']
             )
             
             logger.info(f"LangChain initialized successfully with model: {self.model_name}")
@@ -96,16 +239,108 @@ First, generate a short, clear **TITLE** summarizing the food item or the main c
             logger.error(f"Failed to initialize LangChain: {str(e)}")
             raise
     
+    def _prompt_version(self, output_mode, *parts):
+        digest = hashlib.sha1('\0'.join(str(part) for part in parts).encode()).hexdigest()[:10]
+        return f"{output_mode}-{digest}"
+    
+    def prompt_version(self, output_mode=None):
+        """Version of the analysis prompt used for an output mode (default: the configured one)"""
+        return self.prompt_versions[output_mode or getattr(settings, 'ANALYSIS_OUTPUT_MODE', 'markdown')]
+    
+    def current_prompt_versions(self, output_mode=None):
+        """Every prompt version a fresh analysis in an output mode may record"""
+        output_mode = output_mode or getattr(settings, 'ANALYSIS_OUTPUT_MODE', 'markdown')
+        versions = {self.prompt_versions[output_mode]}
+        if output_mode == 'json':
+            versions.add(self.prompt_versions['json-fallback'])
+        return versions
+    
+    def get_llm(self, model, base_url=None):
+        """Get the (shared) Ollama LLM for a model on a backend"""
+        base_url = base_url or self.base_url
+        with self._llms_lock:
+            llm = self._llms.get((model, base_url))
+            if llm is None:
+                llm = self._llms[(model, base_url)] = BoundedOllama(
+                    model=model,
+                    base_url=base_url,
+                    temperature=0.3,  # Lower temperature for more consistent responses
+                    top_p=0.9,
+                )
+            return llm
+    
+    def generate(self, task, prompt, format=None, num_predict=None, timeout=None):
+        """Run a prompt on the model routed for `task`, on the least-loaded backend.
+        
+        `format` constrains the output ('json' or a JSON schema) and
+        `num_predict` caps the number of generated tokens. `timeout` bounds
+        the whole generation in seconds, a retry on another node included;
+        OLLAMA_REQUEST_TIMEOUT applies when it is None or longer.
+        """
+        request = {'format': format} if format else {}
+        budgets = [t for t in (timeout, getattr(settings, 'OLLAMA_REQUEST_TIMEOUT', 120)) if t is not None]
+        budget = min(budgets) if budgets else None
+        model = self.router.choose(task)
+        tried = []
+        started = time.monotonic()
+        attempts = min(2, len(self.pool.backends))
+        with self.router.track(model):
+            for attempt in range(attempts):
+                if budget is not None:
+                    request['timeout'] = budget - (time.monotonic() - started)
+                    if request['timeout'] <= 0:
+                        raise GenerationTimeout(budget)
+                try:
+                    with self.pool.use(exclude=tried) as backend:
+                        tried.append(backend.url)
+                        llm = self.get_llm(model, backend.url)
+                        if num_predict:
+                            # Ollama takes options as a whole, so extend the LLM's defaults
+                            request['options'] = {**llm._default_params['options'], 'num_predict': num_predict}
+                        generation = llm.generate([prompt], **request).generations[0][0]
+                    break
+                except Exception as e:
+                    # Retry once on another node before giving up
+                    if not is_retryable(e) or attempt == attempts - 1:
+                        raise
+                    logger.warning(f"Ollama backend {tried[-1]} failed, retrying elsewhere: {str(e)}")
+        latency_ms = int((time.monotonic() - started) * 1000)
+        tokens = (generation.generation_info or {}).get('eval_count')
+        logger.info(f"LLM task '{task}' served by {model} on {backend.url} in {latency_ms} ms ({tokens} tokens)")
+        return LLMResponse(text=generation.text, model=model, latency_ms=latency_ms, tokens=tokens)
+    
+    def generate_title(self, question, answer):
+        """Generate a short chat title with the model routed for titles"""
+        response = self.generate('title', TITLE_PROMPT.format(question=question, answer=answer[:1000]))
+        title = response.text.strip().splitlines()[0] if response.text.strip() else ''
+        return title.strip(' "\'*#').strip()
+    
+    def summarize_analysis(self, analysis, timeout=None):
+        """Generate a one-sentence verdict with the model routed for summaries"""
+        response = self.generate('summary', SUMMARY_PROMPT.format(analysis=analysis), timeout=timeout)
+        return response.text.strip()
+    
     def test_connection(self):
-        """Test connection to Ollama"""
+        """Test connection to Ollama, health-checking every configured backend"""
+        health = self.pool.check_all()
+        if not any(health.values()):
+            return False, f"No healthy Ollama backend: {health}"
         try:
-            response = self.llm("Hello, respond with 'OK' if you can hear me.")
-            return True, response
+            response = self.generate('chat', "Hello, respond with 'OK' if you can hear me.")
+            return True, response.text
         except Exception as e:
             return False, str(e)
     
     def extract_text_from_image(self, image_path):
         """Extract text from image using OCR"""
+        return self.extract_text_with_confidence(image_path)[0]
+    
+    def extract_text_with_confidence(self, image_path, deadline=None, reserve=0):
+        """Extract text from image using OCR, with its mean word confidence (0-100).
+        
+        With a `deadline`, OCR raises DeadlineExceeded once it runs out and
+        skips extra passes that would eat into the last `reserve` seconds.
+        """
         try:
             # Open the image
             with Image.open(image_path) as img:
@@ -113,37 +348,35 @@ First, generate a short, clear **TITLE** summarizing the food item or the main c
                 if img.mode != 'RGB':
                     img = img.convert('RGB')
                 
-                # Configure tesseract for better food label reading
-                custom_config = r'--oem 3 --psm 6 -c tessedit_char_whitelist=0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz()[]{},./:;%*+-=<>!@#$%^&*()_+|\\~`" "'
-                
-                # Extract text
-                text = pytesseract.image_to_string(img, config=custom_config)
+                # Extract text from the detected text blocks
+                result = self.ocr.read(img, deadline, reserve)
                 
                 # Clean up the text
-                text = self._clean_extracted_text(text)
+                text = self._clean_extracted_text(result.text)
                 
                 logger.info(f"Successfully extracted {len(text)} characters from image")
-                return text
+                return text, round(result.confidence, 1)
                 
+        except DeadlineExceeded:
+            raise
         except Exception as e:
             logger.error(f"Error extracting text from image: {str(e)}")
-            return f"Error extracting text: {str(e)}"
+            return f"Error extracting text: {str(e)}", None
     
     def _clean_extracted_text(self, text):
-        """Clean and normalize extracted text"""
+        """Clean and normalize extracted text, keeping lines and blank lines between text blocks"""
         if not text:
             return ""
         
-        # Remove extra whitespace and empty lines
-        lines = [line.strip() for line in text.split('\n') if line.strip()]
+        blocks = []
+        for block in re.split(r'\n\s*\n', text):
+            # Remove excessive whitespace within lines and drop empty lines
+            lines = [re.sub(r'[ \t\f\v]+', ' ', line).strip() for line in block.split('\n')]
+            block = '\n'.join(line for line in lines if line)
+            if block:
+                blocks.append(block)
         
-        # Join lines back together
-        cleaned_text = '\n'.join(lines)
-        
-        # Remove excessive whitespace
-        cleaned_text = re.sub(r'\s+', ' ', cleaned_text)
-        
-        return cleaned_text.strip()
+        return '\n\n'.join(blocks)
     
     def process_extracted_text(self, text):
         """Process extracted text to identify ingredients and nutrition sections"""
@@ -166,6 +399,7 @@ First, generate a short, clear **TITLE** summarizing the food item or the main c
                 nutrition_start = text_lower.find('nutrition', start_idx)
                 if nutrition_start != -1 and nutrition_start < end_idx:
                     end_idx = nutrition_start
+                end_idx = self._block_end(text, start_idx, end_idx)
                 
                 ingredients_section = text[start_idx:end_idx].strip()
                 break
@@ -176,29 +410,82 @@ First, generate a short, clear **TITLE** summarizing the food item or the main c
         for keyword in nutrition_keywords:
             if keyword in text_lower:
                 start_idx = text_lower.find(keyword)
-                # Look for the next 400 characters
-                end_idx = start_idx + 400
+                # Look for the next 400 characters, within the text block
+                end_idx = self._block_end(text, start_idx, start_idx + 400)
                 nutrition_section = text[start_idx:end_idx].strip()
                 break
         
         return ingredients_section, nutrition_section
     
-    def analyze_food_label(self, extracted_text, ingredients_section, nutrition_section):
-        """Analyze food label using LangChain"""
+    def tag_ingredients(self, extracted_text, ingredients_section):
+        """Tag allergens, additives and ingredient flags from the knowledge base"""
+        # The nutrition panel ("Sugars 12g") would raise false flags, so prefer the ingredient list
+        return get_ingredient_knowledge().tag(ingredients_section or extracted_text)
+    
+    def _block_end(self, text, start, limit):
+        """End of the OCR text block containing `start`, but no later than `limit`"""
+        end = text.find('\n\n', start)
+        # A heading on its own ("INGREDIENTS:") belongs with the block after it
+        if end != -1 and end - start < 40:
+            end = text.find('\n\n', end + 2)
+        return limit if end == -1 else min(end, limit)
+    
+    def analyze_food_label(self, extracted_text, ingredients_section, nutrition_section, ingredient_tags=None,
+                           output_mode=None, timeout=None):
+        """Analyze food label using LangChain, all generations within `timeout` seconds"""
+        output_mode = output_mode or getattr(settings, 'ANALYSIS_OUTPUT_MODE', 'markdown')
+        started = time.monotonic()
+        
+        def remaining():
+            return None if timeout is None else timeout - (time.monotonic() - started)
+        
         try:
+            if ingredient_tags is None:
+                ingredient_tags = self.tag_ingredients(extracted_text, ingredients_section)
+            
             # Prepare the input
             analysis_input = {
                 "extracted_text": extracted_text or "No text extracted",
                 "ingredients": ingredients_section or "No ingredients section found",
-                "nutrition_info": nutrition_section or "No nutrition information found"
+                "nutrition_info": nutrition_section or "No nutrition information found",
+                "ingredient_hints": format_ingredient_hints(ingredient_tags)
             }
             
             # Run the analysis
-            logger.info("Starting LangChain analysis...")
-            result = self.analysis_chain.run(**analysis_input)
+            logger.info(f"Starting LangChain analysis ({output_mode} output)...")
+            response = None
+            prompt_version = self.prompt_versions[output_mode]
+            if output_mode == 'json':
+                try:
+                    response = self.generate(
+                        'analysis',
+                        self.json_prompt.format(**analysis_input),
+                        format=ANALYSIS_JSON_SCHEMA if getattr(settings, 'ANALYSIS_JSON_SCHEMA', True) else 'json',
+                        num_predict=getattr(settings, 'ANALYSIS_JSON_NUM_PREDICT', 320),
+                        timeout=remaining()
+                    )
+                    parsed_result = self._parse_json_analysis(response.text)
+                except ValueError as e:
+                    # Truncated/invalid JSON, or a server that rejects the format
+                    logger.warning(f"JSON analysis unusable, falling back to markdown: {str(e)}")
+                    response = None
+                    prompt_version = self.prompt_versions['json-fallback']
+            if response is None:
+                output_mode = 'markdown'
+                response = self.generate('analysis', self.prompt.format(**analysis_input), timeout=remaining())
+                parsed_result = self._parse_analysis_result(response.text)
             
-            # Parse the result
-            parsed_result = self._parse_analysis_result(result)
+            parsed_result['model'] = response.model
+            parsed_result['latency_ms'] = response.latency_ms
+            parsed_result['tokens'] = response.tokens
+            parsed_result['output_mode'] = output_mode
+            parsed_result['prompt_version'] = prompt_version
+            
+            if parsed_result['summary'] == "No summary available":
+                try:
+                    parsed_result['summary'] = self.summarize_analysis(response.text, remaining()) or parsed_result['summary']
+                except Exception as e:
+                    logger.warning(f"Could not generate summary: {str(e)}")
             
             logger.info("Analysis completed successfully")
             return parsed_result
@@ -210,9 +497,97 @@ First, generate a short, clear **TITLE** summarizing the food item or the main c
                 'recommendation': 'ERROR',
                 'health_score': 0,
                 'analysis': f"Analysis failed: {str(e)}",
-                'summary': 'Unable to analyze due to an error'
+                'summary': 'Unable to analyze due to an error',
+                'model': None,
+                'latency_ms': None,
+                'tokens': None,
+                'output_mode': output_mode
             }
     
+    def heuristic_assessment(self, ingredients_section, nutrition_section, ingredient_tags=None):
+        """Quick rule-based verdict used when the LLM cannot answer in time"""
+        nutrition = (nutrition_section or '').lower()
+        findings = []
+        score = 8
+        
+        # UK front-of-pack "high"/"medium" thresholds per 100g
+        sugar = self._nutrient_grams(nutrition, r'sugars?')
+        sat_fat = self._nutrient_grams(nutrition, r'saturated(?: fat)?|saturates')
+        fat = self._nutrient_grams(nutrition, r'(?<!saturated )(?:total )?fat')
+        salt = self._nutrient_grams(nutrition, r'salt')
+        sodium = self._nutrient_grams(nutrition, r'sodium')
+        if salt is None and sodium is not None:
+            salt = sodium * 2.5
+        fiber = self._nutrient_grams(nutrition, r'fib(?:re|er)')
+        protein = self._nutrient_grams(nutrition, r'protein')
+        
+        for name, value, high, medium in (
+            ('sugar', sugar, 22.5, 5),
+            ('saturated fat', sat_fat, 5, 1.5),
+            ('salt', salt, 1.5, 0.3),
+            ('fat', fat, 17.5, 3),
+        ):
+            if value is None:
+                continue
+            if value > high:
+                score -= 2
+                findings.append(f"High {name} ({value:g}g)")
+            elif value > medium:
+                score -= 1
+                findings.append(f"Medium {name} ({value:g}g)")
+        if fiber is not None and fiber >= 6:
+            score += 1
+            findings.append(f"High fibre ({fiber:g}g)")
+        if protein is not None and protein >= 10:
+            score += 1
+            findings.append(f"Good protein ({protein:g}g)")
+        
+        if ingredient_tags is None:
+            ingredient_tags = self.tag_ingredients('', ingredients_section)
+        additives = ingredient_tags.get('additives', [])
+        concerning = [a for a in additives if a['concern'] == 'high']
+        if concerning:
+            score -= 1
+            findings.append("Additives of concern: " + ", ".join(f"{a['code']} {a['name']}" for a in concerning))
+        elif len(additives) >= 3:
+            score -= 1
+            findings.append(f"{len(additives)} additives (E-numbers)")
+        flags = {flag['flag'] for flag in ingredient_tags.get('flags', [])}
+        if 'hydrogenated_fat' in flags:
+            score -= 1
+            findings.append("Hydrogenated fat (possible trans fat)")
+        
+        if not findings and not nutrition:
+            score = 5
+        # Allergens inform the reader but don't move the score
+        if ingredient_tags.get('allergens'):
+            findings.append("Allergens: " + ", ".join(a['name'] for a in ingredient_tags['allergens']))
+        score = max(1, min(10, score))
+        recommendation = 'EAT' if score >= 7 else 'MODERATE' if score >= 4 else 'AVOID'
+        analysis = '\n'.join(f"- {finding}" for finding in findings) or "- No nutrition values could be read from the label"
+        return {
+            'raw_response': f"**RECOMMENDATION:** [{recommendation}]\n\n**HEALTH SCORE:** {score}\n\n"
+                            f"**QUICK ESTIMATE:**\n{analysis}",
+            'recommendation': recommendation,
+            'health_score': score,
+            'analysis': analysis,
+            'summary': 'Quick estimate from the nutrition values; the full analysis took too long.',
+            'model': None,
+            'latency_ms': None,
+            'tokens': None,
+            'output_mode': None
+        }
+    
+    def _nutrient_grams(self, text, name_pattern):
+        """Find a nutrient amount in grams (converting mg) in nutrition text"""
+        match = re.search(
+            rf'(?:{name_pattern})[^0-9\n]{{0,20}}?(\d+(?:[.,]\d+)?)\s*(mg|g)\b', text
+        )
+        if not match:
+            return None
+        value = float(match.group(1).replace(',', '.'))
+        return value / 1000 if match.group(2) == 'mg' else value
+    
     def _parse_analysis_result(self, result):
         """Parse the LLM analysis result"""
         try:
@@ -224,8 +599,10 @@ First, generate a short, clear **TITLE** summarizing the food item or the main c
             score_match = re.search(r'\*\*HEALTH SCORE:\*\*\s*(\d+)', result, re.IGNORECASE)
             health_score = int(score_match.group(1)) if score_match else 5
             
-            # Extract analysis section
-            analysis_match = re.search(r'\*\*ANALYSIS:\*\*(.*?)\*\*SUMMARY:\*\*', result, re.DOTALL | re.IGNORECASE)
+            # Extract analysis section (everything from DETAILED ANALYSIS up to SUMMARY)
+            analysis_match = re.search(
+                r'\*\*(?:DETAILED\s+)?ANALYSIS:\*\*(.*?)(?:\*\*SUMMARY:\*\*|\Z)', result, re.DOTALL | re.IGNORECASE
+            )
             analysis = analysis_match.group(1).strip() if analysis_match else "No detailed analysis available"
             
             # Extract summary
@@ -250,6 +627,41 @@ First, generate a short, clear **TITLE** summarizing the food item or the main c
                 'summary': 'Analysis completed but parsing failed'
             }
 
+    def _parse_json_analysis(self, result):
+        """Strictly parse a JSON-mode analysis; raises ValueError if it doesn't match the schema"""
+        data = json.loads(result)  # JSONDecodeError is a ValueError
+        if not isinstance(data, dict):
+            raise ValueError("Analysis is not a JSON object")
+        recommendation = str(data.get('recommendation', '')).strip().upper()
+        if recommendation not in RECOMMENDATIONS:
+            raise ValueError(f"Invalid recommendation: {data.get('recommendation')!r}")
+        health_score = data.get('health_score')
+        if isinstance(health_score, bool) or not isinstance(health_score, int) or not 1 <= health_score <= 10:
+            raise ValueError(f"Invalid health score: {health_score!r}")
+        concerns = data.get('concerns')
+        if not isinstance(concerns, list) or not all(isinstance(c, str) for c in concerns):
+            raise ValueError("Concerns must be a list of strings")
+        advice, summary = data.get('advice'), data.get('summary')
+        if not isinstance(advice, str) or not isinstance(summary, str) or not summary.strip():
+            raise ValueError("Advice and summary must be strings")
+        
+        # Store it in the markdown layout the frontend, chat prompt and reuse path read
+        analysis = '\n'.join(f"- {concern.strip()}" for concern in concerns if concern.strip()) or "- No major concerns"
+        raw_response = (
+            f"**RECOMMENDATION:** [{recommendation}]\n\n"
+            f"**HEALTH SCORE:** {health_score}\n\n"
+            f"**DETAILED ANALYSIS:**\n{analysis}\n\n"
+            f"**PRACTICAL ADVICE:** {advice.strip()}\n\n"
+            f"**SUMMARY:** {summary.strip()}"
+        )
+        return {
+            'raw_response': raw_response,
+            'recommendation': recommendation,
+            'health_score': health_score,
+            'analysis': analysis,
+            'summary': summary.strip()
+        }
+
 # Global service instance
 _food_analyzer_service = None
 
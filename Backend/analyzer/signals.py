@@ -0,0 +1,79 @@
+import logging
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from .models import FoodAnalysis, Chat, Message, SearchDocument
+from . import chat_cache, search, similarity
+
+logger = logging.getLogger(__name__)
+
+
+@receiver(post_delete, sender=FoodAnalysis)
+def release_label_image(sender, instance, **kwargs):
+    """Drop the deleted analysis' reference on its stored label image.
+
+    Runs inside the deleting transaction; the image's files are only removed
+    once it commits.
+    """
+    if not instance.label_image_id:
+        return
+    from .storage import get_label_image_store
+    try:
+        get_label_image_store().release(instance.label_image_id)
+    except Exception as e:
+        logger.error(f"Failed to release label image {instance.label_image_id}: {str(e)}")
+
+
+@receiver(post_save, sender=FoodAnalysis)
+def index_analysis(sender, instance, **kwargs):
+    """Keep the analysis' full-text search entry current"""
+    search.index_analysis(instance)
+
+
+@receiver(post_delete, sender=FoodAnalysis)
+def unindex_analysis(sender, instance, **kwargs):
+    search.remove_document('analysis', instance.id)
+    similarity.forget_analysis(instance.id)
+
+
+@receiver(post_save, sender=FoodAnalysis)
+def remember_label(sender, instance, **kwargs):
+    """Make completed analyses available to the near-duplicate cache"""
+    similarity.remember_analysis(instance)
+
+
+@receiver(post_save, sender=Message)
+def index_message(sender, instance, **kwargs):
+    """Keep the message's full-text search entry current"""
+    search.index_message(instance)
+
+
+@receiver(post_delete, sender=Message)
+def unindex_message(sender, instance, **kwargs):
+    search.remove_document('message', instance.id)
+
+
+@receiver(post_save, sender=Chat)
+def retitle_chat_documents(sender, instance, created, **kwargs):
+    """Chat titles are indexed with their messages; follow renames"""
+    if not created:
+        SearchDocument.objects.filter(chat=instance).exclude(title=instance.title[:255]).update(
+            title=instance.title[:255]
+        )
+
+
+@receiver(post_save, sender=Chat)
+@receiver(post_delete, sender=Chat)
+def invalidate_chat_responses(sender, instance, **kwargs):
+    """Drop this process' cached chat responses a write made stale"""
+    chat_cache.invalidate(chat_id=instance.id, user_id=instance.user_id)
+
+
+@receiver(post_save, sender=Message)
+@receiver(post_delete, sender=Message)
+def invalidate_message_responses(sender, instance, **kwargs):
+    """Drop this process' cached chat responses a write made stale"""
+    # Only look the owner up when the chat is already loaded; the ETag check
+    # catches the chat list change anyway
+    chat_field = Message._meta.get_field('chat')
+    user_id = instance.chat.user_id if chat_field.is_cached(instance) else None
+    chat_cache.invalidate(chat_id=instance.chat_id, user_id=user_id)
@@ -0,0 +1,207 @@
+import logging
+import re
+import threading
+import time
+import zlib
+from datetime import timedelta
+import numpy as np
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+NUM_PERMUTATIONS = 64
+LSH_BANDS = 16  # 16 bands x 4 rows: pairs above ~0.6 similarity nearly always share a band
+SHINGLE_SIZE = 5  # Character shingles tolerate OCR noise better than word shingles
+MIN_TEXT_LENGTH = 40  # Shorter texts match too easily to be trusted
+BRUTE_FORCE_LIMIT = 5000  # Below this many rows a full vectorized scan beats LSH
+SYNC_OVERLAP = timedelta(minutes=10)  # Re-read recent rows other workers may have added
+
+# Finished LLM analyses other uploads of the label may reuse: not copies, not
+# still running, and not a failed generation stored as its error message
+REUSABLE = Q(status='COMPLETE', reused_from__isnull=True) & ~Q(analysis_result='') & ~Q(analysis_result__startswith='Error')
+
+_PRIME = np.uint64(4294967311)  # Smallest prime above 2**32
+_rng = np.random.RandomState(20240601)
+_PERM_A = _rng.randint(1, 2 ** 32 - 1, size=NUM_PERMUTATIONS, dtype=np.uint64)
+_PERM_B = _rng.randint(0, 2 ** 32 - 1, size=NUM_PERMUTATIONS, dtype=np.uint64)
+
+
+def normalize_label_text(ingredients_text, nutrition_text, extracted_text=''):
+    """Lower-case alphanumeric text of the label sections used for matching"""
+    text = f"{ingredients_text or ''} {nutrition_text or ''}"
+    if len(text.strip()) < MIN_TEXT_LENGTH:
+        text = extracted_text or text
+    return re.sub(r'[^a-z0-9]+', ' ', text.lower()).strip()
+
+
+def label_signature(text):
+    """MinHash signature (uint32 array) of normalized text, or None if too short"""
+    if len(text) < MIN_TEXT_LENGTH:
+        return None
+    shingles = {text[i:i + SHINGLE_SIZE] for i in range(len(text) - SHINGLE_SIZE + 1)}
+    hashes = np.fromiter(
+        (zlib.crc32(shingle.encode('utf-8')) for shingle in shingles),
+        dtype=np.uint64, count=len(shingles)
+    )
+    # (a * x + b) mod p for every permutation and shingle at once; a, x < 2**32 cannot overflow
+    permuted = (np.outer(hashes, _PERM_A) + _PERM_B) % _PRIME
+    return (permuted.min(axis=0) & np.uint64(0xFFFFFFFF)).astype(np.uint32)
+
+
+class LabelSimilarityIndex:
+    """In-memory MinHash index of analyzed labels with LSH candidate buckets"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ids = []
+        self._positions = {}
+        self._signatures = np.empty((0, NUM_PERMUTATIONS), dtype=np.uint32)
+        self._alive = np.empty(0, dtype=bool)
+        self._size = 0
+        self._buckets = [dict() for _ in range(LSH_BANDS)]
+        self._rows_per_band = NUM_PERMUTATIONS // LSH_BANDS
+        self._synced_at = None
+        self._last_sync = 0.0
+
+    def __len__(self):
+        return len(self._positions)
+
+    def add(self, analysis_id, signature):
+        analysis_id = str(analysis_id)
+        with self._lock:
+            if analysis_id in self._positions or signature is None:
+                return
+            if self._size == len(self._signatures):
+                # Grow geometrically so bulk loads stay linear
+                capacity = max(1024, self._size * 2)
+                grown = np.empty((capacity, NUM_PERMUTATIONS), dtype=np.uint32)
+                grown[:self._size] = self._signatures[:self._size]
+                alive = np.zeros(capacity, dtype=bool)
+                alive[:self._size] = self._alive[:self._size]
+                self._signatures, self._alive = grown, alive
+            row = self._size
+            self._signatures[row] = signature
+            self._alive[row] = True
+            self._ids.append(analysis_id)
+            self._positions[analysis_id] = row
+            self._size += 1
+            for band, key in enumerate(self._band_keys(signature)):
+                self._buckets[band].setdefault(key, []).append(row)
+
+    def remove(self, analysis_id):
+        with self._lock:
+            row = self._positions.pop(str(analysis_id), None)
+            if row is not None:
+                self._alive[row] = False
+
+    def query(self, signature, threshold):
+        """Return (analysis_id, similarity) of the closest label at or above threshold"""
+        if signature is None:
+            return None
+        with self._lock:
+            if self._size <= BRUTE_FORCE_LIMIT:
+                rows = np.flatnonzero(self._alive[:self._size])
+            else:
+                candidates = set()
+                for band, key in enumerate(self._band_keys(signature)):
+                    candidates.update(self._buckets[band].get(key, ()))
+                rows = np.fromiter(candidates, dtype=np.int64, count=len(candidates))
+                rows = rows[self._alive[rows]] if len(rows) else rows
+            if not len(rows):
+                return None
+            # Fraction of equal MinHash values estimates Jaccard similarity
+            similarities = (self._signatures[rows] == signature).mean(axis=1)
+            best = int(similarities.argmax())
+            if similarities[best] < threshold:
+                return None
+            return self._ids[rows[best]], float(similarities[best])
+
+    def _band_keys(self, signature):
+        rows = self._rows_per_band
+        return [signature[i * rows:(i + 1) * rows].tobytes() for i in range(LSH_BANDS)]
+
+    def sync(self, force=False):
+        """Load signatures stored since the last sync (all of them the first time)"""
+        interval = getattr(settings, 'NEAR_DUPLICATE_SYNC_SECONDS', 30)
+        if not force and time.monotonic() - self._last_sync < interval:
+            return
+        from .models import FoodAnalysis
+
+        started = time.monotonic()
+        queryset = FoodAnalysis.objects.filter(REUSABLE, label_signature__isnull=False)
+        if self._synced_at is not None:
+            queryset = queryset.filter(created_at__gte=self._synced_at - SYNC_OVERLAP)
+        synced_at = timezone.now()
+        loaded = 0
+        for analysis_id, signature in queryset.values_list('id', 'label_signature').iterator(chunk_size=2000):
+            self.add(analysis_id, np.frombuffer(bytes(signature), dtype=np.uint32))
+            loaded += 1
+        if self._synced_at is None:
+            logger.info(f"Built label similarity index from {loaded} analyses in "
+                        f"{time.monotonic() - started:.2f}s")
+        self._synced_at = synced_at
+        self._last_sync = time.monotonic()
+
+
+_similarity_index = None
+_similarity_index_lock = threading.Lock()
+
+
+def get_similarity_index(build=True):
+    """Get the process-wide similarity index, loading it from the database on first use.
+
+    With build=False, returns the index only if this process already loaded it.
+    """
+    global _similarity_index
+    with _similarity_index_lock:
+        if _similarity_index is None:
+            if not build:
+                return None
+            _similarity_index = LabelSimilarityIndex()
+        index = _similarity_index
+    if build:
+        index.sync()
+    return index
+
+
+def find_similar_analysis(signature, exclude_id=None):
+    """Return (FoodAnalysis, similarity) for a completed near-duplicate label, or None"""
+    from .models import FoodAnalysis
+
+    if signature is None:
+        return None
+    threshold = getattr(settings, 'NEAR_DUPLICATE_THRESHOLD', 0.8)
+    match = get_similarity_index().query(signature, threshold)
+    if match is None or match[0] == str(exclude_id):
+        return None
+    analysis_id, similarity = match
+    source = FoodAnalysis.objects.filter(REUSABLE, id=analysis_id).first()
+    if source is None:
+        get_similarity_index(build=False).remove(analysis_id)
+        return None
+    return source, similarity
+
+
+def is_reusable(analysis):
+    """Whether an analysis matches REUSABLE"""
+    return (
+        analysis.status == 'COMPLETE' and not analysis.reused_from_id
+        and bool(analysis.analysis_result) and not analysis.analysis_result.startswith('Error')
+    )
+
+
+def remember_analysis(analysis):
+    """Add a completed, freshly analyzed label to this process' index if loaded"""
+    index = get_similarity_index(build=False)
+    if index is None or not is_reusable(analysis):
+        return
+    if analysis.label_signature:
+        index.add(analysis.id, np.frombuffer(bytes(analysis.label_signature), dtype=np.uint32))
+
+
+def forget_analysis(analysis_id):
+    index = get_similarity_index(build=False)
+    if index is not None:
+        index.remove(analysis_id)
@@ -0,0 +1,171 @@
+import hashlib
+import io
+import logging
+from PIL import Image, ImageOps
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.db.models import F
+from django.db.models.functions import Greatest
+from .models import LabelImage
+
+logger = logging.getLogger(__name__)
+
+# PIL format name -> file extension used for stored originals
+FORMAT_EXTENSIONS = {
+    'JPEG': 'jpg',
+    'PNG': 'png',
+    'WEBP': 'webp',
+    'GIF': 'gif',
+    'BMP': 'bmp',
+    'TIFF': 'tiff',
+}
+
+
+class LabelImageStore:
+    """Content-addressed store for uploaded label images.
+
+    Files are named by the SHA-256 of the uploaded bytes, so the same photo is
+    kept on disk exactly once no matter how many analyses reference it. Each
+    `FoodAnalysis` holds a reference on its `LabelImage`; the files are removed
+    when the last reference is released.
+    """
+
+    def __init__(self, storage=None):
+        self.storage = storage or default_storage
+        self.keep_original = getattr(settings, 'LABEL_IMAGE_KEEP_ORIGINAL', False)
+        self.max_dimension = getattr(settings, 'LABEL_IMAGE_MAX_DIMENSION', 2048)
+        self.webp_quality = getattr(settings, 'LABEL_IMAGE_WEBP_QUALITY', 85)
+
+    def store(self, uploaded_file, references=1):
+        """Store an uploaded file and take `references` references on it.
+
+        The lookup and the increment share a transaction with the row locked,
+        so a concurrent `release()` cannot delete the image in between. Call
+        it inside the transaction that creates the referencing rows.
+        """
+        data = self._read(uploaded_file)
+        digest = hashlib.sha256(data).hexdigest()
+
+        with transaction.atomic():
+            label_image = LabelImage.objects.select_for_update().filter(sha256=digest).first()
+            if label_image is None or not self.storage.exists(label_image.file.name):
+                label_image = self._create(digest, data, label_image)
+
+            LabelImage.objects.filter(pk=label_image.pk).update(ref_count=F('ref_count') + references)
+            label_image.refresh_from_db(fields=['ref_count'])
+        return label_image
+
+    def release(self, label_image_id, references=1):
+        """Drop references on a stored image and delete it once unreferenced"""
+        with transaction.atomic():
+            LabelImage.objects.filter(pk=label_image_id).update(
+                ref_count=Greatest(F('ref_count') - references, 0)
+            )
+            label_image = LabelImage.objects.select_for_update().filter(pk=label_image_id).first()
+            if label_image is None or label_image.ref_count > 0:
+                return False
+            names = [label_image.file.name, label_image.derivative.name]
+            label_image.delete()
+            # Only unlink once the delete is durable; an outer transaction may still roll back
+            transaction.on_commit(lambda: self._delete_files(label_image.sha256, names))
+        return True
+
+    def _delete_files(self, digest, names):
+        """Remove a released image's files unless it was stored again since"""
+        if LabelImage.objects.filter(sha256=digest).exists():
+            return
+        for name in names:
+            if name and self.storage.exists(name):
+                self.storage.delete(name)
+        logger.info(f"Deleted unreferenced label image {digest}")
+
+    def _read(self, uploaded_file):
+        """Read the whole upload, rewinding first if it was already consumed"""
+        if hasattr(uploaded_file, 'seek'):
+            uploaded_file.seek(0)
+        if hasattr(uploaded_file, 'chunks'):
+            return b''.join(uploaded_file.chunks())
+        return uploaded_file.read()
+
+    def _create(self, digest, data, label_image=None):
+        """Write the files for a new digest and create (or repair) its row"""
+        prefix = f"food_labels/{digest[:2]}"
+        try:
+            with Image.open(io.BytesIO(data)) as img:
+                image_format = img.format or ''
+                derivative = self._transcode(img, image_format)
+        except Exception as e:
+            logger.warning(f"Could not transcode image {digest}: {str(e)}")
+            image_format, derivative = '', None
+
+        content_type = Image.MIME.get(image_format, 'application/octet-stream')
+        if derivative is not None and not self.keep_original:
+            # The derivative is the only copy we keep
+            file_name = self._save(f"{prefix}/{digest}.webp", derivative)
+            derivative_name = ''
+            content_type = 'image/webp'
+            size = len(derivative)
+        else:
+            extension = FORMAT_EXTENSIONS.get(image_format, 'bin')
+            file_name = self._save(f"{prefix}/{digest}.{extension}", data)
+            derivative_name = ''
+            if derivative is not None:
+                derivative_name = self._save(f"{prefix}/{digest}_{self.max_dimension}.webp", derivative)
+            size = len(data)
+
+        defaults = {
+            'file': file_name,
+            'derivative': derivative_name,
+            'content_type': content_type,
+            'size': size,
+        }
+        if label_image is not None:
+            # Row survived but its files were lost; point it at the new copies
+            for field, value in defaults.items():
+                setattr(label_image, field, value)
+            label_image.save(update_fields=list(defaults))
+            return label_image
+
+        label_image, created = LabelImage.objects.get_or_create(sha256=digest, defaults=defaults)
+        if created:
+            logger.info(f"Stored new label image {digest} ({size} bytes)")
+        return label_image
+
+    def _transcode(self, img, image_format):
+        """Return a size-capped WebP encoding of `img`, or None if not worthwhile"""
+        if not self.max_dimension:
+            return None
+        oversized = max(img.size) > self.max_dimension
+        if image_format == 'WEBP' and not oversized:
+            return None
+
+        img = ImageOps.exif_transpose(img)
+        if img.mode not in ('RGB', 'RGBA'):
+            img = img.convert('RGBA' if 'A' in img.getbands() else 'RGB')
+        if oversized:
+            img.thumbnail((self.max_dimension, self.max_dimension), Image.LANCZOS)
+
+        buffer = io.BytesIO()
+        img.save(buffer, format='WEBP', quality=self.webp_quality, method=4)
+        return buffer.getvalue()
+
+    def _save(self, name, data):
+        """Save content under its content-addressed name unless already present"""
+        if self.storage.exists(name):
+            return name
+        saved_name = self.storage.save(name, ContentFile(data))
+        if saved_name != name:
+            # Another request wrote the same content first; keep a single copy
+            self.storage.delete(saved_name)
+        return name
+
+    def path(self, name):
+        """Absolute filesystem path of a stored file"""
+        return self.storage.path(name)
+
+
+def get_label_image_store():
+    """Get a label image store bound to the default storage"""
+    return LabelImageStore()
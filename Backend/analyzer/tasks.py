@@ -0,0 +1,142 @@
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from django.conf import settings
+from django.db import close_old_connections
+
+logger = logging.getLogger(__name__)
+
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+_pending = set()  # Futures of the current pool not yet done
+_lanes = []
+
+
+# Threads beyond the admitted LLM calls, for follow-up work such as chat titles
+SPARE_BACKGROUND_WORKERS = 2
+
+
+def background_workers():
+    """Size of the background pool: BACKGROUND_WORKERS, or one thread per admission slot plus spares.
+
+    Admitted requests keep their slot until their LLM call finishes, so with a
+    thread per slot an admitted call never queues behind another.
+    """
+    configured = getattr(settings, 'BACKGROUND_WORKERS', None)
+    if configured:
+        return configured
+    from .admission import DEFAULT_ADMISSION_CONTROL
+    slots = sum(
+        {**DEFAULT_ADMISSION_CONTROL, **limits}['max_concurrency']
+        for limits in getattr(settings, 'ADMISSION_CONTROL', {}).values()
+    )
+    return slots + SPARE_BACKGROUND_WORKERS
+
+
+def get_background_executor():
+    """Get this process' thread pool for work that outlives a request"""
+    global _executor, _executor_pid
+    with _executor_lock:
+        if _executor is None or _executor_pid != os.getpid():
+            # Threads do not survive fork(), so forked workers need their own pool
+            _pending.clear()
+            _executor = ThreadPoolExecutor(
+                max_workers=background_workers(),
+                thread_name_prefix='analyzer-background',
+            )
+            _executor_pid = os.getpid()
+        return _executor
+
+
+def _background_call(func, *args, **kwargs):
+    close_old_connections()
+    try:
+        return func(*args, **kwargs)
+    except Exception as e:
+        logger.error(f"Background task {func.__name__} failed: {str(e)}", exc_info=True)
+        raise
+    finally:
+        close_old_connections()
+
+
+def run_in_background(func, *args, **kwargs):
+    """Submit `func` to the background pool and return its Future"""
+    future = get_background_executor().submit(_background_call, func, *args, **kwargs)
+    with _executor_lock:
+        _pending.add(future)
+    future.add_done_callback(_discard_pending)
+    return future
+
+
+def _discard_pending(future):
+    with _executor_lock:
+        _pending.discard(future)
+
+
+class BackgroundLane:
+    """A small pool of its own for optional background work.
+
+    Work on a lane never takes a thread from the shared background pool, and
+    submissions beyond `max_pending` (queued plus running) are dropped instead
+    of queued. Each forked process gets its own threads.
+    """
+
+    def __init__(self, name, workers=1, max_pending=8):
+        self.name = name
+        self.workers = workers
+        self.max_pending = max_pending
+        self._executor = None
+        self._pid = None
+        self._pending = 0
+        self._lock = threading.Lock()
+        _lanes.append(self)
+
+    def submit(self, func, *args, **kwargs):
+        """Submit `func` and return its Future, or None if the lane is full"""
+        with self._lock:
+            if self._pid != os.getpid():
+                # Threads do not survive fork(), nor does the work they had
+                self._executor = None
+                self._pending = 0
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix=self.name)
+                self._pid = os.getpid()
+            if self._pending >= self.max_pending:
+                return None
+            self._pending += 1
+            future = self._executor.submit(_background_call, func, *args, **kwargs)
+        future.add_done_callback(self._done)
+        return future
+
+    def _done(self, future):
+        with self._lock:
+            self._pending -= 1
+
+    def shutdown(self):
+        """Drop queued work and let running work finish in its own time"""
+        with self._lock:
+            executor = self._executor if self._pid == os.getpid() else None
+            self._executor = None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+
+def shutdown_background_executor(timeout=None):
+    """Let this process' background work finish, e.g. before a worker exits.
+
+    Waits at most `timeout` seconds (None: until done) and returns the number of
+    tasks still unfinished. Work queued on lanes is optional and dropped.
+    """
+    global _executor
+    for lane in _lanes:
+        lane.shutdown()
+    with _executor_lock:
+        executor = _executor if _executor_pid == os.getpid() else None
+        _executor = None
+        pending = list(_pending) if executor is not None else []
+    if executor is None:
+        return 0
+    executor.shutdown(wait=False)
+    return len(wait(pending, timeout=timeout).not_done)
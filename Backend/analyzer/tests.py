@@ -1,3 +1,1500 @@
-from django.test import TestCase
+import csv
+import gzip
+import io
+import json
+import os
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from concurrent.futures import Future, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.contrib.sessions.backends.db import SessionStore
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import DatabaseError, transaction
+from django.http import JsonResponse
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+from PIL import Image, ImageDraw
+from . import admission, answers, chat_cache
+from .admission import (
+    AdmissionController, AdmissionRejected, RateLimiter, admission_controlled, hold_admission, parse_rate
+)
+from .backends import OllamaBackendPool, OllamaResponseError, is_backend_failure, is_retryable
+from .deadlines import Deadline, DeadlineExceeded
+from .knowledge import DEFAULT_KNOWLEDGE_PATH, AhoCorasick, IngredientKnowledge
+from .models import AnalysisSession, Chat, FoodAnalysis, LabelImage, Message
+from .ocr import PSM_SINGLE_COLUMN, PSM_SINGLE_LINE, PSM_UNIFORM_BLOCK, LabelOCR, detect_text_regions
+from .retention import RetentionJob
+from .routing import ModelRouter
+from .services import FoodAnalyzerService, GenerationTimeout, LLMResponse, get_food_analyzer_service
+from .similarity import LabelSimilarityIndex, find_similar_analysis, label_signature, normalize_label_text
+from .storage import get_label_image_store
+from .tasks import BackgroundLane, run_in_background, shutdown_background_executor
 
-# Create your tests here.
+
+class RateLimiterTests(SimpleTestCase):
+    def setUp(self):
+        self.now = 1000.0
+        patcher = mock.patch('analyzer.admission.time.monotonic', side_effect=lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_parse_rate(self):
+        self.assertEqual(parse_rate('20/m'), (20, 60))
+        self.assertEqual(parse_rate('5/hour'), (5, 3600))
+        self.assertIsNone(parse_rate(''))
+
+    def test_burst_up_to_capacity_then_retry_after(self):
+        limiter = RateLimiter('3/m')
+        self.assertEqual([limiter.hit('a') for _ in range(3)], [0, 0, 0])
+        self.assertAlmostEqual(limiter.hit('a'), 20.0)
+
+    def test_tokens_refill_over_time(self):
+        limiter = RateLimiter('3/m')
+        for _ in range(3):
+            limiter.hit('a')
+        self.now += 20
+        self.assertEqual(limiter.hit('a'), 0)
+        self.assertGreater(limiter.hit('a'), 0)
+
+    def test_keys_have_separate_buckets(self):
+        limiter = RateLimiter('1/m')
+        self.assertEqual(limiter.hit('a'), 0)
+        self.assertGreater(limiter.hit('a'), 0)
+        self.assertEqual(limiter.hit('b'), 0)
+
+    def test_full_buckets_are_pruned(self):
+        limiter = RateLimiter('1/s', max_keys=2)
+        limiter.hit('a')
+        limiter.hit('b')
+        self.now += 5
+        limiter.hit('c')
+        self.assertEqual(set(limiter._buckets), {'c'})
+
+
+class AdmissionControllerTests(SimpleTestCase):
+    def hold_slot(self, controller, release):
+        """Occupy a slot from another thread until `release` is set"""
+        admitted = threading.Event()
+
+        def run():
+            with controller.admit():
+                admitted.set()
+                release.wait(5)
+        thread = threading.Thread(target=run)
+        thread.start()
+        self.assertTrue(admitted.wait(5))
+        return thread
+
+    def test_admits_up_to_max_concurrency(self):
+        controller = AdmissionController('test', max_concurrency=2, max_queue=0, max_wait_seconds=1)
+        with controller.admit(), controller.admit():
+            self.assertEqual(controller.stats(), {'active': 2, 'waiting': 0})
+            with self.assertRaises(AdmissionRejected) as rejected:
+                with controller.admit():
+                    pass
+        self.assertEqual(rejected.exception.reason, 'queue full')
+        self.assertEqual(controller.stats(), {'active': 0, 'waiting': 0})
+
+    def test_queued_request_times_out(self):
+        controller = AdmissionController('test', max_concurrency=1, max_queue=1, max_wait_seconds=10)
+        with controller.admit():
+            started = time.monotonic()
+            with self.assertRaises(AdmissionRejected) as rejected:
+                with controller.admit(max_wait=0.1):
+                    pass
+        self.assertEqual(rejected.exception.reason, 'queue wait timed out')
+        self.assertLess(time.monotonic() - started, 5)
+        self.assertGreaterEqual(rejected.exception.retry_after, 1)
+
+    def test_queued_request_gets_the_freed_slot(self):
+        controller = AdmissionController('test', max_concurrency=1, max_queue=1, max_wait_seconds=5)
+        release = threading.Event()
+        holder = self.hold_slot(controller, release)
+        threading.Timer(0.1, release.set).start()
+        with controller.admit():
+            self.assertEqual(controller.stats()['active'], 1)
+        holder.join()
+
+    def test_rejects_beyond_the_queue(self):
+        controller = AdmissionController('test', max_concurrency=1, max_queue=1, max_wait_seconds=5)
+        release = threading.Event()
+        holder = self.hold_slot(controller, release)
+
+        def wait_for_slot():
+            with controller.admit():
+                pass
+        waiter = threading.Thread(target=wait_for_slot)
+        waiter.start()
+        for _ in range(100):
+            if controller.stats()['waiting']:
+                break
+            time.sleep(0.01)
+        with self.assertRaises(AdmissionRejected) as rejected:
+            with controller.admit():
+                pass
+        self.assertEqual(rejected.exception.reason, 'queue full')
+        release.set()
+        holder.join()
+        waiter.join()
+
+
+@override_settings(
+    RATE_LIMITS={'test': {'per_ip': '1/m'}},
+    ADMISSION_CONTROL={'test': {'max_concurrency': 1, 'max_queue': 0, 'max_wait_seconds': 1}},
+)
+class AdmissionControlledViewTests(TestCase):
+    def setUp(self):
+        admission._controllers.pop('test', None)
+        admission._rate_limiters.pop('test', None)
+        self.addCleanup(admission._controllers.pop, 'test', None)
+        self.addCleanup(admission._rate_limiters.pop, 'test', None)
+
+    def request(self, ip='10.0.0.1'):
+        request = RequestFactory().post('/', REMOTE_ADDR=ip)
+        request.session = SessionStore()
+        return request
+
+    def test_rate_limited_client_gets_429(self):
+        view = admission_controlled('test')(lambda request: JsonResponse({'ok': True}))
+        self.assertEqual(view(self.request()).status_code, 200)
+        response = view(self.request())
+        self.assertEqual(response.status_code, 429)
+        self.assertGreaterEqual(int(response['Retry-After']), 1)
+        self.assertEqual(view(self.request(ip='10.0.0.2')).status_code, 200)
+
+    @override_settings(RATE_LIMITS={})
+    def test_busy_endpoint_sheds_with_503(self):
+        def view_func(request):
+            # A second request arriving while this one holds the only slot
+            return inner(self.request())
+        inner = admission_controlled('test')(lambda request: JsonResponse({'ok': True}))
+        response = admission_controlled('test')(view_func)(self.request())
+        self.assertEqual(response.status_code, 503)
+        self.assertIn('Retry-After', response)
+
+    @override_settings(RATE_LIMITS={})
+    def test_slot_is_held_until_abandoned_work_finishes(self):
+        future = Future()
+
+        def view_func(request):
+            hold_admission(request, future)
+            return JsonResponse({'degraded': True})
+        self.assertEqual(admission_controlled('test')(view_func)(self.request()).status_code, 200)
+        controller = admission.get_admission_controller('test')
+        self.assertEqual(controller.stats()['active'], 1)
+        future.set_result(None)
+        self.assertEqual(controller.stats()['active'], 0)
+
+
+class TextRegionTests(SimpleTestCase):
+    """XY-cut on synthetic labels drawn with Pillow's built-in font (about 11 px tall)"""
+
+    def label(self, size=(800, 600)):
+        image = Image.new('L', size, 255)
+        return image, ImageDraw.Draw(image)
+
+    def test_two_columns_read_column_by_column(self):
+        image, draw = self.label()
+        for i in range(8):
+            draw.text((40, 50 + 16 * i), "Sugar, wheat flour, palm oil, salt", fill=0)
+        # Lines offset from the left column's, so not one table
+        for i in range(5):
+            draw.text((440, 58 + 16 * i), "Energy 1850 kJ", fill=0)
+        regions, scale = detect_text_regions(image)
+        self.assertEqual(scale, 1.0)
+        self.assertEqual(len(regions), 2)
+        (left, _, right, _, psm), (second_left, *_, second_psm) = regions
+        self.assertLess(right, 440)
+        self.assertGreaterEqual(second_left, 400)
+        self.assertEqual((psm, second_psm), (PSM_SINGLE_COLUMN, PSM_SINGLE_COLUMN))
+
+    def test_table_columns_stay_together(self):
+        image, draw = self.label()
+        for i in range(6):
+            draw.text((40, 50 + 16 * i), "Energy per 100g", fill=0)
+            draw.text((440, 50 + 16 * i), "1850 kJ 440 kcal", fill=0)
+        regions, _ = detect_text_regions(image)
+        self.assertEqual(len(regions), 1)
+        left, _, right, _, psm = regions[0]
+        self.assertLess(left, 40)
+        self.assertGreater(right, 440)
+        self.assertEqual(psm, PSM_UNIFORM_BLOCK)
+
+    def test_artwork_is_dropped(self):
+        image, draw = self.label()
+        draw.ellipse((300, 40, 500, 240), fill=0)
+        for i in range(4):
+            draw.text((40, 350 + 16 * i), "Sugar, wheat flour, palm oil, salt", fill=0)
+        regions, _ = detect_text_regions(image)
+        self.assertEqual(len(regions), 1)
+        self.assertGreaterEqual(regions[0][1], 340)
+
+    def test_blocks_separated_by_blank_rows_read_top_down(self):
+        image, draw = self.label()
+        draw.text((40, 40), "Sugar, wheat flour, palm oil, salt", fill=0)
+        for i in range(3):
+            draw.text((40, 300 + 16 * i), "Store in a cool dry place", fill=0)
+        regions, _ = detect_text_regions(image)
+        self.assertEqual([region[4] for region in regions], [PSM_SINGLE_LINE, PSM_SINGLE_COLUMN])
+        self.assertLess(regions[0][3], regions[1][1])
+
+    def test_large_images_are_downscaled_and_mapped_back(self):
+        image, draw = self.label((3000, 2000))
+        for i in range(6):
+            draw.text((300, 300 + 16 * i), "Sugar, wheat flour, palm oil, salt", fill=0)
+        _, scale = detect_text_regions(image)
+        self.assertEqual(scale, 3.0)
+        with override_settings(OCR_REGION_PADDING=0):
+            regions = LabelOCR().regions(image.convert('RGB'))
+        self.assertEqual(len(regions), 1)
+        left, top, _, bottom = regions[0].box
+        self.assertLessEqual(left, 300)
+        self.assertLessEqual(top, 300)
+        self.assertGreater(bottom, 380)
+
+    def test_small_images_are_read_whole(self):
+        image, draw = self.label()
+        draw.text((40, 40), "Sugar, wheat flour, palm oil, salt", fill=0)
+        self.assertIsNone(LabelOCR().regions(image))
+
+
+class OCRDeadlineTests(SimpleTestCase):
+    def setUp(self):
+        self.image = Image.new('RGB', (200, 50), 'white')
+        self.ocr = LabelOCR()
+        data = {'text': ['Sugar'], 'conf': ['40'], 'block_num': [1], 'par_num': [1], 'line_num': [1]}
+        patcher = mock.patch('analyzer.ocr.pytesseract.image_to_data', return_value=data)
+        self.image_to_data = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_low_confidence_gets_extra_passes_without_a_deadline(self):
+        self.assertEqual(self.ocr.recognize_adaptive(self.image, 6).passes, self.ocr.max_passes)
+
+    def test_extra_passes_stop_at_the_reserve(self):
+        result = self.ocr.recognize_adaptive(self.image, 6, Deadline(5), reserve=10)
+        self.assertEqual(result.passes, 1)
+        self.assertAlmostEqual(self.image_to_data.call_args.kwargs['timeout'], 5, delta=1)
+
+    def test_expired_deadline_raises(self):
+        deadline = Deadline(0.01)
+        time.sleep(0.02)
+        with self.assertRaises(DeadlineExceeded):
+            self.ocr.read(self.image, deadline)
+        self.image_to_data.assert_not_called()
+
+    def test_killed_tesseract_raises_deadline_exceeded(self):
+        deadline = Deadline(0.05)
+
+        def slow_tesseract(*args, **kwargs):
+            time.sleep(0.1)
+            raise RuntimeError('Tesseract process timeout')
+        self.image_to_data.side_effect = slow_tesseract
+        with self.assertRaises(DeadlineExceeded):
+            self.ocr.read(self.image, deadline)
+
+
+class StubOllama:
+    """Local Ollama node: answers health checks and streams one reply per generation"""
+
+    def __init__(self, reply='OK'):
+        self.reply = reply
+        self.status = 200  # Status of /api/generate, e.g. 404 for a model missing on this node
+        self.tags_status = 200
+        self.models = []  # Names listed by /api/tags
+        self.chunk_delay = 0  # Seconds between streamed tokens
+        self.generations = 0
+        self.disconnected = threading.Event()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def send_json(self, status, *lines):
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/x-ndjson')
+                self.end_headers()
+                for line in lines:
+                    self.wfile.write((json.dumps(line) + '\n').encode())
+
+            def do_GET(self):
+                self.send_json(stub.tags_status, {'models': [{'name': name} for name in stub.models]})
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers['Content-Length']))
+                stub.generations += 1
+                if stub.status != 200:
+                    error = 'model not found' if stub.status == 404 else 'server error'
+                    return self.send_json(stub.status, {'error': error})
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/x-ndjson')
+                self.end_headers()
+                try:
+                    for i, word in enumerate(stub.reply.split(' ')):
+                        time.sleep(stub.chunk_delay)
+                        token = word if i == 0 else ' ' + word
+                        self.wfile.write((json.dumps({'response': token, 'done': False}) + '\n').encode())
+                        self.wfile.flush()
+                    self.wfile.write((json.dumps({'response': '', 'done': True, 'eval_count': 1}) + '\n').encode())
+                except (BrokenPipeError, ConnectionResetError):
+                    stub.disconnected.set()
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_port}"
+        threading.Thread(target=self.server.serve_forever, args=(0.05,), daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class OllamaBackendPoolTests(SimpleTestCase):
+    def setUp(self):
+        self.nodes = [StubOllama('from a'), StubOllama('from b')]
+        for node in self.nodes:
+            self.addCleanup(node.close)
+
+    def service(self, urls=None):
+        with override_settings(
+            OLLAMA_BACKENDS=urls or [node.url for node in self.nodes],
+            OLLAMA_HEALTH_CHECK_INTERVAL=0,
+            OLLAMA_MAX_QUEUE_DEPTH=None,
+        ):
+            return FoodAnalyzerService()
+
+    def backend(self, service, node):
+        return next(backend for backend in service.pool.backends if backend.url == node.url)
+
+    def test_timeout_bounds_a_streaming_generation(self):
+        self.nodes[0].reply = ' '.join(['word'] * 50)
+        self.nodes[0].chunk_delay = 0.05
+        service = self.service([self.nodes[0].url])
+        started = time.monotonic()
+        with self.assertRaises(GenerationTimeout):
+            service.generate('chat', 'hi', timeout=0.5)
+        self.assertLess(time.monotonic() - started, 1.5)
+        # The stream is closed, so the node stops generating, and the node is not blamed
+        self.assertTrue(self.nodes[0].disconnected.wait(2))
+        self.assertTrue(service.pool.backends[0].healthy)
+        self.assertEqual(service.pool.backends[0].failures, 0)
+
+    def test_error_response_retries_on_another_node(self):
+        self.nodes[0].status = 404
+        service = self.service()
+        for _ in range(5):
+            self.assertEqual(service.generate('chat', 'hi').text, 'from b')
+        # A model missing on one node is not the node failing: it keeps serving other models
+        self.assertTrue(self.backend(service, self.nodes[0]).healthy)
+        self.assertEqual(self.backend(service, self.nodes[0]).failures, 0)
+        self.assertEqual(self.backend(service, self.nodes[1]).failures, 0)
+
+    def test_missing_model_everywhere_raises_without_ejecting(self):
+        for node in self.nodes:
+            node.status = 404
+        service = self.service()
+        for _ in range(4):
+            with self.assertRaises(OllamaResponseError) as raised:
+                service.generate('title', 'hi')
+            self.assertEqual(raised.exception.status, 404)
+        self.assertEqual([backend.healthy for backend in service.pool.backends], [True, True])
+        for node in self.nodes:
+            node.status = 200
+        self.assertIn(service.generate('chat', 'hi').text, ('from a', 'from b'))
+
+    def test_other_client_errors_are_not_retried(self):
+        self.nodes[0].status = 400
+        service = self.service([self.nodes[0].url])
+        with self.assertRaises(OllamaResponseError):
+            service.generate('chat', 'hi')
+        self.assertEqual(self.nodes[0].generations, 1)
+        self.assertEqual(service.pool.backends[0].failures, 0)
+        self.assertFalse(is_retryable(OllamaResponseError(400, 'invalid format')))
+        self.assertTrue(is_retryable(OllamaResponseError(500, "model 'x' not found, try pulling it first")))
+        self.assertFalse(is_backend_failure(OllamaResponseError(500, "model 'x' not found, try pulling it first")))
+        self.assertTrue(is_backend_failure(OllamaResponseError(503, 'overloaded')))
+
+    def test_failing_node_is_ejected(self):
+        self.nodes[0].status = 500
+        service = self.service()
+        for _ in range(5):
+            self.assertEqual(service.generate('chat', 'hi').text, 'from b')
+        self.assertFalse(self.backend(service, self.nodes[0]).healthy)
+        self.assertEqual(self.nodes[0].generations, 3)
+
+    def test_unreachable_node_is_ejected(self):
+        closed = StubOllama()
+        closed.close()
+        service = self.service([closed.url, self.nodes[1].url])
+        for _ in range(3):
+            self.assertEqual(service.generate('chat', 'hi').text, 'from b')
+        self.assertFalse(service.pool.backends[0].healthy)
+
+    def test_error_is_raised_when_every_node_fails(self):
+        for node in self.nodes:
+            node.status = 500
+        service = self.service()
+        with self.assertRaises(ValueError):
+            service.generate('chat', 'hi')
+        self.assertEqual([backend.failures for backend in service.pool.backends], [1, 1])
+
+    def test_ejected_node_recovers_after_health_check(self):
+        self.nodes[0].status = 500
+        service = self.service()
+        for _ in range(3):
+            service.generate('chat', 'hi')
+        self.assertFalse(self.backend(service, self.nodes[0]).healthy)
+
+        self.nodes[0].status = 200
+        self.assertEqual(service.pool.check_all(), {node.url: True for node in self.nodes})
+        self.assertTrue(self.backend(service, self.nodes[0]).healthy)
+
+    def test_failed_health_check_ejects(self):
+        self.nodes[0].tags_status = 500
+        pool = OllamaBackendPool([node.url for node in self.nodes], health_check_interval=0)
+        self.assertFalse(pool.check(pool.backends[0]))
+        self.assertEqual([backend.healthy for backend in pool.backends], [False, True])
+
+    def test_request_errors_do_not_count_against_the_node(self):
+        pool = OllamaBackendPool([self.nodes[0].url], health_check_interval=0)
+        with self.assertRaises(KeyError):
+            with pool.use():
+                raise KeyError('prompt variable')
+        self.assertEqual(pool.backends[0].failures, 0)
+        self.assertEqual(pool.backends[0].inflight, 0)
+
+    def test_least_loaded_node_is_chosen(self):
+        pool = OllamaBackendPool(['http://a', 'http://b', 'http://c'], health_check_interval=0)
+        a, b, c = pool.backends
+        a.avg_latency, b.avg_latency, c.avg_latency = 2.0, 1.0, 0.5
+        with pool.use() as first:
+            self.assertIs(first, c)
+            with pool.use() as second:
+                self.assertIs(second, b)
+                with pool.use() as third:
+                    self.assertIs(third, a)
+                    self.assertEqual([backend.inflight for backend in pool.backends], [1, 1, 1])
+        with pool.use(exclude=[c.url]) as backend:
+            self.assertIs(backend, b)
+
+
+class ModelRouterTests(SimpleTestCase):
+    def router(self, **kwargs):
+        options = {'default_model': 'big', 'fallbacks': {'big': 'small'}, 'max_queue_depth': 2}
+        options.update(kwargs)
+        return ModelRouter(**options)
+
+    def test_tasks_without_a_route_use_the_default_model(self):
+        router = self.router(routes={'title': 'small'})
+        self.assertEqual(router.choose('title'), 'small')
+        self.assertEqual(router.choose('chat'), 'big')
+
+    def test_default_settings_route_every_task_to_the_configured_model(self):
+        with override_settings(OLLAMA_HEALTH_CHECK_INTERVAL=0):
+            service = FoodAnalyzerService()
+        for task in ('analysis', 'chat', 'title', 'summary'):
+            self.assertEqual(service.router.choose(task), service.model_name)
+
+    def test_downgrades_at_max_queue_depth(self):
+        router = self.router()
+        with router.track('big'):
+            self.assertEqual(router.choose('chat'), 'big')
+            with router.track('big'):
+                self.assertEqual(router.choose('chat'), 'small')
+        self.assertEqual(router.choose('chat'), 'big')
+
+    def test_downgrades_when_projected_wait_exceeds_slo(self):
+        router = self.router(slo_seconds={'chat': 30, 'analysis': 90}, max_queue_depth=None)
+        with mock.patch('analyzer.routing.time.monotonic', side_effect=[0, 20]):
+            with router.track('big'):
+                pass
+        self.assertEqual(router.choose('chat'), 'big')
+        with router.track('big'):
+            # One queued 20s generation plus this one is 40s: over the chat SLO, within the analysis SLO
+            self.assertEqual(router.choose('chat'), 'small')
+            self.assertEqual(router.choose('analysis'), 'big')
+
+    def test_does_not_downgrade_to_an_unreported_model(self):
+        for available in (None, False):
+            router = self.router(max_queue_depth=1, model_available=lambda model: available)
+            with router.track('big'):
+                self.assertEqual(router.choose('chat'), 'big')
+        router = self.router(max_queue_depth=1, model_available=lambda model: True)
+        with router.track('big'):
+            self.assertEqual(router.choose('chat'), 'small')
+
+    def test_route_to_a_missing_model_uses_the_default(self):
+        router = self.router(routes={'title': 'tiny'}, model_available=lambda model: model != 'tiny')
+        self.assertEqual(router.choose('title'), 'big')
+        # Unknown until a health check reports the node's models
+        router = self.router(routes={'title': 'tiny'}, model_available=lambda model: None)
+        self.assertEqual(router.choose('title'), 'tiny')
+
+    def test_pool_reports_models_from_health_checks(self):
+        node = StubOllama()
+        self.addCleanup(node.close)
+        node.models = ['llama3.2:latest', 'llama3.2:1b']
+        pool = OllamaBackendPool([node.url], health_check_interval=0)
+        self.assertIsNone(pool.has_model('llama3.2:1b'))
+        pool.check_all()
+        self.assertTrue(pool.has_model('llama3.2'))
+        self.assertTrue(pool.has_model('llama3.2:1b'))
+        self.assertFalse(pool.has_model('mistral'))
+
+
+ANALYSIS_JSON = {
+    'recommendation': 'moderate',
+    'health_score': 6,
+    'concerns': ['High sugar', '  ', 'Palm oil'],
+    'advice': ' Keep it to an occasional snack. ',
+    'summary': ' Tasty but sugary. ',
+}
+
+
+class JSONAnalysisParsingTests(SimpleTestCase):
+    def setUp(self):
+        self.service = get_food_analyzer_service()
+
+    def parse(self, **changes):
+        return self.service._parse_json_analysis(json.dumps({**ANALYSIS_JSON, **changes}))
+
+    def test_valid_analysis_is_stored_in_the_markdown_layout(self):
+        result = self.parse()
+        self.assertEqual(result['recommendation'], 'MODERATE')
+        self.assertEqual(result['health_score'], 6)
+        self.assertEqual(result['analysis'], "- High sugar\n- Palm oil")
+        self.assertEqual(result['summary'], "Tasty but sugary.")
+        self.assertIn("**PRACTICAL ADVICE:** Keep it to an occasional snack.", result['raw_response'])
+
+        reparsed = self.service._parse_analysis_result(result['raw_response'])
+        for key in ('recommendation', 'health_score', 'summary'):
+            self.assertEqual(reparsed[key], result[key])
+        self.assertIn("- High sugar", reparsed['analysis'])
+
+    def test_no_concerns(self):
+        self.assertEqual(self.parse(concerns=[])['analysis'], "- No major concerns")
+
+    def test_invalid_analyses_are_rejected(self):
+        for changes in [
+            {'recommendation': 'MAYBE'},
+            {'recommendation': None},
+            {'health_score': 0},
+            {'health_score': 11},
+            {'health_score': '7'},
+            {'health_score': 7.5},
+            {'health_score': True},
+            {'concerns': 'High sugar'},
+            {'concerns': ['High sugar', 3]},
+            {'advice': None},
+            {'summary': '  '},
+        ]:
+            with self.subTest(changes), self.assertRaises(ValueError):
+                self.parse(**changes)
+        for text in ('{"recommendation": "EAT", "health_sc', '["EAT", 8]', 'EAT'):
+            with self.subTest(text), self.assertRaises(ValueError):
+                self.service._parse_json_analysis(text)
+
+    def test_unusable_json_falls_back_to_markdown(self):
+        markdown = (
+            "**RECOMMENDATION:** [AVOID]\n\n**HEALTH SCORE:** 2\n\n**DETAILED ANALYSIS:**\n- Mostly sugar\n\n"
+            "**SUMMARY:** Sugar with a little flour."
+        )
+        responses = [
+            LLMResponse('{"recommendation": "AVOID", "health_sc', 'm', 10, 5),
+            LLMResponse(markdown, 'm', 10, 5),
+        ]
+        with mock.patch.object(self.service, 'generate', side_effect=responses) as generate:
+            result = self.service.analyze_food_label(LABEL_TEXT, LABEL_TEXT, '', {}, output_mode='json')
+        self.assertEqual(generate.call_count, 2)
+        self.assertIsNotNone(generate.call_args_list[0].kwargs['format'])
+        self.assertNotIn('format', generate.call_args_list[1].kwargs)
+        self.assertEqual(result['output_mode'], 'markdown')
+        self.assertEqual(result['recommendation'], 'AVOID')
+        self.assertEqual(result['health_score'], 2)
+        # Marked as the JSON mode's fallback, so reanalyze treats it as current in JSON mode only
+        self.assertEqual(result['prompt_version'], self.service.prompt_versions['json-fallback'])
+        self.assertIn(result['prompt_version'], self.service.current_prompt_versions('json'))
+        self.assertNotIn(result['prompt_version'], self.service.current_prompt_versions('markdown'))
+
+
+class ChatAnswerCacheTests(SimpleTestCase):
+    def setUp(self):
+        self.analysis = FoodAnalysis(analysis_result="**RECOMMENDATION:** [MODERATE]", extracted_text=LABEL_TEXT)
+        self.addCleanup(cache.clear)
+
+    def test_rephrased_questions_share_an_answer(self):
+        answers.cache_answer(self.analysis, "Is this safe for diabetics?", "In moderation.")
+        for question in ("is it safe for a diabetic", "Safe for diabetics?", "For diabetics, is this safe?"):
+            with self.subTest(question):
+                self.assertEqual(answers.get_cached_answer(self.analysis, question)['answer'], "In moderation.")
+
+    def test_near_misses_do_not_share_an_answer(self):
+        for cached, asked in [
+            ("Can I eat this with diabetes and high blood pressure?", "Can I eat this with low blood pressure?"),
+            ("How much sugar per serving?", "How much salt per serving?"),
+            ("Is it safe for kids?", "Is it not safe for kids?"),
+            ("Is it vegan?", "Is it vegan and gluten free?"),
+        ]:
+            with self.subTest(asked):
+                answers.cache_answer(self.analysis, cached, "Cached answer")
+                self.assertIsNone(answers.get_cached_answer(self.analysis, asked))
+
+    def test_answers_are_per_analysis_result(self):
+        answers.cache_answer(self.analysis, "Is it vegan?", "Yes.")
+        self.analysis.analysis_result = "**RECOMMENDATION:** [AVOID]"
+        self.assertIsNone(answers.get_cached_answer(self.analysis, "Is it vegan?"))
+
+
+@override_settings(
+    CHAT_ANSWER_PRECOMPUTE_QUESTIONS=["Is it vegan?", "Is it safe for diabetics?"],
+    ADMISSION_CONTROL={'chat': {'max_concurrency': 1, 'max_queue': 2, 'max_wait_seconds': 5}},
+)
+class PrecomputeAnswersTests(SimpleTestCase):
+    def setUp(self):
+        self.analysis = FoodAnalysis(analysis_result="**RECOMMENDATION:** [MODERATE]", extracted_text=LABEL_TEXT)
+        self.addCleanup(cache.clear)
+        admission._controllers.pop('chat', None)
+        self.addCleanup(admission._controllers.pop, 'chat', None)
+        patcher = mock.patch.object(
+            get_food_analyzer_service(), 'generate',
+            return_value=LLMResponse("**TITLE**: Label questions\n---\nIt depends.", 'test', 10, 5)
+        )
+        self.generate = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_answers_are_cached(self):
+        answers.precompute_answers(self.analysis)
+        self.assertEqual(self.generate.call_count, 2)
+        cached = answers.get_cached_answer(self.analysis, "is this vegan")
+        self.assertEqual((cached['answer'], cached['title']), ("It depends.", "Label questions"))
+        self.assertEqual(admission.get_admission_controller('chat').stats()['active'], 0)
+
+    def test_skipped_while_chat_is_busy(self):
+        with admission.get_admission_controller('chat').admit():
+            answers.precompute_answers(self.analysis)
+        self.generate.assert_not_called()
+
+    def test_lane_drops_work_beyond_its_limit(self):
+        lane = BackgroundLane('test-lane', workers=1, max_pending=2)
+        self.addCleanup(lane.shutdown)
+        release = threading.Event()
+        running = [lane.submit(release.wait, 5), lane.submit(release.wait, 5)]
+        self.assertIsNone(lane.submit(release.wait, 5))
+        release.set()
+        for future in running:
+            future.result(timeout=5)
+        self.assertIsNotNone(lane.submit(len, ()))
+
+
+class BackgroundShutdownTests(SimpleTestCase):
+    def test_wait_for_background_work_is_bounded(self):
+        release = threading.Event()
+        self.addCleanup(release.set)
+        finished = run_in_background(time.sleep, 0)
+        stuck = run_in_background(release.wait, 5)
+        finished.result(timeout=5)
+
+        started = time.monotonic()
+        self.assertEqual(shutdown_background_executor(timeout=0.1), 1)
+        self.assertLess(time.monotonic() - started, 2)
+        self.assertFalse(stuck.done())
+        release.set()
+        self.assertTrue(stuck.result(timeout=5))
+
+    def test_lanes_drop_queued_work(self):
+        lane = BackgroundLane('test-lane', workers=1)
+        release = threading.Event()
+        self.addCleanup(release.set)
+        running = lane.submit(release.wait, 5)
+        queued = lane.submit(len, ())
+        self.assertEqual(shutdown_background_executor(timeout=1), 0)
+        self.assertTrue(queued.cancelled())
+        release.set()
+        self.assertTrue(running.result(timeout=5))
+
+
+class SearchScopeTests(TestCase):
+    def setUp(self):
+        session = self.client.session
+        session.save()
+        self.mine = self.analysis('Ingredients: peanut butter, sugar', AnalysisSession.objects.create(
+            session_id=session.session_key, ip_address='127.0.0.1'
+        ))
+        self.chatted = self.analysis('Ingredients: roasted peanut, salt')
+        self.others = self.analysis('Ingredients: peanut oil, flour')
+        user = User.objects.create(username='anon_test')
+        session['user_id'] = user.id
+        session.save()
+        Chat.objects.create(user=user, title='Peanuts', analysis_id=str(self.chatted.id))
+
+    def analysis(self, text, session=None):
+        return FoodAnalysis.objects.create(extracted_text=text, ingredients_text=text, session=session)
+
+    def search(self, **params):
+        return self.client.get('/api/search/', {'q': 'peanut', 'type': 'analysis', **params})
+
+    def found(self, response):
+        return {result['analysis_id'] for result in response.json()['results']}
+
+    def test_users_only_find_their_own_analyses(self):
+        response = self.search()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.found(response), {str(self.mine.id), str(self.chatted.id)})
+
+    def test_global_search_is_staff_only(self):
+        self.assertEqual(self.search(scope='all').status_code, 403)
+        self.client.force_login(User.objects.create(username='staff', is_staff=True))
+        self.assertEqual(
+            self.found(self.search(scope='all')),
+            {str(self.mine.id), str(self.chatted.id), str(self.others.id)}
+        )
+
+
+class AhoCorasickTests(SimpleTestCase):
+    def test_finds_overlapping_and_nested_patterns(self):
+        matcher = AhoCorasick()
+        for pattern in ('he', 'she', 'his', 'hers'):
+            matcher.add(pattern, pattern)
+        matcher.build()
+        self.assertEqual(
+            sorted(matcher.find('ushers')),
+            [(1, 4, 'she'), (2, 4, 'he'), (2, 6, 'hers')]
+        )
+        self.assertEqual(list(matcher.find('xyz')), [])
+
+
+class IngredientKnowledgeTests(SimpleTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.knowledge = IngredientKnowledge.load(DEFAULT_KNOWLEDGE_PATH)
+
+    def allergens(self, text):
+        return {allergen['name']: allergen['matches'] for allergen in self.knowledge.tag(text)['allergens']}
+
+    def test_dairy_terms_are_milk(self):
+        self.assertEqual(
+            self.allergens("Butter, buttermilk, whole milk powder, cream, cheeses"),
+            {'milk': ['butter', 'buttermilk', 'milk powder', 'cream', 'cheeses']}
+        )
+
+    def test_plant_butters_and_milks_are_not_milk(self):
+        for text, expected in [
+            ("Peanut butter (98%), salt", {'peanuts': ['peanut']}),
+            ("Roasted almond butter", {'tree nuts': ['almond']}),
+            ("Sunflower seed butter, sugar", {}),
+            ("Sugar, cocoa butter, cacao butter, shea butter", {}),
+            ("Apple butter, cinnamon", {}),
+            ("Butter beans, water, salt", {}),
+            ("Coconut milk, oat milk, cream of tartar", {}),
+            ("Bean curd, soy sauce", {'soy': ['soy']}),
+        ]:
+            with self.subTest(text):
+                self.assertEqual(self.allergens(text), expected)
+
+    def test_exclusions_only_cover_their_own_span(self):
+        self.assertEqual(self.allergens("Peanut butter, butter"), {'peanuts': ['peanut'], 'milk': ['butter']})
+
+    def test_whole_words_and_plurals(self):
+        self.assertEqual(self.allergens("Eggs, aubergine (eggplant)"), {'egg': ['eggs']})
+        self.assertEqual(self.allergens("Nutmeg"), {})
+
+    def test_e_number_spellings(self):
+        additives = self.knowledge.tag("Acid (E 330), colour: INS 150d, E150(d)")['additives']
+        self.assertEqual(
+            {additive['code']: additive['matches'] for additive in additives},
+            {'E330': ['e 330'], 'E150d': ['ins 150d', 'e150 d']}
+        )
+
+    def test_longest_match_wins_at_a_position(self):
+        knowledge = IngredientKnowledge({'ingredient_flags': {
+            'added_sugar': {'label': 'Added sugars', 'terms': ['glucose', 'glucose syrup']},
+        }})
+        self.assertEqual(
+            knowledge.tag("Glucose syrup, salt")['flags'],
+            [{'flag': 'added_sugar', 'label': 'Added sugars', 'matches': ['glucose syrup']}]
+        )
+
+
+LABEL_TEXT = (
+    "ingredients whole grain oats sugar rapeseed oil honey salt raising agent sodium bicarbonate "
+    "nutrition per 100g energy 1850kj fat 15g saturates 1.5g carbohydrate 62g sugars 20g fibre 7g protein 9g"
+)
+
+
+class LabelSimilarityTests(SimpleTestCase):
+    def test_short_text_has_no_signature(self):
+        self.assertIsNone(label_signature('sugar salt'))
+
+    def test_ocr_noise_stays_similar_and_other_labels_do_not(self):
+        index = LabelSimilarityIndex()
+        index.add('oats', label_signature(LABEL_TEXT))
+        index.add('crisps', label_signature(
+            "ingredients potatoes sunflower oil salt nutrition per 100g energy 2200kj fat 32g saturates 3g"
+            " carbohydrate 50g sugars 0.5g fibre 4g protein 6g"
+        ))
+        noisy = LABEL_TEXT.replace('rapeseed', 'rapeseeo').replace('fibre 7g', 'fibre 79')
+        match = index.query(label_signature(noisy), 0.8)
+        self.assertEqual(match[0], 'oats')
+        self.assertGreaterEqual(match[1], 0.8)
+        self.assertEqual(index.query(label_signature(LABEL_TEXT), 0.8), ('oats', 1.0))
+
+        other = "ingredients milk chocolate cocoa butter whole milk powder emulsifier soya lecithin vanilla extract"
+        self.assertIsNone(index.query(label_signature(other), 0.8))
+
+    def test_lsh_buckets_find_the_same_matches_as_a_full_scan(self):
+        index = LabelSimilarityIndex()
+        for i in range(50):
+            index.add(f'label-{i}', label_signature(f"{LABEL_TEXT} batch {i * 7919}"))
+        query = label_signature(f"{LABEL_TEXT} batch {21 * 7919}")
+        full_scan = index.query(query, 0.9)
+        with mock.patch('analyzer.similarity.BRUTE_FORCE_LIMIT', 0):
+            self.assertEqual(index.query(query, 0.9), full_scan)
+        self.assertEqual(full_scan[0], 'label-21')
+
+    def test_removed_labels_are_not_matched(self):
+        index = LabelSimilarityIndex()
+        index.add('oats', label_signature(LABEL_TEXT))
+        index.remove('oats')
+        self.assertIsNone(index.query(label_signature(LABEL_TEXT), 0.8))
+        self.assertEqual(len(index), 0)
+
+
+class AnalysisReuseTests(TestCase):
+    """Only finished LLM results may stand in for another upload of the label"""
+
+    def setUp(self):
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        settings_override = override_settings(MEDIA_ROOT=media.name, CHAT_ANSWER_PRECOMPUTE_QUESTIONS=[])
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.service = get_food_analyzer_service()
+        for name, value in {
+            'extract_text_with_confidence': (f"Ingredients: {LABEL_TEXT}", 90.0),
+            'analyze_food_label': {
+                'raw_response': 'Error: connection refused', 'recommendation': 'ERROR', 'health_score': 0,
+                'summary': 'Unable to analyze due to an error', 'model': None, 'latency_ms': None,
+            },
+        }.items():
+            patcher = mock.patch.object(self.service, name, return_value=value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = mock.patch.dict(self.service.ocr.__dict__, {'version': 'tesseract-test'})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        buffer = io.BytesIO()
+        Image.new('RGB', (60, 40), 'white').save(buffer, 'PNG')
+        self.image = buffer.getvalue()
+
+    def upload(self):
+        upload = SimpleUploadedFile('label.png', self.image, content_type='image/png')
+        return self.client.post('/api/analyze/', {'image': upload}).json()
+
+    def test_failed_llm_analysis_is_degraded_and_not_reused(self):
+        first = self.upload()
+        self.assertEqual(first['status'], 'degraded')
+        self.assertNotEqual(first['recommendation'], 'ERROR')
+        self.assertEqual(FoodAnalysis.objects.get(id=first['analysis_id']).status, 'DEGRADED')
+
+        second = self.upload()
+        self.assertFalse(second['cached'])
+        self.assertEqual(self.service.analyze_food_label.call_count, 2)
+        self.assertIsNone(find_similar_analysis(label_signature(normalize_label_text(LABEL_TEXT, ''))))
+
+    def test_failed_ocr_is_degraded(self):
+        self.service.extract_text_with_confidence.return_value = ("Error extracting text: broken", None)
+        response = self.client.post('/api/analyze/', {
+            'image': SimpleUploadedFile('label.png', self.image, content_type='image/png')
+        })
+        self.assertEqual(response.status_code, 500)
+        self.assertEqual(FoodAnalysis.objects.get().status, 'DEGRADED')
+
+
+class BackfillLabelSignaturesTests(TestCase):
+    def backfill(self, *args):
+        out = io.StringIO()
+        call_command('backfill_label_signatures', *args, stdout=out)
+        return out.getvalue()
+
+    def test_analyses_without_a_signature_are_signed(self):
+        unsigned = FoodAnalysis.objects.create(extracted_text=LABEL_TEXT, ingredients_text=LABEL_TEXT)
+        short = FoodAnalysis.objects.create(extracted_text='Oats')
+        FoodAnalysis.objects.create(extracted_text='')
+        signed = FoodAnalysis.objects.create(extracted_text=LABEL_TEXT, label_signature=b'kept')
+
+        self.assertIn('2 analyses to sign', self.backfill('--dry-run'))
+        self.assertIsNone(FoodAnalysis.objects.get(id=unsigned.id).label_signature)
+
+        self.assertIn('Signed 1 analyses (1 too short to match)', self.backfill('--batch-size', '1'))
+        expected = label_signature(normalize_label_text(LABEL_TEXT, '', LABEL_TEXT)).tobytes()
+        self.assertEqual(bytes(FoodAnalysis.objects.get(id=unsigned.id).label_signature), expected)
+        self.assertIsNone(FoodAnalysis.objects.get(id=short.id).label_signature)
+        self.assertEqual(bytes(FoodAnalysis.objects.get(id=signed.id).label_signature), b'kept')
+
+        self.backfill('--all')
+        self.assertEqual(
+            bytes(FoodAnalysis.objects.get(id=signed.id).label_signature),
+            label_signature(normalize_label_text('', '', LABEL_TEXT)).tobytes()
+        )
+
+
+class IngestLabelsTests(TestCase):
+    def setUp(self):
+        media = tempfile.TemporaryDirectory()
+        labels = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        self.addCleanup(labels.cleanup)
+        self.labels = labels.name
+        settings_override = override_settings(MEDIA_ROOT=media.name)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        self.service = get_food_analyzer_service()
+        command = 'analyzer.management.commands.ingest_labels'
+        for patcher in [
+            # OCR in threads of this process, where the test database and mocks are visible
+            mock.patch(f'{command}.get_ocr_pool', ThreadPoolExecutor),
+            mock.patch(f'{command}.ocr_label', side_effect=self.ocr),
+            mock.patch.object(self.service, 'analyze_food_label', return_value={
+                'raw_response': "**RECOMMENDATION:** [EAT]\n\n**HEALTH SCORE:** 8\n\n**SUMMARY:** Fine.",
+                'recommendation': 'EAT', 'health_score': 8, 'summary': 'Fine.', 'model': 'test',
+                'latency_ms': 10, 'prompt_version': 'markdown-test',
+            }),
+        ]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def ocr(self, image_path):
+        return {
+            'extracted_text': LABEL_TEXT, 'ocr_confidence': 90.0, 'ocr_version': 'tesseract-test',
+            'ingredients_text': LABEL_TEXT, 'nutrition_text': '', 'ingredient_tags': {}, 'label_signature': None,
+        }
+
+    def write_label(self, name, colour):
+        Image.new('RGB', (60, 40), colour).save(f"{self.labels}/{name}", 'PNG')
+
+    def ingest(self):
+        call_command('ingest_labels', self.labels, '--ocr-workers', '2', stdout=io.StringIO(), stderr=io.StringIO())
+
+    def test_copies_of_one_file_share_one_analysis(self):
+        self.write_label('a.png', 'white')
+        self.write_label('b.png', 'white')
+        self.write_label('c.png', 'black')
+        self.ingest()
+
+        self.assertEqual(self.service.analyze_food_label.call_count, 2)
+        self.assertEqual(FoodAnalysis.objects.count(), 3)
+        copy = FoodAnalysis.objects.get(reused_from__isnull=False)
+        self.assertEqual(copy.label_image_id, copy.reused_from.label_image_id)
+        self.assertEqual((copy.status, copy.recommendation), ('COMPLETE', 'EAT'))
+        self.assertEqual(copy.label_image.ref_count, 2)
+
+    def test_failed_analyses_of_the_image_are_not_reused(self):
+        self.write_label('a.png', 'white')
+        self.ingest()
+        # Written as COMPLETE before failed results were marked DEGRADED
+        FoodAnalysis.objects.update(analysis_result='Error: connection refused')
+        self.write_label('b.png', 'white')
+        self.ingest()
+
+        self.assertEqual(self.service.analyze_food_label.call_count, 2)
+        self.assertFalse(FoodAnalysis.objects.filter(reused_from__isnull=False).exists())
+
+    def test_images_already_in_the_media_store_are_skipped(self):
+        self.write_label('new.png', 'black')
+        self.ingest()
+        self.assertEqual(self.service.analyze_food_label.call_count, 1)
+
+        # A legacy upload an analysis refers to, next to the stored copy of new.png
+        self.labels = os.path.join(settings.MEDIA_ROOT, 'food_labels')
+        self.write_label('food_label_legacy.png', 'white')
+        FoodAnalysis.objects.create(image='food_labels/food_label_legacy.png')
+        self.ingest()
+
+        self.assertEqual(self.service.analyze_food_label.call_count, 1)
+        self.assertEqual(FoodAnalysis.objects.count(), 2)
+        self.assertEqual(LabelImage.objects.get().ref_count, 1)
+
+class ReanalyzeTests(TestCase):
+    def setUp(self):
+        checkpoint = tempfile.TemporaryDirectory()
+        self.addCleanup(checkpoint.cleanup)
+        self.checkpoint = os.path.join(checkpoint.name, 'checkpoint')
+        self.service = get_food_analyzer_service()
+        self.model = self.service.model_name
+        patcher = mock.patch.object(self.service, 'analyze_food_label', side_effect=self.analyze)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.dict(self.service.router.fallbacks, {self.model: 'small'})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def analyze(self, *args, **kwargs):
+        return {
+            'raw_response': 'Fine.', 'recommendation': 'EAT', 'health_score': 8, 'summary': 'Fine.',
+            'model': self.model, 'latency_ms': 10, 'prompt_version': self.service.prompt_version(),
+        }
+
+    def analysis(self, **fields):
+        options = {
+            'extracted_text': LABEL_TEXT, 'status': 'COMPLETE', 'recommendation': 'AVOID', 'llm_model': self.model,
+            'prompt_version': self.service.prompt_version(),
+        }
+        options.update(fields)
+        return FoodAnalysis.objects.create(**options)
+
+    def reanalyze(self, *args):
+        out = io.StringIO()
+        call_command('reanalyze', '--checkpoint', self.checkpoint, *args, stdout=out, stderr=io.StringIO())
+        return out.getvalue()
+
+    def test_only_stale_analyses_are_sent_to_the_llm(self):
+        current = self.analysis()
+        downgraded = self.analysis(llm_model='small')
+        old_prompt = self.analysis(prompt_version='markdown-0000000000')
+        old_model = self.analysis(llm_model='retired')
+        degraded = self.analysis(status='DEGRADED')
+        copy = self.analysis(prompt_version='markdown-0000000000', reused_from=old_prompt)
+        self.analysis(extracted_text='', prompt_version='')
+
+        self.assertIn('LLM stale: 3', self.reanalyze('--dry-run'))
+        self.reanalyze()
+
+        self.assertEqual(self.service.analyze_food_label.call_count, 3)
+        for analysis in (old_prompt, old_model, degraded, copy):
+            analysis.refresh_from_db()
+            self.assertEqual((analysis.status, analysis.recommendation), ('COMPLETE', 'EAT'))
+            self.assertEqual(analysis.prompt_version, self.service.prompt_version())
+        for analysis in (current, downgraded):
+            analysis.refresh_from_db()
+            self.assertEqual(analysis.recommendation, 'AVOID')
+
+        # Nothing is stale any more, even when starting over
+        self.reanalyze('--restart')
+        self.assertEqual(self.service.analyze_food_label.call_count, 3)
+
+    def test_json_results_that_fell_back_to_markdown_are_current(self):
+        with override_settings(ANALYSIS_OUTPUT_MODE='json'):
+            fell_back = self.analysis(prompt_version=self.service.prompt_versions['json-fallback'])
+            self.analysis(prompt_version=self.service.prompt_version('json'))
+            markdown = self.analysis(prompt_version=self.service.prompt_version('markdown'))
+            self.reanalyze()
+
+        self.assertEqual(self.service.analyze_food_label.call_count, 1)
+        markdown.refresh_from_db()
+        self.assertEqual(markdown.recommendation, 'EAT')
+        fell_back.refresh_from_db()
+        self.assertEqual(fell_back.recommendation, 'AVOID')
+
+
+class ExportTests(TestCase):
+    def setUp(self):
+        self.staff = User.objects.create(username='staff', is_staff=True)
+        self.user = User.objects.create(username='alice')
+        self.other = User.objects.create(username='bob')
+        self.chat = Chat.objects.create(user=self.user, title='Oats, "crunchy"\nbar')
+        Message.objects.create(chat=self.chat, role='user', content='Is it vegan?')
+        Message.objects.create(chat=Chat.objects.create(user=self.other, title='Crisps'), role='user', content='Salt?')
+        self.analyses = []
+        for day, recommendation in [(1, 'EAT'), (2, 'AVOID'), (3, 'EAT')]:
+            self.analyses.append(FoodAnalysis.objects.create(
+                recommendation=recommendation, status='COMPLETE', ingredient_tags={'allergens': ['oats']},
+                created_at=timezone.make_aware(timezone.datetime(2024, 5, day, 12)),
+            ))
+
+    def export(self, **params):
+        self.client.force_login(self.staff)
+        return self.client.get('/api/export/', params)
+
+    def lines(self, response):
+        return b''.join(response.streaming_content).decode()
+
+    def ndjson(self, **params):
+        response = self.export(**params)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        return [json.loads(line) for line in self.lines(response).splitlines()]
+
+    def test_non_staff_is_forbidden(self):
+        self.assertEqual(self.client.get('/api/export/').status_code, 403)
+        self.client.force_login(self.user)
+        self.assertEqual(self.client.get('/api/export/').status_code, 403)
+
+    def test_staff_can_authenticate_with_a_bearer_token(self):
+        from rest_framework_simplejwt.tokens import RefreshToken
+        token = RefreshToken.for_user(self.staff).access_token
+        response = self.client.get('/api/export/', headers={'Authorization': f'Bearer {token}'})
+        self.assertEqual(response.status_code, 200)
+        token = RefreshToken.for_user(self.user).access_token
+        response = self.client.get('/api/export/', headers={'Authorization': f'Bearer {token}'})
+        self.assertEqual(response.status_code, 403)
+
+    def test_ndjson_streams_one_object_per_row_in_creation_order(self):
+        rows = self.ndjson()
+        self.assertEqual([row['id'] for row in rows], [str(analysis.id) for analysis in self.analyses])
+        self.assertEqual(rows[0]['created_at'], '2024-05-01T12:00:00+00:00')
+        self.assertEqual(rows[0]['ingredient_tags'], {'allergens': ['oats']})
+        self.assertIn('attachment; filename="analyses-', self.export()['Content-Disposition'])
+
+    def test_csv_quotes_commas_quotes_and_newlines(self):
+        response = self.export(dataset='chats', format='csv')
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        rows = list(csv.reader(io.StringIO(self.lines(response))))
+        self.assertEqual(rows[0], ['id', 'created_at', 'user_id', 'title', 'is_title_auto_generated', 'analysis_id'])
+        self.assertEqual(rows[1][3], 'Oats, "crunchy"\nbar')
+        self.assertEqual(len(rows), 3)
+
+        rows = list(csv.reader(io.StringIO(self.lines(self.export(format='csv')))))
+        column = rows[0].index('ingredient_tags')
+        self.assertEqual(json.loads(rows[1][column]), {'allergens': ['oats']})
+
+    def test_filters(self):
+        # A bare `until` date includes that whole day
+        rows = self.ndjson(since='2024-05-02', until='2024-05-02')
+        self.assertEqual([row['id'] for row in rows], [str(self.analyses[1].id)])
+        rows = self.ndjson(since='2024-05-01T13:00:00')
+        self.assertEqual(len(rows), 2)
+        rows = self.ndjson(recommendation='eat')
+        self.assertEqual({row['recommendation'] for row in rows}, {'EAT'})
+        self.assertEqual(len(rows), 2)
+
+        rows = self.ndjson(dataset='messages', user=self.user.id)
+        self.assertEqual([row['content'] for row in rows], ['Is it vegan?'])
+        rows = self.ndjson(dataset='chats', user=self.other.id)
+        self.assertEqual([row['title'] for row in rows], ['Crisps'])
+
+    def test_invalid_parameters_are_rejected(self):
+        for params in [
+            {'format': 'xml'},
+            {'dataset': 'users'},
+            {'since': 'yesterday'},
+            {'dataset': 'chats', 'recommendation': 'EAT'},
+            {'dataset': 'analyses', 'user': self.user.id},
+            {'dataset': 'chats', 'user': 'alice'},
+        ]:
+            with self.subTest(params):
+                response = self.export(**params)
+                self.assertEqual(response.status_code, 400)
+                self.assertIn('error', response.json())
+
+
+class ChatConditionalGetTests(TestCase):
+    def setUp(self):
+        session = self.client.session
+        self.user = User.objects.create(username='anon_test')
+        session['user_id'] = self.user.id
+        session.save()
+        self.chat = Chat.objects.create(user=self.user, title='Oat bar', analysis_id='a1')
+        Message.objects.create(chat=self.chat, role='user', content='Is it vegan?')
+        self.addCleanup(chat_cache._entries.clear)
+
+    def history(self, **headers):
+        return self.client.get(f'/api/chat-history/{self.chat.id}/', headers=headers)
+
+    def chats(self, **headers):
+        return self.client.get('/api/user-chats/', headers=headers)
+
+    def test_unchanged_history_is_not_modified(self):
+        first = self.history()
+        self.assertEqual(first.status_code, 200)
+        self.assertIn('Last-Modified', first)
+        self.assertEqual(len(first.json()['messages']), 1)
+        response = self.history(if_none_match=first['ETag'])
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b'')
+        # A client without the ETag gets the body from the response cache
+        self.assertEqual(self.history().content, first.content)
+
+    def test_new_message_or_title_changes_the_history_etag(self):
+        first = self.history()
+        Message.objects.create(chat=self.chat, role='llm', content='Yes.')
+        second = self.history(if_none_match=first['ETag'])
+        self.assertEqual(second.status_code, 200)
+        self.assertNotEqual(second['ETag'], first['ETag'])
+        self.assertEqual([message['content'] for message in second.json()['messages']], ['Is it vegan?', 'Yes.'])
+
+        Chat.objects.filter(id=self.chat.id).update(title='Vegan oat bar')
+        third = self.history(if_none_match=second['ETag'])
+        self.assertEqual(third.status_code, 200)
+        self.assertEqual(third.json()['title'], 'Vegan oat bar')
+
+    def test_chat_list_etag_follows_chats_and_messages(self):
+        first = self.chats()
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(self.chats(if_none_match=first['ETag']).status_code, 304)
+
+        Message.objects.create(chat=self.chat, role='llm', content='Yes.')
+        second = self.chats(if_none_match=first['ETag'])
+        self.assertEqual(second.status_code, 200)
+        self.assertEqual(second.json()['chats'][0]['message_count'], 2)
+
+        Chat.objects.create(user=self.user, title='Crisps')
+        third = self.chats(if_none_match=second['ETag'])
+        self.assertEqual(third.status_code, 200)
+        self.assertEqual(len(third.json()['chats']), 2)
+        self.assertEqual(self.chats(if_none_match=third['ETag']).status_code, 304)
+
+    def test_database_errors_keep_the_json_error_shape(self):
+        with mock.patch('analyzer.views._chat_history_state', side_effect=DatabaseError('database is locked')):
+            response = self.history()
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['success'], False)
+        self.assertNotIn('ETag', response)
+
+        with mock.patch('analyzer.views._user_chats_state', side_effect=DatabaseError('database is locked')):
+            response = self.chats()
+        self.assertEqual(response.status_code, 500)
+        self.assertEqual(response.json(), {'error': 'Failed to retrieve chats'})
+
+    @override_settings(CHAT_RESPONSE_CACHE_MAX_ENTRY_BYTES=10)
+    def test_large_responses_are_not_cached(self):
+        self.assertEqual(self.history().status_code, 200)
+        self.assertEqual(self.chats().status_code, 200)
+        self.assertEqual(len(chat_cache._entries), 0)
+
+    def test_other_users_chats_do_not_change_the_etag(self):
+        first = self.chats()
+        other = Chat.objects.create(user=User.objects.create(username='other'), title='Crisps')
+        Message.objects.create(chat=other, role='user', content='Is it vegan?')
+        self.assertEqual(self.chats(if_none_match=first['ETag']).status_code, 304)
+
+
+class LabelImageStoreTests(TestCase):
+    def setUp(self):
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        self.media = media.name
+        settings_override = override_settings(MEDIA_ROOT=self.media, LABEL_IMAGE_KEEP_ORIGINAL=False)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.store = get_label_image_store()
+
+    def image(self, colour='white', size=(60, 40)):
+        buffer = io.BytesIO()
+        Image.new('RGB', size, colour).save(buffer, 'PNG')
+        return buffer.getvalue()
+
+    def stored_files(self):
+        return sorted(
+            os.path.relpath(os.path.join(root, name), self.media)
+            for root, dirs, files in os.walk(self.media) for name in files
+        )
+
+    def test_identical_uploads_share_one_file(self):
+        first = self.store.store(SimpleUploadedFile('a.png', self.image()))
+        second = self.store.store(SimpleUploadedFile('b.png', self.image()))
+        other = self.store.store(SimpleUploadedFile('c.png', self.image('black')))
+
+        self.assertEqual(first.pk, second.pk)
+        self.assertNotEqual(first.pk, other.pk)
+        self.assertEqual(LabelImage.objects.get(pk=first.pk).ref_count, 2)
+        self.assertEqual(second.ref_count, 2)
+        self.assertEqual(len(self.stored_files()), 2)
+        self.assertTrue(first.file.name.endswith(f"{first.sha256}.webp"))
+
+    def test_lost_files_are_written_again(self):
+        first = self.store.store(SimpleUploadedFile('a.png', self.image()))
+        os.remove(self.store.path(first.file.name))
+        second = self.store.store(SimpleUploadedFile('a.png', self.image()))
+        self.assertEqual(first.pk, second.pk)
+        self.assertEqual(second.ref_count, 2)
+        self.assertTrue(os.path.exists(self.store.path(second.file.name)))
+
+    def test_release_deletes_the_image_with_its_last_reference(self):
+        label_image = self.store.store(SimpleUploadedFile('a.png', self.image()), references=2)
+        path = self.store.path(label_image.file.name)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertFalse(self.store.release(label_image.pk))
+        self.assertEqual(LabelImage.objects.get(pk=label_image.pk).ref_count, 1)
+        self.assertTrue(os.path.exists(path))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertTrue(self.store.release(label_image.pk))
+        self.assertFalse(LabelImage.objects.filter(pk=label_image.pk).exists())
+        self.assertFalse(os.path.exists(path))
+        self.assertFalse(self.store.release(label_image.pk))
+
+    def test_release_never_goes_below_zero(self):
+        label_image = self.store.store(SimpleUploadedFile('a.png', self.image()), references=1)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertTrue(self.store.release(label_image.pk, references=3))
+        self.assertFalse(LabelImage.objects.exists())
+        self.assertEqual(self.stored_files(), [])
+
+    def test_files_of_an_image_stored_again_before_commit_are_kept(self):
+        label_image = self.store.store(SimpleUploadedFile('a.png', self.image()))
+        with self.captureOnCommitCallbacks() as callbacks:
+            self.store.release(label_image.pk)
+        again = self.store.store(SimpleUploadedFile('a.png', self.image()))
+        for callback in callbacks:
+            callback()
+        self.assertTrue(os.path.exists(self.store.path(again.file.name)))
+
+    def test_dedupe_moves_legacy_uploads_into_the_store(self):
+        legacy = os.path.join(self.media, 'food_labels')
+        os.makedirs(legacy)
+        for name, colour in [('food_label_1.png', 'white'), ('food_label_2.png', 'white'),
+                             ('food_label_3.png', 'black')]:
+            with open(os.path.join(legacy, name), 'wb') as fh:
+                fh.write(self.image(colour))
+        first = FoodAnalysis.objects.create(image='food_labels/food_label_1.png')
+        second = FoodAnalysis.objects.create(image='food_labels/food_label_2.png')
+        also_second = FoodAnalysis.objects.create(image='food_labels/food_label_2.png')
+
+        call_command('dedupe_label_images', '--dry-run', stdout=io.StringIO())
+        self.assertFalse(LabelImage.objects.exists())
+        self.assertEqual(len(os.listdir(legacy)), 3)
+
+        call_command('dedupe_label_images', stdout=io.StringIO())
+        label_image = LabelImage.objects.get()
+        self.assertEqual(label_image.ref_count, 3)
+        for analysis in (first, second, also_second):
+            analysis.refresh_from_db()
+            self.assertEqual(analysis.label_image_id, label_image.pk)
+            self.assertEqual(analysis.image.name, label_image.ocr_name)
+        # The unreferenced upload stays unless asked for
+        self.assertIn('food_labels/food_label_3.png', self.stored_files())
+
+        call_command('dedupe_label_images', '--delete-orphans', stdout=io.StringIO())
+        self.assertEqual(self.stored_files(), [label_image.file.name])
+
+
+class RetentionJobTests(TestCase):
+    def setUp(self):
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        self.media = media.name
+        settings_override = override_settings(MEDIA_ROOT=self.media, RETENTION_ARCHIVE_DIR=None)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.now = timezone.now()
+        self.user = User.objects.create(username='alice', password='x')
+
+    def days_ago(self, days):
+        return self.now - timedelta(days=days)
+
+    def chat(self, age_days, message_age_days=None):
+        chat = Chat.objects.create(user=self.user, title='Oat bar')
+        Chat.objects.filter(id=chat.id).update(created_at=self.days_ago(age_days))
+        if message_age_days is not None:
+            message = Message.objects.create(chat=chat, role='user', content='Is it vegan?')
+            Message.objects.filter(id=message.id).update(created_at=self.days_ago(message_age_days))
+        return chat
+
+    def media_file(self, name, age_hours):
+        path = os.path.join(self.media, 'food_labels', name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as fh:
+            fh.write(b'label')
+        stamp = (self.now - timedelta(hours=age_hours)).timestamp()
+        os.utime(path, (stamp, stamp))
+        return path
+
+    def test_rows_older_than_their_policy_are_removed(self):
+        old_chat = self.chat(200)
+        active_chat = self.chat(200, message_age_days=1)
+        new_chat = self.chat(1)
+        old_analysis = FoodAnalysis.objects.create(created_at=self.days_ago(400))
+        kept_by_chat = FoodAnalysis.objects.create(created_at=self.days_ago(400))
+        Chat.objects.filter(id=active_chat.id).update(analysis_id=str(kept_by_chat.id))
+        freed_by_chat = FoodAnalysis.objects.create(created_at=self.days_ago(400))
+        Chat.objects.filter(id=old_chat.id).update(analysis_id=str(freed_by_chat.id))
+        new_analysis = FoodAnalysis.objects.create(created_at=self.days_ago(10))
+        AnalysisSession.objects.create(session_id='old', ip_address='127.0.0.1', last_activity=self.days_ago(100))
+        AnalysisSession.objects.create(session_id='new', ip_address='127.0.0.1', last_activity=self.days_ago(1))
+        User.objects.create(username='anon_old', date_joined=self.days_ago(40))
+        User.objects.create(username='anon_new', date_joined=self.days_ago(1))
+
+        report = RetentionJob(now=self.now).run()
+
+        self.assertEqual(set(Chat.objects.values_list('id', flat=True)), {active_chat.id, new_chat.id})
+        self.assertEqual(
+            set(FoodAnalysis.objects.values_list('id', flat=True)), {kept_by_chat.id, new_analysis.id}
+        )
+        self.assertFalse(FoodAnalysis.objects.filter(id=old_analysis.id).exists())
+        self.assertEqual(list(AnalysisSession.objects.values_list('session_id', flat=True)), ['new'])
+        self.assertEqual(
+            set(User.objects.values_list('username', flat=True)), {'alice', 'anon_new'}
+        )
+        self.assertEqual((report['chats'], report['analyses'], report['sessions']), (1, 2, 1))
+
+    def test_rows_are_deleted_in_batches_and_archived(self):
+        analyses = [FoodAnalysis.objects.create(created_at=self.days_ago(400)) for _ in range(5)]
+        chat = self.chat(200, message_age_days=200)
+        archive = tempfile.TemporaryDirectory()
+        self.addCleanup(archive.cleanup)
+        job = RetentionJob(now=self.now, archive_dir=archive.name, batch_size=2)
+
+        with mock.patch.object(job, '_delete_batch', wraps=job._delete_batch) as delete_batch:
+            job.run()
+
+        batches = [call.args[2] for call in delete_batch.call_args_list if call.args[0] == 'analyses']
+        self.assertEqual([len(batch) for batch in batches], [2, 2, 1])
+        self.assertFalse(FoodAnalysis.objects.exists())
+
+        def archived(label):
+            path = os.path.join(archive.name, f"{label}-{self.now.strftime('%Y%m%dT%H%M%S')}.jsonl.gz")
+            with gzip.open(path, 'rt', encoding='utf-8') as fh:
+                return [json.loads(line) for line in fh]
+
+        self.assertEqual(
+            sorted(row['id'] for row in archived('analyses')), sorted(str(a.id) for a in analyses)
+        )
+        self.assertEqual([row['id'] for row in archived('chats')], [chat.id])
+        self.assertEqual([row['content'] for row in archived('messages')], ['Is it vegan?'])
+
+    def test_only_old_unreferenced_media_is_removed(self):
+        referenced = self.media_file('food_label_used.jpg', age_hours=48)
+        FoodAnalysis.objects.create(image='food_labels/food_label_used.jpg')
+        stored = self.media_file('ab/stored.webp', age_hours=48)
+        LabelImage.objects.create(sha256='a' * 64, file='food_labels/ab/stored.webp', ref_count=1)
+        orphan = self.media_file('food_label_orphan.jpg', age_hours=48)
+        fresh = self.media_file('food_label_fresh.jpg', age_hours=1)
+        leaked = LabelImage.objects.create(sha256='b' * 64, file='food_labels/bb/b.webp',
+                                           created_at=self.now - timedelta(hours=48))
+        # Stored moments ago; its analysis row is about to be attached
+        in_flight = LabelImage.objects.create(sha256='c' * 64, file='food_labels/cc/c.webp')
+
+        dry_run = RetentionJob(now=self.now, dry_run=True).run()
+        self.assertEqual((dry_run['orphaned_media_files'], dry_run['leaked_label_images']), (1, 1))
+        self.assertTrue(os.path.exists(orphan))
+
+        report = RetentionJob(now=self.now).run()
+
+        self.assertEqual(report['orphaned_media_files'], 1)
+        self.assertFalse(os.path.exists(orphan))
+        for path in (referenced, stored, fresh):
+            self.assertTrue(os.path.exists(path))
+        self.assertFalse(LabelImage.objects.filter(pk=leaked.pk).exists())
+        self.assertTrue(LabelImage.objects.filter(pk=in_flight.pk).exists())
+
+    def test_released_image_files_are_removed_only_after_commit(self):
+        buffer = io.BytesIO()
+        Image.new('RGB', (60, 40), 'white').save(buffer, 'PNG')
+        store = get_label_image_store()
+        label_image = store.store(SimpleUploadedFile('label.png', buffer.getvalue()))
+        analysis = FoodAnalysis.objects.create(label_image=label_image, image=label_image.ocr_name)
+        path = store.path(label_image.ocr_name)
+
+        with self.captureOnCommitCallbacks() as callbacks:
+            with self.assertRaises(RuntimeError):
+                with transaction.atomic():
+                    FoodAnalysis.objects.get(id=analysis.id).delete()
+                    raise RuntimeError('batch failed')
+        self.assertEqual(callbacks, [])
+        self.assertTrue(os.path.exists(path))
+        self.assertEqual(LabelImage.objects.get(pk=label_image.pk).ref_count, 1)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            FoodAnalysis.objects.get(id=analysis.id).delete()
+            self.assertTrue(os.path.exists(path))
+        self.assertFalse(LabelImage.objects.filter(pk=label_image.pk).exists())
+        self.assertFalse(os.path.exists(path))
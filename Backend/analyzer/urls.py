@@ -8,9 +8,12 @@ app_name = 'analyzer'
 urlpatterns = [
     path('', views.index, name='index'),
     path('analyze/', views.analyze_food_label, name='analyze'),
+    path('analysis/<uuid:analysis_id>/', views.get_analysis, name='get_analysis'),
     path('chat/', views.chat_followup, name='chat_followup'),
     path('user-chats/', views.get_user_chats, name='get_user_chats'),
     path('chat-history/<int:chat_id>/', views.get_chat_history, name='get_chat_history'),
+    path('search/', views.search_history, name='search'),
+    path('export/', views.export_data, name='export'),
     path('signup/', SignupView.as_view(), name='signup'),
     path('token/', TokenObtainPairView.as_view(), name='token_obtain_pair'),
     path('token/refresh/', TokenRefreshView.as_view(), name='token_refresh'),
@@ -1,22 +1,33 @@
 import json
 import logging
-import os
 import re
 import uuid
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from functools import partial, wraps
 from django.shortcuts import render, get_object_or_404
-from django.http import JsonResponse
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
 from django.views.decorators.csrf import csrf_exempt
-from django.views.decorators.http import require_http_methods
-from django.core.files.storage import default_storage
-from django.core.files.base import ContentFile
+from django.views.decorators.cache import cache_control
+from django.views.decorators.http import condition, require_http_methods
 from django.utils import timezone
 from django.conf import settings
-from django.db import transaction
+from django.db import transaction, close_old_connections
+from django.db.models import Count, Max
 from django.contrib.auth.models import User
 from .models import FoodAnalysis, AnalysisSession, Chat, Message
-from .services import get_food_analyzer_service
+from .admission import admission_controlled, hold_admission
+from .deadlines import Deadline, DeadlineExceeded
+from .tasks import run_in_background
+from .knowledge import format_ingredient_hints
+from .services import GenerationTimeout, get_food_analyzer_service
+from . import answers, chat_cache, exports, search
+from .similarity import REUSABLE, find_similar_analysis, label_signature, normalize_label_text, remember_analysis
+from .storage import get_label_image_store
 from .utils import get_client_ip
 from rest_framework import generics
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import InvalidToken
 from .serializers import UserSignupSerializer
 from django.contrib.auth import get_user_model
 
@@ -29,8 +40,10 @@ def index(request):
 
 @csrf_exempt
 @require_http_methods(["POST"])
+@admission_controlled('analyze')
 def analyze_food_label(request):
     """Analyze uploaded food label image"""
+    analysis = None
     try:
         # Check if image was uploaded
         if 'image' not in request.FILES:
@@ -60,47 +73,125 @@ def analyze_food_label(request):
             }
         )
 
-        # Create analysis record
-        analysis = FoodAnalysis.objects.create()
-
-        # Save uploaded image
-        file_extension = uploaded_file.name.split('.')[-1]
-        file_name = f"food_label_{analysis.id}.{file_extension}"
-        file_path = default_storage.save(f'food_labels/{file_name}', ContentFile(uploaded_file.read()))
-        analysis.image = file_path
-        analysis.save()
+        # Store the image once per unique content and reference it from the analysis
+        image_store = get_label_image_store()
+        with transaction.atomic():
+            # The reference and the row holding it commit (or roll back) together
+            label_image = image_store.store(uploaded_file)
+            analysis = FoodAnalysis.objects.create(
+                label_image=label_image,
+                image=label_image.ocr_name,
+                session=analysis_session
+            )
 
         # Get the full path for processing
-        full_image_path = os.path.join(settings.MEDIA_ROOT, file_path)
+        full_image_path = image_store.path(label_image.ocr_name)
 
         # Get the food analyzer service
         analyzer_service = get_food_analyzer_service()
-
-        # Extract text from image
-        logger.info(f"Extracting text from image: {full_image_path}")
-        extracted_text = analyzer_service.extract_text_from_image(full_image_path)
-        if extracted_text.startswith("Error"):
-            return JsonResponse({'error': extracted_text}, status=500)
-
-        # Process extracted text
-        ingredients_section, nutrition_section = analyzer_service.process_extracted_text(extracted_text)
-
-        # Analyze with LangChain
-        logger.info("Starting LangChain analysis...")
-        analysis_result = analyzer_service.analyze_food_label(
-            extracted_text,
-            ingredients_section,
-            nutrition_section
-        )
+        deadline = Deadline.for_request(request, 'analyze')
+        db_reserve = getattr(settings, 'DEADLINE_DB_RESERVE_SECONDS', 1.0)
+        llm_reserve = getattr(settings, 'DEADLINE_LLM_RESERVE_SECONDS', 10)
+
+        # The exact same image was analyzed before: skip OCR and the LLM entirely
+        use_cache = getattr(settings, 'NEAR_DUPLICATE_CACHE', True)
+        reuse = None
+        if use_cache:
+            source = FoodAnalysis.objects.filter(
+                REUSABLE, label_image=label_image
+            ).exclude(id=analysis.id).order_by('-created_at').first()
+            if source is not None:
+                reuse = (source, 1.0)
+                analysis.extracted_text = source.extracted_text
+                analysis.ocr_confidence = source.ocr_confidence
+                analysis.ocr_version = source.ocr_version
+                analysis.ingredients_text = source.ingredients_text
+                analysis.nutrition_text = source.nutrition_text
+
+        if reuse is None:
+            # Extract text from image
+            logger.info(f"Extracting text from image: {full_image_path}")
+            try:
+                deadline.check('ocr', reserve=db_reserve)
+                extracted_text, ocr_confidence = analyzer_service.extract_text_with_confidence(
+                    full_image_path, deadline=deadline, reserve=llm_reserve + db_reserve
+                )
+            except DeadlineExceeded:
+                logger.warning(f"⏱️ OCR missed the deadline after {deadline.elapsed():.1f}s")
+                mark_analysis_failed(analysis.id)
+                return JsonResponse({'error': 'Reading the label took too long. Please try again.'}, status=503)
+            if extracted_text.startswith("Error"):
+                mark_analysis_failed(analysis.id)
+                return JsonResponse({'error': extracted_text}, status=500)
+
+            # Process extracted text
+            ingredients_section, nutrition_section = analyzer_service.process_extracted_text(extracted_text)
+            analysis.extracted_text = extracted_text
+            analysis.ocr_confidence = ocr_confidence
+            analysis.ocr_version = analyzer_service.ocr.version
+            analysis.ingredients_text = ingredients_section
+            analysis.nutrition_text = nutrition_section
+
+            # Another photo of the same product: reuse its analysis
+            signature = label_signature(normalize_label_text(ingredients_section, nutrition_section, extracted_text))
+            if signature is not None:
+                analysis.label_signature = signature.tobytes()
+            if use_cache:
+                reuse = find_similar_analysis(signature, exclude_id=analysis.id)
+
+        extracted_text = analysis.extracted_text
+        ingredients_section = analysis.ingredients_text
+        nutrition_section = analysis.nutrition_text
+        ingredient_tags = analyzer_service.tag_ingredients(extracted_text, ingredients_section)
+        analysis.ingredient_tags = ingredient_tags
+        status = 'COMPLETE'
+        future = None
+        if reuse is not None:
+            source, similarity = reuse
+            logger.info(f"♻️ Reusing analysis {source.id} (similarity {similarity:.2f})")
+            analysis.reused_from = source
+            analysis_result = {
+                **analyzer_service._parse_analysis_result(source.analysis_result),
+                'model': source.llm_model or None,
+                'latency_ms': None,
+                'prompt_version': source.prompt_version
+            }
+        else:
+            # Analyze with LangChain within whatever is left of the time budget
+            logger.info("Starting LangChain analysis...")
+            finish_later = getattr(settings, 'ANALYSIS_BACKGROUND_COMPLETION', True)
+            try:
+                deadline.check('llm', reserve=db_reserve)
+                future = run_in_background(
+                    analyzer_service.analyze_food_label,
+                    extracted_text,
+                    ingredients_section,
+                    nutrition_section,
+                    ingredient_tags,
+                    # Past the deadline only a background completion still wants the result
+                    timeout=None if finish_later else deadline.remaining(reserve=db_reserve)
+                )
+                hold_admission(request, future)
+                analysis_result = future.result(timeout=deadline.remaining(reserve=db_reserve))
+                if analysis_result['recommendation'] == 'ERROR':
+                    # Not a result to store or reuse; answer with the estimate instead
+                    logger.warning(f"LLM analysis failed, returning a degraded result: {analysis_result['summary']}")
+                    analysis_result = analyzer_service.heuristic_assessment(
+                        ingredients_section, nutrition_section, ingredient_tags
+                    )
+                    status = 'DEGRADED'
+            except (DeadlineExceeded, FutureTimeoutError):
+                logger.warning(f"⏱️ LLM analysis missed the deadline after {deadline.elapsed():.1f}s, returning a degraded result")
+                analysis_result = analyzer_service.heuristic_assessment(ingredients_section, nutrition_section, ingredient_tags)
+                status = 'PENDING' if future is not None and finish_later else 'DEGRADED'
 
         # Save analysis results
-        analysis.extracted_text = extracted_text
-        analysis.ingredients_text = ingredients_section
-        analysis.nutrition_text = nutrition_section
-        analysis.analysis_result = analysis_result['raw_response']
-        analysis.recommendation = analysis_result['recommendation']
-        analysis.health_score = analysis_result['health_score']
-        analysis.save()
+        save_analysis_result(analysis, analysis_result, status)
+        if status == 'PENDING':
+            future.add_done_callback(partial(finish_analysis_in_background, analysis.id))
+        elif status == 'COMPLETE' and reuse is None:
+            # Copies share their source's answers, so only fresh analyses need them
+            answers.schedule_precompute(analysis)
 
         # Update session stats
         analysis_session.total_analyses += 1
@@ -112,24 +203,104 @@ def analyze_food_label(request):
             'success': True,
             'analysis_id': str(analysis.id),
             'extracted_text': extracted_text,
+            'ocr_confidence': analysis.ocr_confidence,
             'ingredients': ingredients_section,
             'nutrition': nutrition_section,
+            'tags': ingredient_tags,
             'analysis': analysis_result['raw_response'],
             'recommendation': analysis_result['recommendation'],
             'health_score': analysis_result['health_score'],
             'summary': analysis_result['summary'],
+            'model': analysis_result['model'],
+            'status': status.lower(),
+            'degraded': status != 'COMPLETE',
+            'cached': reuse is not None,
             'timestamp': analysis.created_at.isoformat()
         }
-        logger.info(f"Analysis completed successfully for {analysis.id}")
+        if reuse is not None:
+            response_data['similar_to'] = str(reuse[0].id)
+            response_data['similarity'] = round(reuse[1], 3)
+        logger.info(f"Analysis completed for {analysis.id} ({status.lower()})")
         return JsonResponse(response_data)
 
     except Exception as e:
         logger.error(f"Error in analyze_food_label: {str(e)}", exc_info=True)
+        if analysis is not None:
+            mark_analysis_failed(analysis.id)
         return JsonResponse({'error': f'Analysis failed: {str(e)}'}, status=500)
 
 
+def mark_analysis_failed(analysis_id):
+    """Leave an analysis that never got a result DEGRADED rather than processing forever"""
+    FoodAnalysis.objects.filter(id=analysis_id, status='PROCESSING').update(status='DEGRADED')
+
+
+def save_analysis_result(analysis, analysis_result, status='COMPLETE'):
+    """Store an LLM (or heuristic) analysis result on a FoodAnalysis"""
+    analysis.analysis_result = analysis_result['raw_response']
+    analysis.recommendation = analysis_result['recommendation']
+    analysis.health_score = analysis_result['health_score']
+    analysis.llm_model = analysis_result['model'] or ''
+    analysis.llm_latency_ms = analysis_result['latency_ms']
+    analysis.prompt_version = analysis_result.get('prompt_version', '')  # Heuristic results have none
+    analysis.status = status
+    analysis.save()
+
+
+def finish_analysis_in_background(analysis_id, future):
+    """Replace a pending degraded result once the full LLM analysis arrives"""
+    close_old_connections()
+    try:
+        analysis_result = future.result()
+        if analysis_result['recommendation'] == 'ERROR':
+            FoodAnalysis.objects.filter(id=analysis_id, status='PENDING').update(status='DEGRADED')
+            return
+        FoodAnalysis.objects.filter(id=analysis_id, status='PENDING').update(
+            analysis_result=analysis_result['raw_response'],
+            recommendation=analysis_result['recommendation'],
+            health_score=analysis_result['health_score'],
+            llm_model=analysis_result['model'] or '',
+            llm_latency_ms=analysis_result['latency_ms'],
+            prompt_version=analysis_result['prompt_version'],
+            status='COMPLETE'
+        )
+        analysis = FoodAnalysis.objects.get(id=analysis_id)
+        remember_analysis(analysis)
+        answers.schedule_precompute(analysis)
+        logger.info(f"✅ Background analysis completed for {analysis_id}")
+    except Exception as e:
+        logger.error(f"Background analysis failed for {analysis_id}: {str(e)}", exc_info=True)
+        FoodAnalysis.objects.filter(id=analysis_id, status='PENDING').update(status='DEGRADED')
+    finally:
+        close_old_connections()
+
+
+@csrf_exempt
+@require_http_methods(["GET"])
+def get_analysis(request, analysis_id):
+    """Get a stored analysis, e.g. to pick up a result finished in the background"""
+    analysis = get_object_or_404(FoodAnalysis, id=analysis_id)
+    return JsonResponse({
+        'success': True,
+        'analysis_id': str(analysis.id),
+        'extracted_text': analysis.extracted_text,
+        'ocr_confidence': analysis.ocr_confidence,
+        'ingredients': analysis.ingredients_text,
+        'nutrition': analysis.nutrition_text,
+        'tags': analysis.ingredient_tags,
+        'analysis': analysis.analysis_result,
+        'recommendation': analysis.recommendation,
+        'health_score': analysis.health_score,
+        'model': analysis.llm_model or None,
+        'status': analysis.status.lower(),
+        'degraded': analysis.status != 'COMPLETE',
+        'timestamp': analysis.created_at.isoformat()
+    })
+
+
 @csrf_exempt
 @require_http_methods(["POST"])
+@admission_controlled('chat')
 def chat_followup(request):
     """
     Handle follow-up health-related questions about a previously analyzed label.
@@ -205,28 +376,48 @@ def chat_followup(request):
                 if msg.role in ['user', 'llm']
             ]
 
-            # Build prompt
-            prompt = build_chat_prompt(analysis, context_messages, question)
-            logger.debug("🧠 Built chat prompt for LLM")
+            # Common first questions about a product are answered from the cache
+            cached = answers.get_cached_answer(analysis, question) if not chat_id else None
 
-            # Call the LLM
             analyzer_service = get_food_analyzer_service()
-            try:
-                llm_response = analyzer_service.llm(prompt)
-                title, answer = parse_llm_response(llm_response)
-                if not answer or not answer.strip():
-                    answer = "I apologize, but I couldn't generate a proper response. Please try rephrasing your question."
-                logger.info("✅ LLM response received")
-            except Exception as llm_error:
-                logger.error(f"❌ LLM error: {str(llm_error)}", exc_info=True)
-                answer = "I'm experiencing technical difficulties. Please try again later."
-                title = None
+            deadline = Deadline.for_request(request, 'chat')
+            reply = None
+            answered = False
+            if cached is not None:
+                title, answer = cached['title'], cached['answer']
+            else:
+                # Build prompt; the first turn also names the chat
+                prompt = build_chat_prompt(analysis, context_messages, question, with_title=not chat_id)
+                logger.debug("🧠 Built chat prompt for LLM")
+
+                # Call the LLM
+                try:
+                    deadline.check('llm')
+                    future = run_in_background(analyzer_service.generate, 'chat', prompt, timeout=deadline.remaining())
+                    hold_admission(request, future)
+                    reply = future.result(timeout=deadline.remaining())
+                    title, answer = parse_llm_response(reply.text)
+                    if not answer or not answer.strip():
+                        answer = "I apologize, but I couldn't generate a proper response. Please try rephrasing your question."
+                    else:
+                        answered = True
+                    logger.info(f"✅ LLM response received from {reply.model}")
+                except (DeadlineExceeded, FutureTimeoutError, GenerationTimeout):
+                    logger.warning(f"⏱️ Chat answer missed the deadline after {deadline.elapsed():.1f}s")
+                    answer = "This is taking longer than expected. Please ask again in a moment."
+                    title = None
+                except Exception as llm_error:
+                    logger.error(f"❌ LLM error: {str(llm_error)}", exc_info=True)
+                    answer = "I'm experiencing technical difficulties. Please try again later."
+                    title = None
 
             # Save LLM response
             llm_msg = Message.objects.create(
                 chat=chat,
                 role='llm',
-                content=answer
+                content=answer,
+                llm_model=cached['model'] if cached else (reply.model if reply else ''),
+                llm_latency_ms=reply.latency_ms if reply else None
             )
             logger.debug(f"🧾 Saved LLM response message ID {llm_msg.id} to chat {chat.id}")
 
@@ -236,12 +427,28 @@ def chat_followup(request):
                 chat.save()
                 logger.debug(f"✏️ Updated chat title to: {chat.title}")
 
+            if answered and not chat_id:
+                answers.cache_answer(
+                    analysis, question.strip(), answer,
+                    chat.title if chat.title != "New Food Chat" else None, reply.model
+                )
+
+            # Let the small title model name new chats the answer didn't title, once
+            # this transaction has committed and without holding up the response
+            if chat.title == "New Food Chat" and (answered or cached is not None):
+                transaction.on_commit(
+                    partial(run_in_background, title_chat_in_background, chat.id, question.strip(), answer)
+                )
+
         return JsonResponse({
             'success': True,
             'chat_id': chat.id,
             'answer': answer,
             'title': chat.title,
             'message_id': llm_msg.id,
+            'model': llm_msg.llm_model or None,
+            'degraded': reply is None and cached is None,
+            'cached': cached is not None,
             'timestamp': llm_msg.created_at.isoformat()
         })
 
@@ -250,6 +457,20 @@ def chat_followup(request):
         return JsonResponse({'error': 'Chat processing failed'}, status=500)
 
 
+def title_chat_in_background(chat_id, question, answer):
+    """Name a new chat with the title model, unless it got a title meanwhile"""
+    try:
+        title = get_food_analyzer_service().generate_title(question, answer)
+    except Exception as e:
+        logger.warning(f"⚠️ Title generation failed: {str(e)}")
+        return
+    chat = Chat.objects.filter(id=chat_id, title="New Food Chat").first()
+    if chat is not None and title:
+        chat.title = title[:255]
+        chat.save()
+        logger.debug(f"✏️ Updated chat title to: {chat.title}")
+
+
 from django.contrib.auth.models import User
 
 def get_or_create_session_user(request):
@@ -285,8 +506,8 @@ def get_or_create_session_user(request):
     return user
 
 
-def build_chat_prompt(analysis, context_messages, question):
-    """Build the chat prompt with title generation instruction"""
+def build_chat_prompt(analysis, context_messages, question, with_title=False):
+    """Build the chat prompt, asking for a chat title on the first turn"""
     has_ingredients = bool(analysis.ingredients_text and analysis.ingredients_text.strip())
     has_nutrition = bool(analysis.nutrition_text and analysis.nutrition_text.strip())
     has_extracted = bool(analysis.extracted_text and analysis.extracted_text.strip())
@@ -303,6 +524,8 @@ def build_chat_prompt(analysis, context_messages, question):
         prompt += f"NUTRITION FACTS: {analysis.nutrition_text}\n\n"
     else:
         prompt += "NUTRITION FACTS: Not clearly visible\n\n"
+    if analysis.ingredient_tags:
+        prompt += f"FLAGGED INGREDIENTS:\n{format_ingredient_hints(analysis.ingredient_tags)}\n\n"
     if analysis.analysis_result:
         prompt += f"PREVIOUS ANALYSIS: {analysis.analysis_result}\n\n"
 
@@ -323,7 +546,13 @@ Instructions for your response:
 - Reference specific ingredients or nutritional information when available
 - If information is missing, acknowledge the limitation
 - If you're unsure about something, say so
-Your response:"""
+"""
+    if with_title:
+        prompt += """- Start with a short title (3-6 words) for this conversation on its own line, then the answer:
+**TITLE**: <title>
+---
+"""
+    prompt += "Your response:"
 
     return prompt
 
@@ -345,11 +574,57 @@ def parse_llm_response(llm_response):
         return None, llm_response.strip()
 
 
+def _skip_on_error(validator):
+    """Let a failing @condition validator skip the 304 check instead of raising.
+
+    The view then runs and reports the error in its usual JSON shape.
+    """
+    @wraps(validator)
+    def wrapper(request, *args, **kwargs):
+        try:
+            return validator(request, *args, **kwargs)
+        except Exception as e:
+            logger.warning(f"Could not compute {validator.__name__}: {str(e)}")
+            return None
+    return wrapper
+
+
+def _chat_history_state(request, chat_id):
+    """One aggregate query that changes whenever the chat's history does (None if not the user's)"""
+    if not hasattr(request, '_chat_history_state'):
+        user = get_or_create_session_user(request)
+        request._chat_history_state = Chat.objects.filter(id=chat_id, user=user).annotate(
+            message_count=Count('message'),
+            last_message_id=Max('message__id'),
+            last_message_at=Max('message__created_at'),
+        ).values_list('title', 'created_at', 'message_count', 'last_message_id', 'last_message_at').first()
+    return request._chat_history_state
+
+
+def _chat_history_etag(request, chat_id):
+    state = _chat_history_state(request, chat_id)
+    return chat_cache.make_etag('history', chat_id, *state) if state else None
+
+
+def _chat_history_last_modified(request, chat_id):
+    state = _chat_history_state(request, chat_id)
+    return (state[4] or state[1]) if state else None
+
+
 @csrf_exempt
 @require_http_methods(["GET"])
+@cache_control(private=True, no_cache=True)
+@condition(etag_func=_skip_on_error(_chat_history_etag),
+           last_modified_func=_skip_on_error(_chat_history_last_modified))
 def get_chat_history(request, chat_id):
     """Get full message history for a specific chat"""
     try:
+        # Polls that get past the 304 check usually still find the body cached
+        etag = _chat_history_etag(request, chat_id)
+        content = chat_cache.get(('history', chat_id), etag) if etag else None
+        if content is not None:
+            return HttpResponse(content, content_type='application/json')
+
         user = get_or_create_session_user(request)
         chat = get_object_or_404(Chat, id=chat_id, user=user)
         messages = Message.objects.filter(chat=chat).order_by('created_at')
@@ -365,7 +640,7 @@ def get_chat_history(request, chat_id):
             for msg in messages
         ]
 
-        return JsonResponse({
+        response = JsonResponse({
             'success': True,
             'chat_id': chat.id,
             'title': chat.title,
@@ -373,39 +648,164 @@ def get_chat_history(request, chat_id):
             'messages': message_data,
             'created_at': chat.created_at.isoformat()
         })
+        chat_cache.put(('history', chat_id), etag, response.content)
+        return response
     except Exception as e:
         logger.error(f"Error in get_chat_history: {str(e)}", exc_info=True)
         return JsonResponse({'success': False, 'error': str(e)}, status=400)
 
 
+def _user_chats_state(request):
+    """One aggregate query that changes whenever any of the user's chats or messages do"""
+    if not hasattr(request, '_user_chats_state'):
+        user = get_or_create_session_user(request)
+        request._user_chats_state = (user.id, Chat.objects.filter(user=user).aggregate(
+            chat_count=Count('id', distinct=True),
+            last_chat_id=Max('id'),
+            last_chat_at=Max('created_at'),
+            message_count=Count('message'),
+            last_message_id=Max('message__id'),
+            last_message_at=Max('message__created_at'),
+        ))
+    return request._user_chats_state
+
+
+def _user_chats_etag(request):
+    user_id, state = _user_chats_state(request)
+    return chat_cache.make_etag('chats', user_id, *state.values())
+
+
+def _user_chats_last_modified(request):
+    _, state = _user_chats_state(request)
+    return max(filter(None, [state['last_chat_at'], state['last_message_at']]), default=None)
+
+
 @csrf_exempt
 @require_http_methods(["GET"])
+@cache_control(private=True, no_cache=True)
+@condition(etag_func=_skip_on_error(_user_chats_etag), last_modified_func=_skip_on_error(_user_chats_last_modified))
 def get_user_chats(request):
     """Get all chats for the current user"""
     try:
-        user = get_or_create_session_user(request)
-        chats = Chat.objects.filter(user=user).order_by('-created_at')
+        user_id, _ = _user_chats_state(request)
+        etag = _user_chats_etag(request)
+        content = chat_cache.get(('chats', user_id), etag)
+        if content is not None:
+            return HttpResponse(content, content_type='application/json')
+
+        chats = Chat.objects.filter(user_id=user_id).annotate(message_count=Count('message')).order_by('-created_at')
 
         chat_data = [
             {
                 'id': chat.id,
                 'title': chat.title,
                 'created_at': chat.created_at.isoformat(),
-                'message_count': chat.message_set.count(),
+                'message_count': chat.message_count,
                 'analysis_id': chat.analysis_id  # ✅ Now included
             }
             for chat in chats
         ]
-        print(chat_data)
-        return JsonResponse({
+        response = JsonResponse({
             'success': True,
             'chats': chat_data
         })
+        chat_cache.put(('chats', user_id), etag, response.content)
+        return response
     except Exception as e:
         logger.error(f"Error getting user chats: {str(e)}", exc_info=True)
         return JsonResponse({'error': 'Failed to retrieve chats'}, status=500)
 
 
+@csrf_exempt
+@require_http_methods(["GET"])
+def search_history(request):
+    """Full-text search over the current user's analyses and chat messages.
+
+    Staff can search every analysis with scope=all.
+    """
+    try:
+        query = request.GET.get('q', '').strip()
+        if not query:
+            return JsonResponse({'error': 'Missing search query'}, status=400)
+        search_type = request.GET.get('type')
+        kinds = (search_type,) if search_type in ('analysis', 'message') else ('analysis', 'message')
+        try:
+            page = max(int(request.GET.get('page', 1)), 1)
+            page_size = min(max(int(request.GET.get('page_size', 20)), 1), 100)
+        except ValueError:
+            return JsonResponse({'error': 'Invalid page or page_size'}, status=400)
+
+        user = get_or_create_session_user(request)
+        if request.GET.get('scope') == 'all':
+            if not _staff_user(request):
+                return JsonResponse({'error': 'Staff access required'}, status=403)
+            analysis_ids = None
+        else:
+            analysis_ids = search.visible_analysis_ids(user, request.session.session_key)
+        results, total = search.search(
+            query, user=user, kinds=kinds, page=page, page_size=page_size, analysis_ids=analysis_ids
+        )
+        return JsonResponse({
+            'success': True,
+            'query': query,
+            'results': results,
+            'total': total,
+            'page': page,
+            'page_size': page_size,
+            'has_next': page * page_size < total
+        })
+    except Exception as e:
+        logger.error(f"Error in search_history: {str(e)}", exc_info=True)
+        return JsonResponse({'error': 'Search failed'}, status=500)
+
+
+def _staff_user(request):
+    """The staff user behind a session or JWT-authenticated request, else None"""
+    user = request.user
+    if not user.is_authenticated:
+        # Also accept the API's JWT bearer tokens, for scripted access
+        try:
+            authenticated = JWTAuthentication().authenticate(request)
+        except (InvalidToken, AuthenticationFailed):
+            authenticated = None
+        if authenticated:
+            user = authenticated[0]
+    return user if user.is_authenticated and user.is_staff else None
+
+
+@csrf_exempt
+@require_http_methods(["GET"])
+def export_data(request):
+    """Stream analyses, chats or messages as NDJSON or CSV (staff only)"""
+    user = _staff_user(request)
+    if user is None:
+        return JsonResponse({'error': 'Staff access required'}, status=403)
+
+    dataset = request.GET.get('dataset', 'analyses')
+    export_format = request.GET.get('format', 'ndjson')
+    if export_format not in exports.FORMATS:
+        return JsonResponse({'error': f"format must be one of {', '.join(exports.FORMATS)}"}, status=400)
+    try:
+        fields, rows = exports.export_rows(
+            dataset,
+            since=exports.parse_bound(request.GET.get('since')),
+            until=exports.parse_bound(request.GET.get('until'), end=True),
+            recommendation=request.GET.get('recommendation'),
+            user=request.GET.get('user'),
+        )
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+
+    logger.info(f"📤 Streaming {dataset} export as {export_format} for {user.username}")
+    response = StreamingHttpResponse(
+        exports.iter_export(fields, rows, export_format),
+        content_type=exports.FORMATS[export_format]
+    )
+    filename = f"{dataset}-{timezone.now():%Y%m%d-%H%M%S}.{export_format}"
+    response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
+
+
 class SignupView(generics.CreateAPIView):
     queryset = get_user_model().objects.all()
     serializer_class = UserSignupSerializer
\ No newline at end of file
@@ -0,0 +1,101 @@
+"""Gunicorn configuration: `gunicorn` from this directory picks it up.
+
+The app is loaded once in the master (Django setup, LangChain, the ingredient
+knowledge base, NumPy/Pillow/Tesseract bindings) and workers are forked from
+it, so that memory is shared copy-on-write. Worker model and sizes follow the
+admission control and OCR settings; see docs/serving.md.
+"""
+import gc
+import multiprocessing
+import os
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'myproject.settings')
+
+from django.conf import settings  # noqa: E402  (settings only; the app loads below)
+
+wsgi_app = 'myproject.wsgi:application'
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:8000')
+preload_app = True
+
+# Requests a worker holds at once: the LLM-bound endpoints' running and queued
+# requests (they wait inside the worker for a slot) plus a few for cheap reads
+_admission = getattr(settings, 'ADMISSION_CONTROL', {})
+_slots = sum(limits['max_concurrency'] + limits['max_queue'] for limits in _admission.values())
+LIGHT_REQUEST_THREADS = 4
+
+worker_class = getattr(settings, 'GUNICORN_WORKER_CLASS', None) or ('gthread' if _slots > 1 else 'sync')
+if worker_class == 'gthread':
+    threads = getattr(settings, 'GUNICORN_THREADS', None) or _slots + LIGHT_REQUEST_THREADS
+
+# Tesseract is the CPU-heavy part and each OCR already runs OCR_MAX_WORKERS
+# processes in parallel, so more workers than cores / OCR lanes only contend
+workers = (
+    int(os.environ.get('WEB_CONCURRENCY', 0))
+    or getattr(settings, 'GUNICORN_WORKERS', None)
+    or max(1, multiprocessing.cpu_count() // max(1, getattr(settings, 'OCR_MAX_WORKERS', 4)))
+)
+
+# Recycle workers to bound slow leaks; jitter keeps them from restarting together
+max_requests = getattr(settings, 'GUNICORN_MAX_REQUESTS', 1000)
+max_requests_jitter = getattr(settings, 'GUNICORN_MAX_REQUESTS_JITTER', 100)
+
+# A sync worker is killed after `timeout` mid-request, so stay above the longest
+# deadline. Exiting workers get until `graceful_timeout` to finish requests,
+# which covers the analysis latency SLO.
+_longest_deadline = max(getattr(settings, 'REQUEST_DEADLINES', {}).values(), default=30)
+_longest_llm_call = max(getattr(settings, 'OLLAMA_LATENCY_SLO_SECONDS', {}).values(), default=_longest_deadline)
+timeout = _longest_deadline + 15
+graceful_timeout = max(_longest_deadline, _longest_llm_call) + 15
+keepalive = 5
+# worker_exit runs after the worker's last heartbeat, so the master kills it
+# `timeout` seconds later (and on shutdown at `graceful_timeout`); stop waiting
+# for background work before either
+BACKGROUND_EXIT_WAIT = min(timeout, graceful_timeout) - 5
+
+
+def when_ready(server):
+    """Warm what every worker would otherwise build, then freeze it for copy-on-write sharing"""
+    from django.db import connections
+    from analyzer.services import get_food_analyzer_service
+    from analyzer.similarity import get_similarity_index
+
+    try:
+        get_food_analyzer_service().ocr.version  # Runs `tesseract --version` once instead of in every worker
+    except Exception as e:
+        server.log.warning(f"Could not read the Tesseract version: {e}")
+    try:
+        if getattr(settings, 'NEAR_DUPLICATE_CACHE', True):
+            server.log.info(f"Preloaded {len(get_similarity_index())} label signatures")
+    except Exception as e:
+        server.log.warning(f"Could not preload the similarity index, workers will load it lazily: {e}")
+    finally:
+        # Forked workers must not share the master's database connections
+        connections.close_all()
+    # Objects moved to the permanent generation are never touched by the cyclic
+    # GC, so collections in the workers don't copy the shared pages
+    gc.collect()
+    gc.freeze()
+
+
+def pre_fork(server, worker):
+    from django.db import connections
+    connections.close_all()
+
+
+def post_fork(server, worker):
+    # Executors and caches are per process and rebuild themselves lazily; start
+    # the Ollama health checker now since threads don't survive fork()
+    from analyzer.services import get_food_analyzer_service
+    try:
+        get_food_analyzer_service().pool.start()
+    except Exception as e:
+        server.log.warning(f"Could not start the Ollama health checker: {e}")
+
+
+def worker_exit(server, worker):
+    """Give background analyses a bounded time to finish before a recycled or stopped worker exits"""
+    from analyzer.tasks import shutdown_background_executor
+    unfinished = shutdown_background_executor(timeout=BACKGROUND_EXIT_WAIT)
+    if unfinished:
+        server.log.warning(f"Worker exiting with {unfinished} background tasks unfinished "
+                           f"after {BACKGROUND_EXIT_WAIT}s")
@@ -104,6 +104,23 @@ STATICFILES_DIRS = [
 MEDIA_URL = '/media/'
 MEDIA_ROOT = BASE_DIR / 'media'
 
+# Uploaded label images are stored once per unique content (SHA-256) and
+# transcoded to a size-capped WebP copy used for OCR and display
+LABEL_IMAGE_KEEP_ORIGINAL = False  # Also keep the original upload next to the WebP copy
+LABEL_IMAGE_MAX_DIMENSION = 2048  # Longest side in pixels; None disables transcoding
+LABEL_IMAGE_WEBP_QUALITY = 85
+
+# Data retention, applied by `manage.py apply_retention` (days; None keeps forever)
+RETENTION_POLICIES = {
+    'chats': 180,  # Chats with no message newer than this, and their messages
+    'analyses': 365,  # Analyses no surviving chat refers to
+    'sessions': 90,  # AnalysisSession rows by last activity
+    'anonymous_users': 30,  # Session users that never started a chat
+}
+RETENTION_ARCHIVE_DIR = None  # e.g. BASE_DIR / 'archive' to keep a compressed JSONL copy
+RETENTION_BATCH_SIZE = 500
+RETENTION_MEDIA_GRACE_HOURS = 24  # Never treat files younger than this as orphaned
+
 # Default primary key field type
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
@@ -122,6 +139,112 @@ DATA_UPLOAD_MAX_MEMORY_SIZE = 10 * 1024 * 1024  # 10MB
 # Ollama settings
 OLLAMA_MODEL = 'llama3.2:latest'  
 OLLAMA_BASE_URL = 'http://localhost:11434' 
+# Inference nodes generations are spread over (least-loaded healthy node wins)
+OLLAMA_BACKENDS = [OLLAMA_BASE_URL]
+OLLAMA_BACKEND_MAX_FAILURES = 3  # Consecutive connection errors or 5xx responses before a node is ejected
+OLLAMA_HEALTH_CHECK_INTERVAL = 15  # Seconds between background health checks; 0 disables
+
+# Model used per LLM task type ('analysis', 'chat', 'title', 'summary'); tasks
+# without an entry use OLLAMA_MODEL. Pull a model on every node before routing
+# to it, e.g. {'title': 'llama3.2:1b', 'summary': 'llama3.2:1b'}; a route to a
+# model no node reports having falls back to OLLAMA_MODEL.
+OLLAMA_MODEL_ROUTES = {}
+# Smaller model a task is downgraded to when its routed model is overloaded, e.g.
+# {OLLAMA_MODEL: 'llama3.2:1b'}; only used once a node reports having it
+OLLAMA_MODEL_FALLBACKS = {}
+OLLAMA_LATENCY_SLO_SECONDS = {  # Downgrade when the projected wait exceeds this
+    'analysis': 90,
+    'chat': 30,
+}
+OLLAMA_MAX_QUEUE_DEPTH = 4  # Downgrade when this many generations are in flight
+
+# Admission control for LLM-bound endpoints (per worker process). Requests
+# beyond max_concurrency wait up to max_wait_seconds in a queue of max_queue;
+# the rest are shed immediately with 503 + Retry-After.
+ADMISSION_CONTROL = {
+    'analyze': {'max_concurrency': 2, 'max_queue': 8, 'max_wait_seconds': 20},
+    'chat': {'max_concurrency': 4, 'max_queue': 16, 'max_wait_seconds': 10},
+}
+# End-to-end time budget per endpoint in seconds, including queueing, OCR, LLM and DB
+REQUEST_DEADLINES = {
+    'analyze': 45,
+    'chat': 25,
+}
+DEADLINE_DB_RESERVE_SECONDS = 1.0  # Budget kept back for saving results
+DEADLINE_LLM_RESERVE_SECONDS = 10  # Budget extra OCR passes leave for the LLM
+# When the LLM misses the deadline, return a heuristic result marked degraded and
+# let the full analysis finish in the background (fetch it from /api/analysis/<id>/)
+ANALYSIS_BACKGROUND_COMPLETION = True
+OLLAMA_REQUEST_TIMEOUT = 120  # Longest any generation may run, background ones included
+BACKGROUND_WORKERS = None  # None: one thread per admission slot (sum of max_concurrency) plus 2
+
+# Reuse a previous analysis when the same image, or another photo of the same
+# label (MinHash similarity of the ingredient/nutrition text), was analyzed before
+NEAR_DUPLICATE_CACHE = True
+NEAR_DUPLICATE_THRESHOLD = 0.8  # Estimated Jaccard similarity of the label text
+NEAR_DUPLICATE_SYNC_SECONDS = 30  # How often each worker loads signatures saved by others
+
+# Allergen/additive/ingredient knowledge base used to tag labels before the LLM
+# runs; None uses the file bundled in analyzer/data/
+INGREDIENT_KNOWLEDGE_PATH = None
+
+# 'markdown' asks the model for the full report and scrapes it; 'json' asks for a
+# compact JSON object constrained by Ollama's `format`, with a capped token budget
+ANALYSIS_OUTPUT_MODE = 'markdown'
+ANALYSIS_JSON_NUM_PREDICT = 320
+ANALYSIS_JSON_SCHEMA = True  # Send the full JSON schema (Ollama 0.5+); False sends format='json'
+
+# OCR only the text blocks found on a downscaled copy of the label, in parallel,
+# each with a page segmentation mode suited to it (line, column or table)
+OCR_REGION_DETECTION = True
+OCR_MAX_WORKERS = 4
+OCR_DETECTION_MAX_DIMENSION = 1000  # Longest side of the copy used to find blocks
+OCR_REGION_MIN_PIXELS = 1_000_000  # Smaller images are read whole
+OCR_MAX_REGIONS = 24  # More blocks than this and the image is read whole
+
+# Each block gets one fast OCR pass; blocks read below the confidence target get
+# up to OCR_MAX_PASSES in total (inverted, another segmentation mode, upscaled 2x)
+OCR_CONFIDENCE_TARGET = 80  # Mean word confidence, 0-100
+OCR_MAX_PASSES = 3
+OCR_MAX_UPSCALE_PIXELS = 4_000_000
+OCR_CHAR_WHITELIST = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz()[]{},./:;%*+-=<>!@#$%^&*()_+|\\~` '  # None: no whitelist
+
+# First-turn chat answers are cached per analysis (in the default Django cache)
+# and reused for questions with the same content words (stopwords, word order
+# and inflections aside)
+CHAT_ANSWER_CACHE = True
+CHAT_ANSWER_CACHE_TTL = 24 * 3600  # Seconds
+CHAT_ANSWER_CACHE_MAX_ENTRIES = 20  # Questions remembered per analysis
+# Answered in the background right after each fresh analysis so these chats start
+# instantly, e.g. ["Is this vegan?", "Is it safe for diabetics?", "How much can I eat?"].
+# One thread per process, using chat admission slots only while they are free
+CHAT_ANSWER_PRECOMPUTE_QUESTIONS = []
+CHAT_ANSWER_PRECOMPUTE_MAX_PENDING = 8  # Analyses waiting to be precomputed; later ones are skipped
+
+# Serialized chat list/history responses kept per worker process; polls whose
+# ETag still matches are answered with 304, or from this cache without re-serializing.
+# Entries only match the ETag computed from the database on each request, so
+# writes in other processes never serve stale bodies. Memory is bounded by
+# MAX_ENTRIES x MAX_ENTRY_BYTES per process.
+CHAT_RESPONSE_CACHE_MAX_ENTRIES = 1000
+CHAT_RESPONSE_CACHE_MAX_ENTRY_BYTES = 256 * 1024  # Larger responses are not cached
+
+# Rows fetched per server-side cursor round trip by the export endpoint and command
+EXPORT_CHUNK_SIZE = 2000
+
+# Gunicorn (gunicorn.conf.py); None derives the value from the settings above:
+# gthread workers with a thread per admission slot, one worker per OCR_MAX_WORKERS cores
+GUNICORN_WORKERS = None  # WEB_CONCURRENCY in the environment takes precedence
+GUNICORN_WORKER_CLASS = None  # 'sync' or 'gthread'
+GUNICORN_THREADS = None
+GUNICORN_MAX_REQUESTS = 1000  # Requests before a worker is recycled
+GUNICORN_MAX_REQUESTS_JITTER = 100
+
+# Per-client token buckets ('<count>/<s|m|h>'); exceeding them returns 429
+RATE_LIMITS = {
+    'analyze': {'per_ip': '20/m', 'per_session': '10/m'},
+    'chat': {'per_ip': '60/m', 'per_session': '30/m'},
+}
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': (